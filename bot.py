@@ -2,14 +2,15 @@ import os
 import time
 import random
 import re
+from io import BytesIO
 from itertools import groupby
 
 import django
 import telebot
-from telebot import types
 from openpyxl import Workbook
 from django.utils import timezone
-from django.contrib.auth.hashers import make_password, check_password
+from django.db.models import Count, F, Q, Sum
+from django.db.models.functions import Coalesce
 
 os.environ.setdefault(
     key='DJANGO_SETTINGS_MODULE',
@@ -17,230 +18,243 @@ os.environ.setdefault(
 )
 django.setup()
 
-from quiz.settings import BOT_TOKEN
-from tgbot.models import Authorization, CustomUser, PointsTransaction, Question, Tournament, PointsTournament, Standings
+from quiz.settings import BOT_TOKEN, BOT_WORKER_THREADS, CONVERSATION_STATE_TTL, CONVERSATION_STATE_SWEEP_INTERVAL
+from tgbot.models import Authorization, CustomUser, PointsTransaction, Question, Tournament, PointsTournament, Standings, \
+    ScoreLedger
+from tgbot.keyboards import AUTH_KEYBOARD, NAVIGATION_KEYBOARD, REMOVE_KEYBOARD, get_main_menu_keyboard, get_answer_keyboard, \
+    get_tours_keyboard
+from tgbot.question_bank import get_question_bank, get_tour_ids, get_tour_questions, get_tour_question
+from tgbot.dispatcher import setup_chat_dispatcher
+from tgbot.router import CommandRouter
+from tgbot.conversation import StateStoreHandlerBackend, get_state_store, start_conversation_sweeper
+from tgbot.passwords import submit_password_task, hash_password, verify_password
+from tgbot.session import UserSessionMiddleware, get_user_session, reset_user_session
+from tgbot.leaderboard import get_cached_leaderboard, get_cached_leaderboard_export, get_leaderboard_export_key, \
+    get_export_file_id, set_export_file_id, delete_export_file_id
+
+bot = telebot.TeleBot(
+    BOT_TOKEN,
+    use_class_middlewares=True
+)
+bot.setup_middleware(UserSessionMiddleware())
+
+# Все текстовые сообщения проходят через один обработчик, который выбирает функцию по точному тексту
+router = CommandRouter()
+bot.register_message_handler(router.dispatch)
 
-bot = telebot.TeleBot(BOT_TOKEN)
+bot.next_step_backend = StateStoreHandlerBackend(
+    store=get_state_store(),
+    callbacks=globals(),
+    ttl=CONVERSATION_STATE_TTL,
+    fallback=router.dispatch
+)
 
+EXPORT_FILE_NAME = 'results.xlsx'
 
-def update_standings_places():
+# Размер порции строк при чтении рейтинга (в PostgreSQL - через серверный курсор)
+EXPORT_CHUNK_SIZE = 2000
+
+
+def rank_standings(standings_list, key):
     """
-    Обновляет места в турнирной таблице
+    Возвращает словарь {ID записи: место}. Записи с одинаковым значением key получают одно место
+    standings_list - записи Standings, отсортированные в порядке рейтинга
     """
-    standings_list = Standings.objects.order_by('-tournament_points')
-    quiz_standings_list = Standings.objects.order_by('-quiz_points')
-    total_standings_list = Standings.objects.order_by('-total_points', 'full_name')
+    places = {}
 
     for index, standings_group in enumerate(
-            groupby(standings_list, key=lambda x: x.tournament_points), start=1
+            groupby(standings_list, key=key), start=1
     ):
         for standings in standings_group[1]:
-            standings.tournament_place = index
-            standings.save()
-
-    for index, quiz_standings_group in enumerate(
-            groupby(quiz_standings_list, key=lambda x: x.quiz_points), start=1
-    ):
-        for quiz_standings in quiz_standings_group[1]:
-            quiz_standings.quiz_place = index
-            quiz_standings.save()
+            places[standings.id] = index
 
-    for index, total_standings_group in enumerate(
-            groupby(total_standings_list, key=lambda x: (x.total_points, x.full_name)), start=1
-    ):
-        for total_standings in total_standings_group[1]:
-            total_standings.final_place = index
-            total_standings.save()
+    return places
 
 
-def update_tournament_points(telegram_id):
-    """"
-    Выводит общие очки, набранные пользователем во время турнира
+def update_standings_places():
     """
-    auth_data = Authorization.objects.filter(
-        telegram_id=telegram_id,
+    Обновляет места в турнирной таблице
+    Таблица читается одним запросом, а в БД записываются только те строки,
+    у которых изменилось хотя бы одно из мест (одним bulk_update)
+    """
+    total_standings_list = list(
+        Standings.objects.order_by().only(
+            'id',
+            'full_name',
+            'total_points',
+            'final_place',
+            'tournament_points',
+            'tournament_place',
+            'quiz_points',
+            'quiz_place',
+        )
     )
-    telegram_id = auth_data.first()
 
-    tournament_sender_data = PointsTournament.objects.filter(
-        sender_telegram_id=telegram_id,
+    # Сортировка в Python, а не в БД: SQLite и PostgreSQL по-разному располагают NULL и сравнивают строки
+    total_standings_list.sort(
+        key=lambda x: (x.total_points is None, -(x.total_points or 0), x.full_name)
     )
 
-    if tournament_sender_data:
-        tournament_points = 0
-        points_received_or_transferred = 0
-        bonuses = 0
-        total_transfer_loss = 0
-        total_transfer_income = 0
-
-        for item in tournament_sender_data:
-            tournament_points += item.tournament_points if item.tournament_points else 0
-            points_received_or_transferred += item.points_received_or_transferred if item.points_received_or_transferred else 0
-            bonuses += item.bonuses if item.bonuses else 0
-            total_transfer_loss += item.points_transferred if item.points_transferred else 0
-
-        sender_data_vals = [
-            tournament_points,
-            points_received_or_transferred,
-            bonuses,
-        ]
+    standings_list = sorted(
+        total_standings_list,
+        key=lambda x: (x.tournament_points is None, -(x.tournament_points or 0))
+    )
 
-        tournament_receiver_data = PointsTournament.objects.filter(
-            receiver_telegram_id=telegram_id,
-        )
+    quiz_standings_list = sorted(
+        total_standings_list,
+        key=lambda x: (x.quiz_points is None, -(x.quiz_points or 0))
+    )
 
-        if tournament_receiver_data:
-            for item in tournament_receiver_data:
-                total_transfer_income += item.points_transferred if item.points_transferred else 0
+    places = {
+        'tournament_place': rank_standings(
+            standings_list, key=lambda x: x.tournament_points
+        ),
+        'quiz_place': rank_standings(
+            quiz_standings_list, key=lambda x: x.quiz_points
+        ),
+        'final_place': rank_standings(
+            total_standings_list, key=lambda x: (x.total_points, x.full_name)
+        ),
+    }
 
-        standing_participant = Standings.objects.filter(
-            participant_telegram=telegram_id,
-        )
+    changed_standings = []
+    for standings in total_standings_list:
+        is_changed = False
 
-        auth_data = Authorization.objects.filter(
-            telegram_id=telegram_id,
+        for place_field, place_dict in places.items():
+            place = place_dict[standings.id]
+
+            if getattr(standings, place_field) != place:
+                setattr(standings, place_field, place)
+                is_changed = True
+
+        if is_changed:
+            changed_standings.append(standings)
+
+    if changed_standings:
+        Standings.objects.bulk_update(
+            changed_standings,
+            fields=list(places.keys()),
+            batch_size=500
         )
 
-        if not standing_participant.exists() and auth_data.exists():
-            standing_participant = Standings(
-                participant_telegram=telegram_id,
-                full_name=auth_data.first().full_name,
-            ).save()
 
-            standing_participant = Standings.objects.filter(
-                participant_telegram=telegram_id,
-            )
+def update_points_rows(points_rows, **fields):
+    """
+    Обновляет записи PointsTransaction или PointsTournament через save(),
+    чтобы изменение баллов было применено к ScoreLedger
+    """
+    for points_row in points_rows:
+        for field, value in fields.items():
+            setattr(points_row, field, value)
 
-        if standing_participant:
-            standing_participant.update(
-                tournament_points=sum(
-                    sender_data_vals
-                ) + (
-                    total_transfer_income - total_transfer_loss
-                ),
-            )
+        points_row.save()
 
-            standing_participant.update(
-                total_points=standing_participant.first().quiz_points + standing_participant.first().tournament_points
-            )
-            update_standings_places()
 
+def calculate_participant_points(ledger_type, telegram_id):
+    """
+    Считает итоговые баллы участника по накопленным записям ScoreLedger
+    ledger_type - тип баллов (ScoreLedger.QUIZ для викторины, ScoreLedger.TOURNAMENT для турнира)
+    telegram_id - Telegram ID участника
 
-def update_quiz_points(telegram_id):
-    """"
-    Выводит общие очки, набранные пользователем во время викторины
+    ИТОГ = баллы по типам 1-3 + (доход от трансфера - убыток от трансфера)
     """
-    auth_data = Authorization.objects.filter(
-        telegram_id=telegram_id,
+    points_data = ScoreLedger.objects.filter(
+        participant_telegram_id=telegram_id,
+        ledger_type=ledger_type
+    ).aggregate(
+        tournament_points=Coalesce(Sum('tournament_points'), 0),
+        points_received_or_transferred=Coalesce(Sum('points_received_or_transferred'), 0),
+        bonuses=Coalesce(Sum('bonuses'), 0),
+        total_transfer_loss=Coalesce(Sum('transfer_loss'), 0),
+        total_transfer_income=Coalesce(Sum('transfer_income'), 0),
     )
-    telegram_id = auth_data.first()
 
-    tournament_sender_data = PointsTransaction.objects.filter(
-        sender_telegram_id=telegram_id,
+    return sum([
+        points_data['tournament_points'],
+        points_data['points_received_or_transferred'],
+        points_data['bonuses'],
+    ]) + (
+        points_data['total_transfer_income'] - points_data['total_transfer_loss']
     )
 
-    if tournament_sender_data:
-        tournament_points = 0
-        points_received_or_transferred = 0
-        bonuses = 0
-        total_transfer_loss = 0
-        total_transfer_income = 0
-
-        for item in tournament_sender_data:
-            tournament_points += item.tournament_points if item.tournament_points else 0
-            points_received_or_transferred += item.points_received_or_transferred if item.points_received_or_transferred else 0
-            bonuses += item.bonuses if item.bonuses else 0
-            total_transfer_loss += item.points_transferred if item.points_transferred else 0
-
-        sender_data_vals = [
-            tournament_points,
-            points_received_or_transferred,
-            bonuses,
-        ]
 
-        tournament_receiver_data = PointsTransaction.objects.filter(
-            receiver_telegram_id=telegram_id,
-        )
+def update_standings_points(telegram_id, ledger_type, points_field):
+    """
+    Записывает баллы участника в Standings одним UPDATE и обновляет места в турнирной таблице
+    points_field - столбец Standings, в который записываются баллы (quiz_points или tournament_points)
+    """
+    points = calculate_participant_points(
+        ledger_type=ledger_type,
+        telegram_id=telegram_id
+    )
 
-        if tournament_receiver_data:
-            for item in tournament_receiver_data:
-                total_transfer_income += item.points_transferred if item.points_transferred else 0
+    other_points_field = 'tournament_points' if points_field == 'quiz_points' else 'quiz_points'
 
-        standing_participant = Standings.objects.filter(
-            participant_telegram=telegram_id,
-        )
+    is_updated = Standings.objects.filter(
+        participant_telegram_id=telegram_id,
+    ).update(**{
+        points_field: points,
+        'total_points': Coalesce(F(other_points_field), 0) + points,
+    })
 
+    if not is_updated:
         auth_data = Authorization.objects.filter(
             telegram_id=telegram_id,
-        )
+        ).first()
 
-        if not standing_participant.exists() and auth_data.exists():
-            standing_participant = Standings(
-                participant_telegram=telegram_id,
-                full_name=auth_data.first().full_name,
-            ).save()
+        if auth_data is None:
+            return
 
-            standing_participant = Standings.objects.filter(
-                participant_telegram=telegram_id,
-            )
+        Standings.objects.create(**{
+            'participant_telegram': auth_data,
+            'full_name': auth_data.full_name,
+            points_field: points,
+            'total_points': points,
+        })
 
-        if standing_participant:
-            standing_participant.update(
-                quiz_points=sum(
-                    sender_data_vals
-                ) + (
-                    total_transfer_income - total_transfer_loss
-                )
-            )
+    update_standings_places()
 
-            standing_participant.update(
-                total_points=standing_participant.first().quiz_points + standing_participant.first().tournament_points
-            )
-            update_standings_places()
+
+def update_tournament_points(telegram_id):
+    """"
+    Выводит общие очки, набранные пользователем во время турнира
+    """
+    update_standings_points(
+        telegram_id=telegram_id,
+        ledger_type=ScoreLedger.TOURNAMENT,
+        points_field='tournament_points'
+    )
+
+
+def update_quiz_points(telegram_id):
+    """"
+    Выводит общие очки, набранные пользователем во время викторины
+    """
+    update_standings_points(
+        telegram_id=telegram_id,
+        ledger_type=ScoreLedger.QUIZ,
+        points_field='quiz_points'
+    )
 
 
-@bot.message_handler(commands=['start'])
+@router.route('/start')
 def start(message):
     """
     Запускает бота для регистрации и авторизации пользователей
     """
     markup_start = True
-    user_auth = Authorization.objects.filter(telegram_id=message.from_user.id)
-
-    if user_auth.exists():
-        user_id = user_auth.first().id
-        custom_user = CustomUser.objects.filter(id=user_id)
-
-        if custom_user.exists():
-            if custom_user.first().is_authorized:
-                bot.send_message(
-                    chat_id=message.chat.id,
-                    text='Вы уже авторизованы',
-                )
-                markup_start = False
-
-    if markup_start:
-        markup = types.ReplyKeyboardMarkup(
-            resize_keyboard=True
-        )
-
-        btn_register = types.KeyboardButton(
-            text='Регистрация'
-        )
-
-        btn_login = types.KeyboardButton(
-            text='Авторизация'
-        )
+    session = get_user_session(message)
 
-        btn_password = types.KeyboardButton(
-            text='Забыл пароль'
+    if session.is_authorized:
+        bot.send_message(
+            chat_id=message.chat.id,
+            text='Вы уже авторизованы',
         )
+        markup_start = False
 
-        markup.add(
-            btn_register,
-            btn_login,
-            btn_password
-        )
+    if markup_start:
+        markup = AUTH_KEYBOARD
 
         bot.reply_to(
             message=message,
@@ -254,15 +268,13 @@ def start(message):
         )
 
 
-@bot.message_handler(func=lambda message: "Регистрация" in message.text or message.text == "/register")
+@router.route('Регистрация', '/register')
 def register(message):
     """
     Проверяет зарегистрирован ли пользователь. Если нет, то начинает серию вопросов
     """
     chat_id = message.chat.id
-    uid = message.from_user.id
-
-    if Authorization.objects.filter(telegram_id=uid).exists():
+    if get_user_session(message).authorization_id is not None:
         response = bot.reply_to(
             message=message,
             text="Вы уже зарегистрированы!"
@@ -354,14 +366,31 @@ def process_phone_number(message, full_name, date_of_birth):
 
 def process_password_registration(message, full_name, date_of_birth, phone_number):
     """
-    Получает информацию о пароле пользователя, создает запись о пользователе в таблице Authorization
+    Получает информацию о пароле пользователя и хэширует его в пуле процессов (см. complete_registration)
+    Результат передается в пул потоков бота, чтобы регистрация выполнилась в очереди сообщений чата
+    """
+    submit_password_task(
+        hash_password,
+        message.text,
+        callback=lambda hashed_password: bot.worker_pool.put(
+            complete_registration,
+            message,
+            full_name=full_name,
+            date_of_birth=date_of_birth,
+            phone_number=phone_number,
+            hashed_password=hashed_password
+        )
+    )
+
+
+def complete_registration(message, full_name, date_of_birth, phone_number, hashed_password):
+    """
+    Создает запись о пользователе в таблице Authorization после хэширования пароля
     """
-    password = message.text
-    hashed_password = make_password(password)
     uid = message.from_user.id
 
     authorization = Authorization.objects.filter(
-        telegram_id=str(uid)
+        telegram_id=uid
     )
 
     if not authorization.exists():
@@ -405,29 +434,21 @@ def process_password_registration(message, full_name, date_of_birth, phone_numbe
         )
 
 
-@bot.message_handler(func=lambda message: "Авторизация" in message.text or message.text == "/login")
+@router.route('Авторизация', '/login')
 def login(message):
     """
     Начинает процесс авторизации пользователя
     """
-    uid = message.from_user.id
-    auth_data = Authorization.objects.filter(
-        telegram_id=str(uid)
-    )
+    session = get_user_session(message)
 
-    if not auth_data.exists():
+    if session.authorization_id is None:
         bot.reply_to(
             message=message,
             text="Вы не зарегистрированы. Для регистрации введите /register"
         )
 
     else:
-        auth_obj = auth_data.first()
-        custom_user = CustomUser.objects.filter(
-            username_id=auth_obj.id
-        ).first()
-
-        if custom_user.is_authorized:
+        if session.is_authorized:
             bot.reply_to(
                 message,
                 "Вы уже авторизованы."
@@ -435,7 +456,7 @@ def login(message):
         else:
             process_login_data(
                 message,
-                custom_user
+                session.custom_user
             )
 
 
@@ -457,15 +478,30 @@ def process_login_data(message, custom_user):
 
 def process_password(message, custom_user):
     """
-    Осуществляет вход пользователя в приложение, если пароль верный
+    Проверяет пароль пользователя в пуле процессов (см. complete_login)
     """
-    input_password = message.text
-    actual_password = custom_user.password
+    submit_password_task(
+        verify_password,
+        message.text,
+        custom_user.password,
+        callback=lambda is_valid: bot.worker_pool.put(
+            complete_login,
+            message,
+            custom_user=custom_user,
+            is_valid=is_valid
+        )
+    )
+
 
-    if check_password(input_password, actual_password):
+def complete_login(message, custom_user, is_valid):
+    """
+    Осуществляет вход пользователя в приложение, если пароль верный
+    """
+    if is_valid:
         custom_user.last_login = timezone.now()
         custom_user.is_authorized = True
         custom_user.save()
+        reset_user_session(message)
 
         main_menu(message)
 
@@ -476,29 +512,22 @@ def process_password(message, custom_user):
         )
 
 
-@bot.message_handler(func=lambda message: "Забыл пароль" in message.text or message.text == "/password")
+@router.route('Забыл пароль', '/password')
 def change_password(message):
     """
     Меняет пароль в случае, если пользователь забыл его
     """
-    uid = message.from_user.id
-    auth_data = Authorization.objects.filter(
-        telegram_id=str(uid)
-    )
+    session = get_user_session(message)
 
-    if not auth_data.exists():
+    if session.authorization_id is None:
         bot.reply_to(
             message=message,
             text="Вы не зарегистрированы. Для регистрации введите /register"
         )
 
     else:
-        custom_user = CustomUser.objects.get(
-            username_id=auth_data.first().id
-        )
-
-        if custom_user:
-            if custom_user.is_authorized == False:
+        if session.custom_user_id is not None:
+            if not session.is_authorized:
                 response = bot.reply_to(
                     message,
                     "Введите ваш новый пароль:"
@@ -518,23 +547,32 @@ def change_password(message):
 
 def get_new_password(message):
     """
-    Позволяет получить новый пароль
+    Позволяет получить новый пароль. Пароль хэшируется в пуле процессов (см. complete_password_change)
     """
-    new_password = message.text
+    submit_password_task(
+        hash_password,
+        message.text,
+        callback=lambda hashed_password: bot.worker_pool.put(
+            complete_password_change,
+            message,
+            hashed_password=hashed_password
+        )
+    )
 
-    hashed_password = make_password(new_password)
-    uid = message.from_user.id
 
-    auth_user = Authorization.objects.filter(
-        telegram_id=str(uid)
-    )
+def complete_password_change(message, hashed_password):
+    """
+    Сохраняет новый пароль пользователя после его хэширования
+    """
+    session = get_user_session(message)
 
-    if auth_user.exists():
+    if session.authorization_id is not None:
         CustomUser.objects.filter(
-            username_id=auth_user.first().id
+            username_id=session.authorization_id
         ).update(
             password=hashed_password
         )
+        reset_user_session(message)
 
         bot.reply_to(
             message=message,
@@ -543,50 +581,22 @@ def get_new_password(message):
 
 
 
-@bot.message_handler(func=lambda message: "Главное меню" in message.text or message.text == "/main_menu")
+@router.route('Главное меню', '/main_menu')
 def main_menu(message):
     """
     Отображает главное меню пользователя
     """
-    uid = message.from_user.id
-    auth_data = Authorization.objects.filter(
-        telegram_id=str(uid)
-    )
+    session = get_user_session(message)
 
-    if not auth_data.exists():
+    if session.authorization_id is None:
         bot.reply_to(
             message=message,
             text="Вы не зарегистрированы. Для регистрации введите /register"
         )
 
     else:
-        auth_obj = auth_data.first()
-        custom_user = CustomUser.objects.filter(
-            username_id=auth_obj.id
-        ).first()
-
-        if not custom_user.is_authorized:
-            markup = types.ReplyKeyboardMarkup(
-                resize_keyboard=True
-            )
-
-            btn_register = types.KeyboardButton(
-                text='Регистрация'
-            )
-
-            btn_login = types.KeyboardButton(
-                text='Авторизация'
-            )
-
-            btn_password = types.KeyboardButton(
-                text='Забыл пароль'
-            )
-
-            markup.add(
-                btn_register,
-                btn_login,
-                btn_password
-            )
+        if not session.is_authorized:
+            markup = AUTH_KEYBOARD
 
             bot.reply_to(
                 message,
@@ -595,93 +605,10 @@ def main_menu(message):
             )
 
         else:
-            markup = types.ReplyKeyboardMarkup(
-                resize_keyboard=True
-            )
-
-            btn_logout = types.KeyboardButton(
-                text='Выход'
-            )
-
-            btn_start_quiz = types.KeyboardButton(
-                text='Начать викторину'
-            )
-
-            btn_add_points1 = types.KeyboardButton(
-                text='Добавить очки за викторину'
-            )
-
-            btn_add_points2 = types.KeyboardButton(
-                text='Добавить очки за турнир'
-            )
-
-            btn_tournament_rating1 = types.KeyboardButton(
-                text='Общий рейтинг по баллам (викторина)'
-            )
-
-            btn_tournament_rating2 = types.KeyboardButton(
-                text='Общий рейтинг по баллам (турнир)'
-            )
-
-            btn_participant_rating1 = types.KeyboardButton(
-                text='Мое место в рейтинге по баллам (викторина)'
-            )
-
-            btn_participant_rating2 = types.KeyboardButton(
-                text='Мое место в рейтинге по баллам (турнир)'
-            )
-
-            btn_answers_rating = types.KeyboardButton(
-                text='Общий рейтинг по верным ответам (викторина)'
-            )
-
-            btn_tour_statistics1 = types.KeyboardButton(
-                text='Общий рейтинг тура по баллам (викторина)'
-            )
-
-            btn_tour_statistics2 = types.KeyboardButton(
-                text='Общий рейтинг турнира по баллам (турнир)'
-            )
-
-            btn_tours_statistics1 = types.KeyboardButton(
-                text='Общий рейтинг по всем турам (викторина)'
-            )
-
-            btn_tours_statistics2 = types.KeyboardButton(
-                text='Общий рейтинг по всем турнирам (турнир)'
+            markup = get_main_menu_keyboard(
+                session.role_id
             )
 
-            if custom_user.role_id == 2:
-                markup.add(
-                    btn_logout,
-                    btn_add_points1,
-                    btn_add_points2,
-                    btn_tournament_rating1,
-                    btn_tournament_rating2,
-                    btn_participant_rating1,
-                    btn_participant_rating2,
-                    btn_answers_rating,
-                    btn_tour_statistics1,
-                    btn_tour_statistics2,
-                    btn_tours_statistics1,
-                    btn_tours_statistics2
-                )
-
-            else:
-                markup.add(
-                    btn_logout,
-                    btn_start_quiz,
-                    btn_tournament_rating1,
-                    btn_tournament_rating2,
-                    btn_participant_rating1,
-                    btn_participant_rating2,
-                    btn_answers_rating,
-                    btn_tour_statistics1,
-                    btn_tour_statistics2,
-                    btn_tours_statistics1,
-                    btn_tours_statistics2
-                )
-
             bot.reply_to(
                 message,
                 "Главное меню",
@@ -689,48 +616,21 @@ def main_menu(message):
             )
 
 
-@bot.message_handler(func=lambda message: 'Выход' in message.text or message.text == '/logout')
+@router.route('Выход', '/logout')
 def logout(message):
     """
     Осуществляет выход пользователя из приложения, если он авторизован
     """
-    uid = message.from_user.id
-    auth_data = Authorization.objects.filter(
-        telegram_id=str(uid)
-    )
+    session = get_user_session(message)
 
-    if auth_data.exists():
-        username_id = auth_data.first().id
-
-        custom_user = CustomUser.objects.get(
-            username_id=username_id
-        )
-
-        if custom_user.is_authorized:
+    if session.authorization_id is not None:
+        if session.is_authorized:
+            custom_user = session.custom_user
             custom_user.is_authorized = False
             custom_user.save()
+            reset_user_session(message)
 
-            markup = types.ReplyKeyboardMarkup(
-                resize_keyboard=True
-            )
-
-            btn_register = types.KeyboardButton(
-                text='Регистрация'
-            )
-
-            btn_login = types.KeyboardButton(
-                text='Авторизация'
-            )
-
-            btn_password = types.KeyboardButton(
-                text='Забыл пароль'
-            )
-
-            markup.add(
-                btn_register,
-                btn_login,
-                btn_password
-            )
+            markup = AUTH_KEYBOARD
 
             bot.reply_to(
                 message,
@@ -739,27 +639,7 @@ def logout(message):
             )
 
         else:
-            markup = types.ReplyKeyboardMarkup(
-                resize_keyboard=True
-            )
-
-            btn_register = types.KeyboardButton(
-                text='Регистрация'
-            )
-
-            btn_login = types.KeyboardButton(
-                text='Авторизация'
-            )
-
-            btn_password = types.KeyboardButton(
-                text='Забыл пароль'
-            )
-
-            markup.add(
-                btn_register,
-                btn_login,
-                btn_password
-            )
+            markup = AUTH_KEYBOARD
 
             bot.reply_to(
                 message,
@@ -768,27 +648,7 @@ def logout(message):
             )
 
     else:
-        markup = types.ReplyKeyboardMarkup(
-            resize_keyboard=True
-        )
-
-        btn_register = types.KeyboardButton(
-            text='Регистрация'
-        )
-
-        btn_login = types.KeyboardButton(
-            text='Авторизация'
-        )
-
-        btn_password = types.KeyboardButton(
-            text='Забыл пароль'
-        )
-
-        markup.add(
-            btn_register,
-            btn_login,
-            btn_password
-        )
+        markup = AUTH_KEYBOARD
 
         bot.reply_to(
             message,
@@ -797,48 +657,19 @@ def logout(message):
         )
 
 
-@bot.message_handler(func=lambda message: 'Добавить очки за викторину' in message.text or message.text == '/add_quiz_points')
+@router.route('Добавить очки за викторину', '/add_quiz_points')
 def add_points_check_quiz(message):
     """
     Проверяет, является ли пользователь директором. Если директор, то запрашивает тип начисления баллов участнику
     """
-    is_AttributeError = False
     uid = message.from_user.id
 
-    user_auth_data = Authorization.objects.filter(
-        telegram_id=uid
-    )
-
-    try:
-        username_id = user_auth_data.first().id
-        custom_user = CustomUser.objects.get(
-            username_id=username_id
-        )
-
-    except AttributeError as e:
-        is_AttributeError = True
-
-    if user_auth_data.exists() and not is_AttributeError:
-        if custom_user.is_authorized:
-            user_auth_data = user_auth_data.first()
-
-            if user_auth_data.role_id == 2:
-                markup = types.ReplyKeyboardMarkup(
-                    resize_keyboard=True
-                )
-
-                btn_main_menu = types.KeyboardButton(
-                    text='Главное меню'
-                )
-
-                btn_logout = types.KeyboardButton(
-                    text='Выход'
-                )
+    session = get_user_session(message)
 
-                markup.add(
-                    btn_main_menu,
-                    btn_logout
-                )
+    if session.is_registered:
+        if session.is_authorized:
+            if session.role_id == 2:
+                markup = NAVIGATION_KEYBOARD
 
                 text = '\n'.join([
                     'Введдите тип начисления баллов в виде числа:',
@@ -867,27 +698,7 @@ def add_points_check_quiz(message):
                 )
 
         else:
-            markup = types.ReplyKeyboardMarkup(
-                resize_keyboard=True
-            )
-
-            btn_register = types.KeyboardButton(
-                text='Регистрация'
-            )
-
-            btn_login = types.KeyboardButton(
-                text='Авторизация'
-            )
-
-            btn_password = types.KeyboardButton(
-                text='Забыл пароль'
-            )
-
-            markup.add(
-                btn_register,
-                btn_login,
-                btn_password
-            )
+            markup = AUTH_KEYBOARD
 
             bot.reply_to(
                 message,
@@ -896,27 +707,7 @@ def add_points_check_quiz(message):
             )
 
     else:
-        markup = types.ReplyKeyboardMarkup(
-            resize_keyboard=True
-        )
-
-        btn_register = types.KeyboardButton(
-            text='Регистрация'
-        )
-
-        btn_login = types.KeyboardButton(
-            text='Авторизация'
-        )
-
-        btn_password = types.KeyboardButton(
-            text='Забыл пароль'
-        )
-
-        markup.add(
-            btn_register,
-            btn_login,
-            btn_password
-        )
+        markup = AUTH_KEYBOARD
 
         bot.reply_to(
             message,
@@ -1273,7 +1064,8 @@ def process_points_type_1_place_points_quiz(message, **kwargs):
                             )
 
                         else:
-                            participant_row.update(
+                            update_points_rows(
+                                participant_row,
                                 tournament_points=points,
                                 points_datetime=timezone.now(),
                             )
@@ -1417,7 +1209,8 @@ def process_points_type_2_pot_quiz(message, **kwargs):
                         )
 
                     else:
-                        participant_row.update(
+                        update_points_rows(
+                            participant_row,
                             points_received_or_transferred=points,
                             points_datetime=timezone.now(),
                         )
@@ -1640,7 +1433,8 @@ def process_points_type_3_result_quiz(message, **kwargs):
                 )
 
             else:
-                participant_row.update(
+                update_points_rows(
+                    participant_row,
                     bonuses=bonuses,
                     points_datetime=timezone.now(),
                 )
@@ -1732,7 +1526,7 @@ def process_points_type_4_amount_quiz(message, **kwargs):
             id=receiver_id
         )
 
-        if int(receiver.telegram_id) != int(sender.telegram_id):
+        if receiver.telegram_id != sender.telegram_id:
             if receiver:
                 if receiver.role_id == 3:
                     response = bot.reply_to(
@@ -1833,11 +1627,13 @@ def process_points_type_4_result_quiz(message, **kwargs):
 
                     else:
                         if not transaction_row12.exists():
-                            transaction_row11.update(
+                            update_points_rows(
+                                transaction_row11,
                                 receiver_telegram_id=receiver.telegram_id,
                             )
 
-                        transaction_row12.update(
+                        update_points_rows(
+                            transaction_row12,
                             points_transferred=amount,
                             transfer_datetime=timezone.now(),
                             points_datetime=timezone.now(),
@@ -1869,48 +1665,19 @@ def process_points_type_4_result_quiz(message, **kwargs):
             )
 
 
-@bot.message_handler(func=lambda message: 'Добавить очки за турнир' in message.text or message.text == '/add_tournam_points')
+@router.route('Добавить очки за турнир', '/add_tournam_points')
 def add_points_check(message):
     """
     Проверяет, является ли пользователь директором. Если директор, то запрашивает тип начисления баллов участнику
     """
-    is_AttributeError = False
     uid = message.from_user.id
 
-    user_auth_data = Authorization.objects.filter(
-        telegram_id=uid
-    )
-
-    try:
-        username_id = user_auth_data.first().id
-        custom_user = CustomUser.objects.get(
-            username_id=username_id
-        )
-
-    except AttributeError as e:
-        is_AttributeError = True
-
-    if user_auth_data.exists() and not is_AttributeError:
-        if custom_user.is_authorized:
-            user_auth_data = user_auth_data.first()
-
-            if user_auth_data.role_id == 2:
-                markup = types.ReplyKeyboardMarkup(
-                    resize_keyboard=True
-                )
-
-                btn_main_menu = types.KeyboardButton(
-                    text='Главное меню'
-                )
-
-                btn_logout = types.KeyboardButton(
-                    text='Выход'
-                )
+    session = get_user_session(message)
 
-                markup.add(
-                    btn_main_menu,
-                    btn_logout
-                )
+    if session.is_registered:
+        if session.is_authorized:
+            if session.role_id == 2:
+                markup = NAVIGATION_KEYBOARD
 
                 text = '\n'.join([
                     'Введдите тип начисления баллов в виде числа:',
@@ -1939,27 +1706,7 @@ def add_points_check(message):
                 )
 
         else:
-            markup = types.ReplyKeyboardMarkup(
-                resize_keyboard=True
-            )
-
-            btn_register = types.KeyboardButton(
-                text='Регистрация'
-            )
-
-            btn_login = types.KeyboardButton(
-                text='Авторизация'
-            )
-
-            btn_password = types.KeyboardButton(
-                text='Забыл пароль'
-            )
-
-            markup.add(
-                btn_register,
-                btn_login,
-                btn_password
-            )
+            markup = AUTH_KEYBOARD
 
             bot.reply_to(
                 message,
@@ -1968,27 +1715,7 @@ def add_points_check(message):
             )
 
     else:
-        markup = types.ReplyKeyboardMarkup(
-            resize_keyboard=True
-        )
-
-        btn_register = types.KeyboardButton(
-            text='Регистрация'
-        )
-
-        btn_login = types.KeyboardButton(
-            text='Авторизация'
-        )
-
-        btn_password = types.KeyboardButton(
-            text='Забыл пароль'
-        )
-
-        markup.add(
-            btn_register,
-            btn_login,
-            btn_password
-        )
+        markup = AUTH_KEYBOARD
 
         bot.reply_to(
             message,
@@ -2292,7 +2019,8 @@ def process_points_type_1_place_points(message, **kwargs):
                             )
 
                         else:
-                            participant_row.update(
+                            update_points_rows(
+                                participant_row,
                                 tournament_points=points,
                                 points_datetime=timezone.now(),
                             )
@@ -2432,7 +2160,8 @@ def process_points_type_2_pot(message, **kwargs):
                         )
 
                     else:
-                        participant_row.update(
+                        update_points_rows(
+                            participant_row,
                             points_received_or_transferred=points,
                             points_datetime=timezone.now(),
                         )
@@ -2648,7 +2377,8 @@ def process_points_type_3_result(message, **kwargs):
                 )
 
             else:
-                participant_row.update(
+                update_points_rows(
+                    participant_row,
                     bonuses=bonuses,
                     points_datetime=timezone.now(),
                 )
@@ -2737,7 +2467,7 @@ def process_points_type_4_amount(message, **kwargs):
             id=receiver_id
         )
 
-        if int(receiver.telegram_id) != int(sender.telegram_id):
+        if receiver.telegram_id != sender.telegram_id:
             if receiver:
                 if receiver.role_id == 3:
                     response = bot.reply_to(
@@ -2835,11 +2565,13 @@ def process_points_type_4_result(message, **kwargs):
 
                     else:
                         if not transaction_row12.exists():
-                            transaction_row11.update(
+                            update_points_rows(
+                                transaction_row11,
                                 receiver_telegram_id=receiver.telegram_id,
                             )
 
-                        transaction_row12.update(
+                        update_points_rows(
+                            transaction_row12,
                             points_transferred=amount,
                             transfer_datetime=timezone.now(),
                             points_datetime=timezone.now(),
@@ -2871,378 +2603,431 @@ def process_points_type_4_result(message, **kwargs):
             )
 
 
-def tournament_rating(message, tour_number=None, my_telegram_id=None, sort_param="total_points"):
+def collect_ledger_points(ledger_type, telegram_ids, scope_id=None):
     """
-    В целом отвечает за рейтинг участников в рамках викторины
-    tour_number - номер тура
-    my_telegram_id - Telegram ID участника
-    sort_param - параметр сортировки рейтинга (по умолчанию total_points, отражающее суммарное количество баллов)
-       * sort_param='total_points' - сортировка по суммарному количеству баллов
-       * sort_param='total_right_answers' - сортировка по количеству правильных ответов
+    Собирает баллы участников одним сгруппированным запросом к ScoreLedger
+    ledger_type - тип баллов (ScoreLedger.QUIZ для викторины, ScoreLedger.TOURNAMENT для турнира)
+    telegram_ids - Telegram ID участников
+    scope_id - номер тура или турнира (если не задан, то учитываются все туры или турниры)
 
-    Итоговое количество баллов рассчитывается относительно sender_telegram_id из таблицы PointsTransaction
-    ИТОГ = total_tournament_points + total_rot_pot + total_bonuses + total_transfer_profit
-        * total_tournament_points - общее количество баллов, начисленных участнику по занятому месту (тип 1)
-        * total_rot_pot - общее количество баллов, начисленных участнику по принципу "РОТ/ПОТ" (тип 2)
-        * total_bonuses - общее количество баллов, начисленных участнику в виде бонусов (тип 3)
-        * total_transfer_profit - общий выигрыш участника, полученный в результате перевода баллов (тип 4)
-            * total_transfer_profit = total_transfer_income - total_transfer_loss
-            * total_transfer_income - общее количество баллов, начисленных участнику в результате перевода баллов
-            * total_transfer_loss - общее количество баллов, списанных у участника в результате перевода баллов
+    Возвращает словарь {Telegram ID: баллы участника} в порядке telegram_ids
     """
-    telegram_ids = []
-    participants = Authorization.objects.filter(role_id=3)
-
-    if participants.exists():
-        if participants.count() >= 1:
-            for participant in participants:
-                telegram_ids.append(
-                    participant.telegram_id
-                )
+    ledger_data = ScoreLedger.objects.filter(
+        ledger_type=ledger_type,
+        participant_telegram_id__in=telegram_ids
+    )
 
-    if telegram_ids:
-        participants_dict = {}
-        senders = None
-        question_ids = []
-        tour_error = True
+    if scope_id:
+        ledger_data = ledger_data.filter(
+            scope_id=scope_id
+        )
+
+    ledger_totals = {
+        item.pop('participant_telegram_id'): item for item in ledger_data.values(
+            'participant_telegram_id'
+        ).annotate(
+            total_tournament_points=Sum('tournament_points'),
+            total_bonuses=Sum('bonuses'),
+            total_rot_pot=Sum('points_received_or_transferred'),
+            total_transfer_loss=Sum('transfer_loss'),
+            total_transfer_income=Sum('transfer_income'),
+            total_right_answers=Sum('right_answers'),
+            question_count=Sum('question_count'),
+            tour_count=Count('id', filter=Q(sent_count__gt=0)),
+            sent_count=Sum('sent_count'),
+            received_count=Sum('received_count'),
+        ).order_by().iterator(
+            chunk_size=EXPORT_CHUNK_SIZE
+        )
+    }
+
+    participants_dict = {}
+    for telegram_id in telegram_ids:
+        totals = ledger_totals.get(telegram_id)
+
+        if totals and totals['sent_count']:
+            participants_dict[telegram_id] = {
+                'total_tournament_points': totals['total_tournament_points'],
+                'total_bonuses': totals['total_bonuses'],
+                'total_rot_pot': totals['total_rot_pot'],
+                'total_transfer_loss': totals['total_transfer_loss'],
+                'total_right_answers': totals['total_right_answers'],
+                'question_count': totals['question_count'],
+                'tour_count': totals['tour_count'],
+            }
 
-        if tour_number:
-            if str(tour_number).isdigit():
-                if int(tour_number) > 0:
-                    questions = Question.objects.filter(
-                        tour_id=int(tour_number)
-                    )
+    if any(totals['received_count'] for totals in ledger_totals.values()):
+        for telegram_id in telegram_ids:
+            participants_dict.setdefault(telegram_id, {})['total_transfer_income'] = ledger_totals.get(
+                telegram_id, {}
+            ).get('total_transfer_income', 0)
 
-                    if questions.exists():
-                        tour_error = False
+    return participants_dict
 
-                        question_ids = [
-                            question.id for question in questions
-                        ]
 
-                        senders = PointsTransaction.objects.filter(
-                            sender_telegram_id__in=telegram_ids,
-                            question_id__in=question_ids
-                        )
+def build_leaderboard(ledger_type, scope_id=None, sort_param='total_points'):
+    """
+    Формирует строки рейтинга участников по накопленным баллам из ScoreLedger
+    ledger_type - тип рейтинга (ScoreLedger.QUIZ - викторина, ScoreLedger.TOURNAMENT - турнир)
+    scope_id - номер тура или турнира (если не задан, то рейтинг строится по всем турам или турнирам)
+    sort_param - параметр сортировки рейтинга
 
-                    else:
-                        bot.reply_to(
-                            message,
-                            "Номера тура не существует"
-                        )
+    Возвращает None, если участников нет
+    """
+    participants = {
+        participant.telegram_id: participant for participant in Authorization.objects.filter(
+            role_id=3
+        ).iterator(
+            chunk_size=EXPORT_CHUNK_SIZE
+        )
+    }
 
-                else:
-                    bot.reply_to(
-                        message,
-                        "Нужно именно положительное число"
-                    )
+    if not participants:
+        return None
 
-            else:
-                bot.reply_to(
-                    message,
-                    "Нужен именно номер турнира"
-                )
+    participants_dict = collect_ledger_points(
+        ledger_type=ledger_type,
+        telegram_ids=list(participants.keys()),
+        scope_id=scope_id
+    )
 
-        else:
-            senders = PointsTransaction.objects.filter(
-                sender_telegram_id__in=telegram_ids
-            )
+    for _, telegram_id_dict in participants_dict.items():
+        telegram_id_dict['total_transfer_profit'] = telegram_id_dict.get('total_transfer_income', 0) - \
+                                                    telegram_id_dict.get('total_transfer_loss', 0)
 
-        if senders:
-            if senders.count() >= 1:
-                for telegram_id in telegram_ids:
-                    if question_ids:
-                        sender_data = PointsTransaction.objects.filter(
-                            sender_telegram_id=telegram_id,
-                            question_id__in=question_ids
-                        )
+        telegram_id_dict['total_points'] = telegram_id_dict.get('total_tournament_points', 0) + \
+                                           telegram_id_dict.get('total_bonuses', 0) + \
+                                           telegram_id_dict.get('total_rot_pot', 0) + \
+                                           telegram_id_dict.get('total_transfer_profit', 0)
 
-                    else:
-                        sender_data = PointsTransaction.objects.filter(
-                            sender_telegram_id=telegram_id
-                        )
+    sorted_data = sorted(
+        participants_dict.items(), key=lambda x: x[1].get(sort_param, 0),
+        reverse=True
+    )
 
-                    total_tournament_points = 0
-                    total_bonuses = 0
-                    total_rot_pot = 0
-                    total_transfer_loss = 0
-                    total_right_answers = 0
-                    question_count = 0
-                    tours_list = []
-
-                    if sender_data.exists():
-                        for item in sender_data:
-                            total_tournament_points += item.tournament_points if item.tournament_points else 0
-                            total_bonuses += item.bonuses if item.bonuses else 0
-                            total_rot_pot += item.points_received_or_transferred if item.points_received_or_transferred else 0
-                            total_transfer_loss += item.points_transferred if item.points_transferred else 0
-                            total_right_answers += item.is_answered if item.is_answered else 0
-                            question_count += item.is_done if item.is_done else 0
-
-                            question_data = Question.objects.filter(
-                                id=item.question_id
-                            )
+    data_list = []
+    for rank, (telegram_id, rank_data) in enumerate(sorted_data, start=1):
+        participant = participants[telegram_id]
+
+        row = [
+            rank,
+            participant.full_name,
+            participant.telegram_nickname,
+            participant.telegram_id,
+            rank_data.get('total_points', 0),
+            rank_data.get('total_tournament_points', 0),
+            rank_data.get('total_rot_pot', 0),
+            rank_data.get('total_bonuses', 0),
+            rank_data.get('total_transfer_profit', 0),
+            rank_data.get('total_transfer_income', 0),
+            rank_data.get('total_transfer_loss', 0),
+        ]
 
-                            if question_data.exists():
-                                question_data = question_data.first()
+        if ledger_type == ScoreLedger.QUIZ:
+            row += [
+                rank_data.get('total_right_answers', 0),
+                rank_data.get('question_count', 0),
+            ]
 
-                                tours_list.append(
-                                    question_data.tour_id
-                                )
+        row.append(
+            rank_data.get('tour_count', 0)
+        )
+        data_list.append(row)
 
-                        participants_dict[telegram_id] = {
-                            'total_tournament_points': total_tournament_points,
-                            'total_bonuses': total_bonuses,
-                            'total_rot_pot': total_rot_pot,
-                            'total_transfer_loss': total_transfer_loss,
-                            'total_right_answers': total_right_answers,
-                            'question_count': question_count,
-                            'tour_count': len(set(tours_list)) if tours_list else 0,
-                        }
+    return data_list
+
+
+def render_leaderboard_export(result_list, my_telegram_id=None):
+    """
+    Формирует Excel-файл с рейтингом в памяти и возвращает его содержимое в байтах
+    result_list - строки рейтинга вместе со строкой заголовков
+    my_telegram_id - Telegram ID участника (если задан, то в файл попадает только его строка)
+    """
+    wb = Workbook()
+    ws = wb.active
 
-        if question_ids:
-            receivers = PointsTransaction.objects.filter(
-                receiver_telegram_id__in=telegram_ids,
-                question_id__in=question_ids
+    for idx, row in enumerate(result_list):
+        if not my_telegram_id:
+            ws.append(
+                row
             )
 
         else:
-            receivers = PointsTransaction.objects.filter(
-                receiver_telegram_id__in=telegram_ids
-            )
+            if my_telegram_id == row[3] or idx == 0:
+                ws.append(
+                    row
+                )
 
-        if receivers:
-            if receivers.count() >= 1:
-                for telegram_id in telegram_ids:
-                    if question_ids:
-                        receiver_data = PointsTransaction.objects.filter(
-                            receiver_telegram_id=telegram_id,
-                            question_id__in=question_ids
-                        )
+    buffer = BytesIO()
+    wb.save(buffer)
 
-                    else:
-                        receiver_data = PointsTransaction.objects.filter(
-                            receiver_telegram_id=telegram_id
-                        )
+    return buffer.getvalue()
 
-                    total_transfer_income = 0
 
-                    for item in receiver_data:
-                        total_transfer_income += item.points_transferred if item.points_transferred else 0
+def send_leaderboard_export(chat_id, export_key, result_list, my_telegram_id, caption):
+    """
+    Отправляет Excel-файл с рейтингом
+    Если файл этой версии рейтинга уже отправлялся, то он пересылается по file_id без повторной загрузки в Telegram
+    export_key - ключ Excel-файла (см. get_leaderboard_export_key)
+    """
+    file_id = get_export_file_id(export_key)
 
-                    if telegram_id in participants_dict:
-                        participants_dict[telegram_id]['total_transfer_income'] = total_transfer_income
+    if file_id:
+        try:
+            bot.send_document(
+                chat_id,
+                document=file_id,
+                caption=caption
+            )
+            return
 
-                    else:
-                        participants_dict[telegram_id] = {
-                            'total_transfer_income': total_transfer_income,
-                        }
+        except telebot.apihelper.ApiTelegramException as e:
+            if not is_invalid_file_id_error(e):
+                raise
 
-        if participants_dict:
-            for _, telegram_id_dict in participants_dict.items():
-                telegram_id_dict['total_transfer_profit'] = telegram_id_dict.get('total_transfer_income', 0) - \
-                                                            telegram_id_dict.get('total_transfer_loss', 0)
+            delete_export_file_id(export_key)
 
-                telegram_id_dict['total_points'] = telegram_id_dict.get('total_tournament_points', 0) + \
-                                                   telegram_id_dict.get('total_bonuses', 0) + \
-                                                   telegram_id_dict.get('total_rot_pot', 0) + \
-                                                   telegram_id_dict.get('total_transfer_profit', 0)
+    export = get_cached_leaderboard_export(
+        export_key=export_key,
+        render=lambda: render_leaderboard_export(
+            result_list=result_list,
+            my_telegram_id=my_telegram_id
+        )
+    )
 
-            sorted_data = dict(
-                sorted(
-                    participants_dict.items(), key=lambda x: x[1][sort_param],
-                    reverse=True
-                )
-            )
+    sent_message = bot.send_document(
+        chat_id,
+        document=export,
+        visible_file_name=EXPORT_FILE_NAME,
+        caption=caption
+    )
 
-            ranked_data = {
-                key: {**value, 'rank': i + 1} for i, (key, value) in enumerate(sorted_data.items())
-            }
+    if sent_message and sent_message.document:
+        set_export_file_id(
+            export_key,
+            sent_message.document.file_id
+        )
 
-            data_list = []
-            if ranked_data:
-                for telegram_id, rank_data in ranked_data.items():
-                    participant = participants.get(
-                        telegram_id=telegram_id
-                    )
 
-                    data_list.append([
-                        rank_data.get('rank', 0),
-                        participant.full_name,
-                        participant.telegram_nickname,
-                        participant.telegram_id,
-                        rank_data.get('total_points', 0),
-                        rank_data.get('total_tournament_points', 0),
-                        rank_data.get('total_rot_pot', 0),
-                        rank_data.get('total_bonuses', 0),
-                        rank_data.get('total_transfer_profit', 0),
-                        rank_data.get('total_transfer_income', 0),
-                        rank_data.get('total_transfer_loss', 0),
-                        rank_data.get('total_right_answers', 0),
-                        rank_data.get('question_count', 0),
-                        rank_data.get('tour_count', 0),
-                    ])
-
-            if data_list:
-                result_list = [[
-                    'Место',
-                    'ФИО',
-                    'Никнейм в Telegram',
-                    'Telegram ID',
-                    'Общее количество баллов',
-                    'Баллы, начисленные по типу 1 (рейтинг)',
-                    'Баллы, начисленные по типу 2 (РОТ/ПОТ)',
-                    'Баллы, начисленные по типу 3 (бонусы)',
-                    'Баллы, начисленные по типу 4 (прибыль от трансфера)',
-                    'Суммарный доход от трансфера',
-                    'Суммарный убыток от трансфера',
-                    'Количество правильных ответов',
-                    'Количество вопросов',
-                    'Количество туров',
-                ]] + data_list
-
-                wb = Workbook()
-                ws = wb.active
-
-                for idx, row in enumerate(result_list):
-                    if not my_telegram_id:
-                        ws.append(
-                            row
-                        )
+def tournament_rating(message, tour_number=None, my_telegram_id=None, sort_param="total_points"):
+    """
+    В целом отвечает за рейтинг участников в рамках викторины
+    tour_number - номер тура
+    my_telegram_id - Telegram ID участника
+    sort_param - параметр сортировки рейтинга (по умолчанию total_points, отражающее суммарное количество баллов)
+       * sort_param='total_points' - сортировка по суммарному количеству баллов
+       * sort_param='total_right_answers' - сортировка по количеству правильных ответов
 
-                    else:
-                        if my_telegram_id == row[3] or idx == 0:
-                            ws.append(
-                                row
-                            )
+    Итоговое количество баллов рассчитывается относительно sender_telegram_id из таблицы PointsTransaction
+    ИТОГ = total_tournament_points + total_rot_pot + total_bonuses + total_transfer_profit
+        * total_tournament_points - общее количество баллов, начисленных участнику по занятому месту (тип 1)
+        * total_rot_pot - общее количество баллов, начисленных участнику по принципу "РОТ/ПОТ" (тип 2)
+        * total_bonuses - общее количество баллов, начисленных участнику в виде бонусов (тип 3)
+        * total_transfer_profit - общий выигрыш участника, полученный в результате перевода баллов (тип 4)
+            * total_transfer_profit = total_transfer_income - total_transfer_loss
+            * total_transfer_income - общее количество баллов, начисленных участнику в результате перевода баллов
+            * total_transfer_loss - общее количество баллов, списанных у участника в результате перевода баллов
+    """
+    scope_id = None
+    tour_error = False
 
-                if my_telegram_id or question_ids:
-                    if not len(data_list) >= 1:
-                        bot.reply_to(
-                            message,
-                            "Нет результатов"
-                        )
+    if tour_number:
+        tour_error = True
 
-                wb.save("results.xlsx")
+        if str(tour_number).isdigit():
+            if int(tour_number) > 0:
+                if Question.objects.filter(
+                    tour_id=int(tour_number)
+                ).exists():
+                    scope_id = int(tour_number)
+                    tour_error = False
 
-                if not tour_number:
-                    if not my_telegram_id:
-                        bot.send_document(
-                            message.chat.id,
-                            document=open('results.xlsx', 'rb'),
-                            caption='Рейтинг участников турнира'
-                        )
+                else:
+                    bot.reply_to(
+                        message,
+                        "Номера тура не существует"
+                    )
 
-                        message_text = 'Список участников в рейтинге:\n\n'
-                        for participant in data_list:
-
-                            text_info = '\n'.join([
-                                f'Место: {participant[0]}',
-                                f'ФИО: {participant[1]}',
-                                f'Никнейм в Telegram: {participant[2]}',
-                                f'Telegram ID: {participant[3]}',
-                                f'Общее количество баллов: {participant[4]}',
-                                f'Баллы, начисленные по рейтингу: {participant[5]}',
-                                f'Баллы, начисленные по РОТ/ПОТ: {participant[6]}',
-                                f'Баллы, начисленные по бонусам: {participant[7]}',
-                                f'Прибыль от трансфера баллов: {participant[8]}',
-                                f'Суммарный доход от трансфера: {participant[9]}',
-                                f'Суммарный убыток от трансфера: {participant[10]}',
-                                f'Количество правильных ответов: {participant[11]}',
-                                f'Количество вопросов: {participant[12]}',
-                                f'Количество туров: {participant[13]}\n\n',
-                            ])
-
-                            message_text += text_info
+            else:
+                bot.reply_to(
+                    message,
+                    "Нужно именно положительное число"
+                )
 
-                        bot.reply_to(
-                            message,
-                            message_text
-                        )
+        else:
+            bot.reply_to(
+                message,
+                "Нужен именно номер турнира"
+            )
 
-                    else:
-                        try:
-                            idx = list(ranked_data.keys()).index(my_telegram_id)
-                            participant_data = result_list[idx + 1]
-                            full_name = participant_data[1]
-                            telegram_id = participant_data[3]
-
-                            bot.send_document(
-                                message.chat.id,
-                                document=open('results.xlsx', 'rb'),
-                                caption=f'Рейтинг участника ({full_name}, {telegram_id})'
-                            )
+    if not tour_error:
+        data_list = get_cached_leaderboard(
+            board_type=ScoreLedger.QUIZ,
+            scope_id=scope_id,
+            sort_param=sort_param,
+            build=lambda: build_leaderboard(
+                ledger_type=ScoreLedger.QUIZ,
+                scope_id=scope_id,
+                sort_param=sort_param
+            )
+        )
 
-                            message_text = 'Положение участника в рейтинге:\n\n'
-
-                            text_info = '\n'.join([
-                                f'Место: {participant_data[0]}',
-                                f'ФИО: {participant_data[1]}',
-                                f'Никнейм в Telegram: {participant_data[2]}',
-                                f'Telegram ID: {participant_data[3]}',
-                                f'Общее количество баллов: {participant_data[4]}',
-                                f'Баллы, начисленные по рейтингу: {participant_data[5]}',
-                                f'Баллы, начисленные по РОТ/ПОТ: {participant_data[6]}',
-                                f'Баллы, начисленные по бонусам: {participant_data[7]}',
-                                f'Прибыль от трансфера баллов: {participant_data[8]}',
-                                f'Суммарный доход от трансфера: {participant_data[9]}',
-                                f'Суммарный убыток от трансфера: {participant_data[10]}',
-                                f'Количество правильных ответов: {participant_data[11]}',
-                                f'Количество вопросов: {participant_data[12]}',
-                                f'Количество туров: {participant_data[13]}\n\n',
-                            ])
+        if data_list is None:
+            bot.reply_to(
+                message,
+                "Нет участников в турнире"
+            )
+
+        elif data_list:
+            result_list = [[
+                'Место',
+                'ФИО',
+                'Никнейм в Telegram',
+                'Telegram ID',
+                'Общее количество баллов',
+                'Баллы, начисленные по типу 1 (рейтинг)',
+                'Баллы, начисленные по типу 2 (РОТ/ПОТ)',
+                'Баллы, начисленные по типу 3 (бонусы)',
+                'Баллы, начисленные по типу 4 (прибыль от трансфера)',
+                'Суммарный доход от трансфера',
+                'Суммарный убыток от трансфера',
+                'Количество правильных ответов',
+                'Количество вопросов',
+                'Количество туров',
+            ]] + data_list
+
+            if my_telegram_id or scope_id:
+                if not len(data_list) >= 1:
+                    bot.reply_to(
+                        message,
+                        "Нет результатов"
+                    )
 
-                            bot.reply_to(
-                                message,
-                                message_text + text_info
-                            )
+            export_key = get_leaderboard_export_key(
+                board_type=ScoreLedger.QUIZ,
+                scope_id=scope_id,
+                sort_param=sort_param,
+                my_telegram_id=my_telegram_id
+            )
+
+            if not tour_number:
+                if not my_telegram_id:
+                    send_leaderboard_export(
+                        message.chat.id,
+                        export_key=export_key,
+                        result_list=result_list,
+                        my_telegram_id=my_telegram_id,
+                        caption='Рейтинг участников турнира'
+                    )
 
-                        except ValueError:
-                            bot.reply_to(
-                                message,
-                                'Не удалось найти ваш результат в рейтинге'
-                            )
+                    message_text = 'Список участников в рейтинге:\n\n'
+                    for participant in data_list:
+
+                        text_info = '\n'.join([
+                            f'Место: {participant[0]}',
+                            f'ФИО: {participant[1]}',
+                            f'Никнейм в Telegram: {participant[2]}',
+                            f'Telegram ID: {participant[3]}',
+                            f'Общее количество баллов: {participant[4]}',
+                            f'Баллы, начисленные по рейтингу: {participant[5]}',
+                            f'Баллы, начисленные по РОТ/ПОТ: {participant[6]}',
+                            f'Баллы, начисленные по бонусам: {participant[7]}',
+                            f'Прибыль от трансфера баллов: {participant[8]}',
+                            f'Суммарный доход от трансфера: {participant[9]}',
+                            f'Суммарный убыток от трансфера: {participant[10]}',
+                            f'Количество правильных ответов: {participant[11]}',
+                            f'Количество вопросов: {participant[12]}',
+                            f'Количество туров: {participant[13]}\n\n',
+                        ])
+
+                        message_text += text_info
+
+                    bot.reply_to(
+                        message,
+                        message_text
+                    )
 
                 else:
-                    if not tour_error:
-                        bot.send_document(
+                    try:
+                        idx = [row[3] for row in data_list].index(my_telegram_id)
+                        participant_data = result_list[idx + 1]
+                        full_name = participant_data[1]
+                        telegram_id = participant_data[3]
+
+                        send_leaderboard_export(
                             message.chat.id,
-                            document=open('results.xlsx', 'rb'),
-                            caption='Рейтинг участников тура №' + str(tour_number)
+                            export_key=export_key,
+                            result_list=result_list,
+                            my_telegram_id=my_telegram_id,
+                            caption=f'Рейтинг участника ({full_name}, {telegram_id})'
                         )
 
-                        message_text = f'Список участников в рейтинге по туру № {tour_number}:\n\n'
-                        for participant in data_list:
-
-                            text_info = '\n'.join([
-                                f'Место: {participant[0]}',
-                                f'ФИО: {participant[1]}',
-                                f'Никнейм в Telegram: {participant[2]}',
-                                f'Telegram ID: {participant[3]}',
-                                f'Общее количество баллов: {participant[4]}',
-                                f'Баллы, начисленные по рейтингу: {participant[5]}',
-                                f'Баллы, начисленные по РОТ/ПОТ: {participant[6]}',
-                                f'Баллы, начисленные по бонусам: {participant[7]}',
-                                f'Прибыль от трансфера баллов: {participant[8]}',
-                                f'Суммарный доход от трансфера: {participant[9]}',
-                                f'Суммарный убыток от трансфера: {participant[10]}',
-                                f'Количество правильных ответов: {participant[11]}',
-                                f'Количество вопросов: {participant[12]}',
-                                f'Количество туров: {participant[13]}\n\n',
-                            ])
-
-                            message_text += text_info
+                        message_text = 'Положение участника в рейтинге:\n\n'
+
+                        text_info = '\n'.join([
+                            f'Место: {participant_data[0]}',
+                            f'ФИО: {participant_data[1]}',
+                            f'Никнейм в Telegram: {participant_data[2]}',
+                            f'Telegram ID: {participant_data[3]}',
+                            f'Общее количество баллов: {participant_data[4]}',
+                            f'Баллы, начисленные по рейтингу: {participant_data[5]}',
+                            f'Баллы, начисленные по РОТ/ПОТ: {participant_data[6]}',
+                            f'Баллы, начисленные по бонусам: {participant_data[7]}',
+                            f'Прибыль от трансфера баллов: {participant_data[8]}',
+                            f'Суммарный доход от трансфера: {participant_data[9]}',
+                            f'Суммарный убыток от трансфера: {participant_data[10]}',
+                            f'Количество правильных ответов: {participant_data[11]}',
+                            f'Количество вопросов: {participant_data[12]}',
+                            f'Количество туров: {participant_data[13]}\n\n',
+                        ])
 
                         bot.reply_to(
                             message,
-                            message_text
+                            message_text + text_info
                         )
 
-    else:
-        bot.reply_to(
-            message,
-            "Нет участников в турнире"
-        )
+                    except ValueError:
+                        bot.reply_to(
+                            message,
+                            'Не удалось найти ваш результат в рейтинге'
+                        )
+
+            else:
+                if not tour_error:
+                    send_leaderboard_export(
+                        message.chat.id,
+                        export_key=export_key,
+                        result_list=result_list,
+                        my_telegram_id=my_telegram_id,
+                        caption='Рейтинг участников тура №' + str(tour_number)
+                    )
+
+                    message_text = f'Список участников в рейтинге по туру № {tour_number}:\n\n'
+                    for participant in data_list:
+
+                        text_info = '\n'.join([
+                            f'Место: {participant[0]}',
+                            f'ФИО: {participant[1]}',
+                            f'Никнейм в Telegram: {participant[2]}',
+                            f'Telegram ID: {participant[3]}',
+                            f'Общее количество баллов: {participant[4]}',
+                            f'Баллы, начисленные по рейтингу: {participant[5]}',
+                            f'Баллы, начисленные по РОТ/ПОТ: {participant[6]}',
+                            f'Баллы, начисленные по бонусам: {participant[7]}',
+                            f'Прибыль от трансфера баллов: {participant[8]}',
+                            f'Суммарный доход от трансфера: {participant[9]}',
+                            f'Суммарный убыток от трансфера: {participant[10]}',
+                            f'Количество правильных ответов: {participant[11]}',
+                            f'Количество вопросов: {participant[12]}',
+                            f'Количество туров: {participant[13]}\n\n',
+                        ])
+
+                        message_text += text_info
+
+                    bot.reply_to(
+                        message,
+                        message_text
+                    )
 
 
 def points_tournament_rating(message, tour_number=None, my_telegram_id=None):
@@ -3261,387 +3046,211 @@ def points_tournament_rating(message, tour_number=None, my_telegram_id=None):
             * total_transfer_income - общее количество баллов, начисленных участнику в результате перевода баллов
             * total_transfer_loss - общее количество баллов, списанных у участника в результате перевода баллов
     """
-    participants = Authorization.objects.filter(
-        role_id=3
-    )
-
-    telegram_ids = []
-    if participants.exists():
-        if participants.count() >= 1:
-            for participant in participants:
-                telegram_ids.append(
-                    participant.telegram_id
-                )
+    scope_id = None
+    tour_error = False
 
-    if telegram_ids:
-        participants_dict = {}
-        senders = None
-        tournament_ids = []
+    if tour_number:
         tour_error = True
 
-        if tour_number:
-            if str(tour_number).isdigit():
-                if int(tour_number) > 0:
-
-                    tournament = Tournament.objects.filter(
-                        id=int(tour_number)
-                    )
-
-                    if tournament.exists():
-                        tour_error = False
-
-                        tournament_ids = [
-                            tournament_obj.id for tournament_obj in tournament
-                        ]
-
-                        senders = PointsTournament.objects.filter(
-                            sender_telegram_id__in=telegram_ids,
-                            tournament_id__in=tournament_ids
-                        )
-
-                    else:
-                        bot.reply_to(
-                            message,
-                            "Номера турнира не существует"
-                        )
+        if str(tour_number).isdigit():
+            if int(tour_number) > 0:
+                if Tournament.objects.filter(
+                    id=int(tour_number)
+                ).exists():
+                    scope_id = int(tour_number)
+                    tour_error = False
 
                 else:
                     bot.reply_to(
                         message,
-                        "Нужно именно положительное число"
+                        "Номера турнира не существует"
                     )
 
             else:
                 bot.reply_to(
                     message,
-                    "Нужен именно номер турнира"
+                    "Нужно именно положительное число"
                 )
 
         else:
-            senders = PointsTournament.objects.filter(
-                sender_telegram_id__in=telegram_ids
-            )
-
-        if senders:
-            if senders.count() >= 1:
-                for telegram_id in telegram_ids:
-                    if tournament_ids:
-                        sender_data = PointsTournament.objects.filter(
-                            sender_telegram_id=telegram_id,
-                            tournament_id__in=tournament_ids
-                        )
-
-                    else:
-                        sender_data = PointsTournament.objects.filter(
-                            sender_telegram_id=telegram_id
-                        )
-
-                    total_tournament_points = 0
-                    total_bonuses = 0
-                    total_rot_pot = 0
-                    total_transfer_loss = 0
-                    tours_list = []
-
-                    if sender_data.exists():
-                        for item in sender_data:
-                            total_tournament_points += item.tournament_points if item.tournament_points else 0
-                            total_bonuses += item.bonuses if item.bonuses else 0
-                            total_rot_pot += item.points_received_or_transferred if item.points_received_or_transferred else 0
-                            total_transfer_loss += item.points_transferred if item.points_transferred else 0
-
-                            tournament_data = Tournament.objects.filter(
-                                id=item.tournament_id
-                            )
-
-                            if tournament_data.exists():
-                                tournament_data = tournament_data.first()
-
-                                tours_list.append(
-                                    tournament_data.id
-                                )
-
-                        participants_dict[telegram_id] = {
-                            'total_tournament_points': total_tournament_points,
-                            'total_bonuses': total_bonuses,
-                            'total_rot_pot': total_rot_pot,
-                            'total_transfer_loss': total_transfer_loss,
-                            'tour_count': len(set(tours_list)) if tours_list else 0,
-                        }
-
-        if tournament_ids:
-            receivers = PointsTournament.objects.filter(
-                receiver_telegram_id__in=telegram_ids,
-                tournament_id__in=tournament_ids
-            )
-
-        else:
-            receivers = PointsTournament.objects.filter(
-                receiver_telegram_id__in=telegram_ids
+            bot.reply_to(
+                message,
+                "Нужен именно номер турнира"
             )
 
-        if receivers:
-            if receivers.count() >= 1:
-                for telegram_id in telegram_ids:
-
-                    if tournament_ids:
-                        receiver_data = PointsTournament.objects.filter(
-                            receiver_telegram_id=telegram_id,
-                            tournament_id__in=tournament_ids
-                        )
-
-                    else:
-                        receiver_data = PointsTournament.objects.filter(
-                            receiver_telegram_id=telegram_id
-                        )
-
-                    total_transfer_income = 0
-
-                    for item in receiver_data:
-                        total_transfer_income += item.points_transferred if item.points_transferred else 0
-
-                    if telegram_id in participants_dict:
-                        participants_dict[telegram_id]['total_transfer_income'] = total_transfer_income
-
-                    else:
-                        participants_dict[telegram_id] = {
-                            'total_transfer_income': total_transfer_income,
-                        }
-
-        if participants_dict:
-            for _, telegram_id_dict in participants_dict.items():
-                telegram_id_dict['total_transfer_profit'] = telegram_id_dict.get('total_transfer_income', 0) - \
-                                                            telegram_id_dict.get('total_transfer_loss', 0)
-
-                telegram_id_dict['total_points'] = telegram_id_dict.get('total_tournament_points', 0) + \
-                                                   telegram_id_dict.get('total_bonuses', 0) + \
-                                                   telegram_id_dict.get('total_rot_pot', 0) + \
-                                                   telegram_id_dict.get('total_transfer_profit', 0)
-
-            sorted_data = dict(
-                sorted(
-                    participants_dict.items(), key=lambda x: x[1]['total_points'],
-                    reverse=True
-                )
+    if not tour_error:
+        data_list = get_cached_leaderboard(
+            board_type=ScoreLedger.TOURNAMENT,
+            scope_id=scope_id,
+            sort_param='total_points',
+            build=lambda: build_leaderboard(
+                ledger_type=ScoreLedger.TOURNAMENT,
+                scope_id=scope_id,
+                sort_param='total_points'
             )
+        )
 
-            ranked_data = {
-                key: {**value, 'rank': i + 1} for i, (key, value) in enumerate(sorted_data.items())
-            }
-
-            data_list = []
-            if ranked_data:
-                for telegram_id, rank_data in ranked_data.items():
-                    participant = participants.get(
-                        telegram_id=telegram_id
+        if data_list is None:
+            bot.reply_to(
+                message,
+                "Нет участников в турнире"
+            )
+
+        elif data_list:
+            result_list = [[
+                'Место',
+                'ФИО',
+                'Никнейм в Telegram',
+                'Telegram ID',
+                'Общее количество баллов',
+                'Баллы, начисленные по типу 1 (рейтинг)',
+                'Баллы, начисленные по типу 2 (РОТ/ПОТ)',
+                'Баллы, начисленные по типу 3 (бонусы)',
+                'Баллы, начисленные по типу 4 (прибыль от трансфера)',
+                'Суммарный доход от трансфера',
+                'Суммарный убыток от трансфера',
+                'Количество турниров',
+            ]] + data_list
+
+            if my_telegram_id or scope_id:
+                if not len(data_list) >= 1:
+                    bot.reply_to(
+                        message,
+                        "Нет результатов"
                     )
 
-                    data_list.append([
-                        rank_data.get('rank', 0),
-                        participant.full_name,
-                        participant.telegram_nickname,
-                        participant.telegram_id,
-                        rank_data.get('total_points', 0),
-                        rank_data.get('total_tournament_points', 0),
-                        rank_data.get('total_rot_pot', 0),
-                        rank_data.get('total_bonuses', 0),
-                        rank_data.get('total_transfer_profit', 0),
-                        rank_data.get('total_transfer_income', 0),
-                        rank_data.get('total_transfer_loss', 0),
-                        rank_data.get('tour_count', 0),
-                    ])
-
-            if data_list:
-                result_list = [[
-                    'Место',
-                    'ФИО',
-                    'Никнейм в Telegram',
-                    'Telegram ID',
-                    'Общее количество баллов',
-                    'Баллы, начисленные по типу 1 (рейтинг)',
-                    'Баллы, начисленные по типу 2 (РОТ/ПОТ)',
-                    'Баллы, начисленные по типу 3 (бонусы)',
-                    'Баллы, начисленные по типу 4 (прибыль от трансфера)',
-                    'Суммарный доход от трансфера',
-                    'Суммарный убыток от трансфера',
-                    'Количество турниров',
-                ]] + data_list
-
-                wb = Workbook()
-                ws = wb.active
-
-                for idx, row in enumerate(result_list):
-                    if not my_telegram_id:
-                        ws.append(
-                            row
-                        )
+            export_key = get_leaderboard_export_key(
+                board_type=ScoreLedger.TOURNAMENT,
+                scope_id=scope_id,
+                sort_param='total_points',
+                my_telegram_id=my_telegram_id
+            )
+
+            if not tour_number:
+                if not my_telegram_id:
+                    send_leaderboard_export(
+                        message.chat.id,
+                        export_key=export_key,
+                        result_list=result_list,
+                        my_telegram_id=my_telegram_id,
+                        caption='Рейтинг участников турнира'
+                    )
 
-                    else:
-                        if my_telegram_id == row[3] or idx == 0:
-                            ws.append(
-                                row
-                            )
+                    message_text = 'Список участников в рейтинге:\n\n'
+                    for participant in data_list:
+
+                        text_info = '\n'.join([
+                            f'Место: {participant[0]}',
+                            f'ФИО: {participant[1]}',
+                            f'Никнейм в Telegram: {participant[2]}',
+                            f'Telegram ID: {participant[3]}',
+                            f'Общее количество баллов: {participant[4]}',
+                            f'Баллы, начисленные по рейтингу: {participant[5]}',
+                            f'Баллы, начисленные по РОТ/ПОТ: {participant[6]}',
+                            f'Баллы, начисленные по бонусам: {participant[7]}',
+                            f'Прибыль от трансфера баллов: {participant[8]}',
+                            f'Суммарный доход от трансфера: {participant[9]}',
+                            f'Суммарный убыток от трансфера: {participant[10]}',
+                            f'Количество турниров: {participant[11]}\n\n',
+                        ])
+
+                        message_text += text_info
 
-                if my_telegram_id or tournament_ids:
-                    if not len(data_list) >= 1:
-                        bot.reply_to(
-                            message,
-                            "Нет результатов"
-                        )
+                    bot.reply_to(
+                        message,
+                        message_text
+                    )
 
-                wb.save("results.xlsx")
+                else:
+                    try:
+                        idx = [row[3] for row in data_list].index(my_telegram_id)
+                        participant_data = result_list[idx + 1]
+                        full_name = participant_data[1]
+                        telegram_id = participant_data[3]
 
-                if not tour_number:
-                    if not my_telegram_id:
-                        bot.send_document(
+                        send_leaderboard_export(
                             message.chat.id,
-                            document=open('results.xlsx', 'rb'),
-                            caption='Рейтинг участников турнира'
+                            export_key=export_key,
+                            result_list=result_list,
+                            my_telegram_id=my_telegram_id,
+                            caption=f'Рейтинг участника ({full_name}, {telegram_id})'
                         )
 
-                        message_text = 'Список участников в рейтинге:\n\n'
-                        for participant in data_list:
-
-                            text_info = '\n'.join([
-                                f'Место: {participant[0]}',
-                                f'ФИО: {participant[1]}',
-                                f'Никнейм в Telegram: {participant[2]}',
-                                f'Telegram ID: {participant[3]}',
-                                f'Общее количество баллов: {participant[4]}',
-                                f'Баллы, начисленные по рейтингу: {participant[5]}',
-                                f'Баллы, начисленные по РОТ/ПОТ: {participant[6]}',
-                                f'Баллы, начисленные по бонусам: {participant[7]}',
-                                f'Прибыль от трансфера баллов: {participant[8]}',
-                                f'Суммарный доход от трансфера: {participant[9]}',
-                                f'Суммарный убыток от трансфера: {participant[10]}',
-                                f'Количество турниров: {participant[11]}\n\n',
-                            ])
-
-                            message_text += text_info
+                        message_text = 'Положение участника в рейтинге:\n\n'
+
+                        text_info = '\n'.join([
+                            f'Место: {participant_data[0]}',
+                            f'ФИО: {participant_data[1]}',
+                            f'Никнейм в Telegram: {participant_data[2]}',
+                            f'Telegram ID: {participant_data[3]}',
+                            f'Общее количество баллов: {participant_data[4]}',
+                            f'Баллы, начисленные по рейтингу: {participant_data[5]}',
+                            f'Баллы, начисленные по РОТ/ПОТ: {participant_data[6]}',
+                            f'Баллы, начисленные по бонусам: {participant_data[7]}',
+                            f'Прибыль от трансфера баллов: {participant_data[8]}',
+                            f'Суммарный доход от трансфера: {participant_data[9]}',
+                            f'Суммарный убыток от трансфера: {participant_data[10]}',
+                            f'Количество турниров: {participant_data[11]}\n\n',
+                        ])
 
                         bot.reply_to(
                             message,
-                            message_text
-                        )
-
-                    else:
-                        try:
-                            idx = list(ranked_data.keys()).index(my_telegram_id)
-                            participant_data = result_list[idx + 1]
-                            full_name = participant_data[1]
-                            telegram_id = participant_data[3]
-
-                            bot.send_document(
-                                message.chat.id,
-                                document=open('results.xlsx', 'rb'),
-                                caption=f'Рейтинг участника ({full_name}, {telegram_id})'
-                            )
-
-                            message_text = 'Положение участника в рейтинге:\n\n'
-
-                            text_info = '\n'.join([
-                                f'Место: {participant_data[0]}',
-                                f'ФИО: {participant_data[1]}',
-                                f'Никнейм в Telegram: {participant_data[2]}',
-                                f'Telegram ID: {participant_data[3]}',
-                                f'Общее количество баллов: {participant_data[4]}',
-                                f'Баллы, начисленные по рейтингу: {participant_data[5]}',
-                                f'Баллы, начисленные по РОТ/ПОТ: {participant_data[6]}',
-                                f'Баллы, начисленные по бонусам: {participant_data[7]}',
-                                f'Прибыль от трансфера баллов: {participant_data[8]}',
-                                f'Суммарный доход от трансфера: {participant_data[9]}',
-                                f'Суммарный убыток от трансфера: {participant_data[10]}',
-                                f'Количество турниров: {participant_data[11]}\n\n',
-                            ])
-
-                            bot.reply_to(
-                                message,
-                                message_text + text_info
-                            )
-
-                        except ValueError:
-                            bot.reply_to(
-                                message,
-                                'Не удалось найти ваш результат в рейтинге'
-                            )
-
-                else:
-                    if not tour_error:
-                        bot.send_document(
-                            message.chat.id,
-                            document=open('results.xlsx', 'rb'),
-                            caption='Рейтинг участников турнира №' + str(tour_number)
+                            message_text + text_info
                         )
 
-                        message_text = f'Список участников в рейтинге по турниру № {tour_number}:\n\n'
-
-                        for participant in data_list:
-                            text_info = '\n'.join([
-                                f'Место: {participant[0]}',
-                                f'ФИО: {participant[1]}',
-                                f'Никнейм в Telegram: {participant[2]}',
-                                f'Telegram ID: {participant[3]}',
-                                f'Общее количество баллов: {participant[4]}',
-                                f'Баллы, начисленные по рейтингу: {participant[5]}',
-                                f'Баллы, начисленные по РОТ/ПОТ: {participant[6]}',
-                                f'Баллы, начисленные по бонусам: {participant[7]}',
-                                f'Прибыль от трансфера баллов: {participant[8]}',
-                                f'Суммарный доход от трансфера: {participant[9]}',
-                                f'Суммарный убыток от трансфера: {participant[10]}',
-                                f'Количество турниров: {participant[11]}\n\n',
-                            ])
-
-                            message_text += text_info
-
+                    except ValueError:
                         bot.reply_to(
                             message,
-                            message_text
+                            'Не удалось найти ваш результат в рейтинге'
                         )
 
-    else:
-        bot.reply_to(
-            message,
-            "Нет участников в турнире"
-        )
+            else:
+                if not tour_error:
+                    send_leaderboard_export(
+                        message.chat.id,
+                        export_key=export_key,
+                        result_list=result_list,
+                        my_telegram_id=my_telegram_id,
+                        caption='Рейтинг участников турнира №' + str(tour_number)
+                    )
 
+                    message_text = f'Список участников в рейтинге по турниру № {tour_number}:\n\n'
+
+                    for participant in data_list:
+                        text_info = '\n'.join([
+                            f'Место: {participant[0]}',
+                            f'ФИО: {participant[1]}',
+                            f'Никнейм в Telegram: {participant[2]}',
+                            f'Telegram ID: {participant[3]}',
+                            f'Общее количество баллов: {participant[4]}',
+                            f'Баллы, начисленные по рейтингу: {participant[5]}',
+                            f'Баллы, начисленные по РОТ/ПОТ: {participant[6]}',
+                            f'Баллы, начисленные по бонусам: {participant[7]}',
+                            f'Прибыль от трансфера баллов: {participant[8]}',
+                            f'Суммарный доход от трансфера: {participant[9]}',
+                            f'Суммарный убыток от трансфера: {participant[10]}',
+                            f'Количество турниров: {participant[11]}\n\n',
+                        ])
+
+                        message_text += text_info
 
-@bot.message_handler(func=lambda message: 'Общий рейтинг по баллам (викторина)' in message.text or message.text == '/quiz_rating')
+                    bot.reply_to(
+                        message,
+                        message_text
+                    )
+
+
+@router.route('Общий рейтинг по баллам (викторина)', '/quiz_rating')
 def tournament_rating_realization(message):
     """"
     Выводит общий рейтинг турнира в виде Excel-файла
     """
-    is_AttributeError = False
-    uid = message.from_user.id
+    session = get_user_session(message)
 
-    user_auth_data = Authorization.objects.filter(
-        telegram_id=uid
-    )
-
-    try:
-        custom_user = CustomUser.objects.get(
-            username_id=user_auth_data.first().id
-        )
-    except AttributeError as e:
-        is_AttributeError = True
+    if session.is_registered:
+        if session.is_authorized:
 
-    if user_auth_data.exists() and not is_AttributeError:
-        if custom_user.is_authorized:
-
-            markup = types.ReplyKeyboardMarkup(
-                resize_keyboard=True
-            )
-
-            btn_main_menu = types.KeyboardButton(
-                text='Главное меню'
-            )
-
-            btn_logout = types.KeyboardButton(
-                text='Выход'
-            )
-
-            markup.add(
-                btn_main_menu,
-                btn_logout
-            )
+            markup = NAVIGATION_KEYBOARD
 
             bot.send_message(
                 message.chat.id,
@@ -3654,27 +3263,7 @@ def tournament_rating_realization(message):
             )
 
         else:
-            markup = types.ReplyKeyboardMarkup(
-                resize_keyboard=True
-            )
-
-            btn_register = types.KeyboardButton(
-                text='Регистрация'
-            )
-
-            btn_login = types.KeyboardButton(
-                text='Авторизация'
-            )
-
-            btn_password = types.KeyboardButton(
-                text='Забыл пароль'
-            )
-
-            markup.add(
-                btn_register,
-                btn_login,
-                btn_password
-            )
+            markup = AUTH_KEYBOARD
 
             bot.reply_to(
                 message,
@@ -3683,27 +3272,7 @@ def tournament_rating_realization(message):
             )
 
     else:
-        markup = types.ReplyKeyboardMarkup(
-            resize_keyboard=True
-        )
-
-        btn_register = types.KeyboardButton(
-            text='Регистрация'
-        )
-
-        btn_login = types.KeyboardButton(
-            text='Авторизация'
-        )
-
-        btn_password = types.KeyboardButton(
-            text='Забыл пароль'
-        )
-
-        markup.add(
-            btn_register,
-            btn_login,
-            btn_password
-        )
+        markup = AUTH_KEYBOARD
 
         bot.reply_to(
             message,
@@ -3712,31 +3281,20 @@ def tournament_rating_realization(message):
         )
 
 
-@bot.message_handler(func=lambda message: 'Мое место в рейтинге по баллам (викторина)' in message.text or message.text=='/my_quiz_rating')
+@router.route('Мое место в рейтинге по баллам (викторина)', '/my_quiz_rating')
 def participant_question(message):
     """"
     Фиксирует Telegram ID участника для вывода индивидуального рейтинга
     """
-    is_AttributeError = False
-    uid = message.from_user.id
-    user_auth_data = Authorization.objects.filter(
-        telegram_id=uid
-    )
-
-    try:
-        custom_user = CustomUser.objects.get(
-            username_id=user_auth_data.first().id
-        )
-    except AttributeError as e:
-        is_AttributeError = True
+    session = get_user_session(message)
 
     participants = Authorization.objects.all().filter(
         role=3
     )
 
     participants_list = []
-    if user_auth_data.exists() and not is_AttributeError:
-        if custom_user.is_authorized:
+    if session.is_registered:
+        if session.is_authorized:
             if participants.exists():
                 for participant in participants:
                     part_id = participant.id
@@ -3748,22 +3306,7 @@ def participant_question(message):
                         f"{part_id}: {part_name}" + f" (Telegram: {part_nick}, {part_tel_id})"
                     )
 
-                markup = types.ReplyKeyboardMarkup(
-                    resize_keyboard=True
-                )
-
-                btn_main_menu = types.KeyboardButton(
-                    text='Главное меню'
-                )
-
-                btn_logout = types.KeyboardButton(
-                    text='Выход'
-                )
-
-                markup.add(
-                    btn_main_menu,
-                    btn_logout
-                )
+                markup = NAVIGATION_KEYBOARD
 
                 participants_list = "\n".join(
                     participants_list
@@ -3792,27 +3335,7 @@ def participant_question(message):
                 )
 
         else:
-            markup = types.ReplyKeyboardMarkup(
-                resize_keyboard=True
-            )
-
-            btn_register = types.KeyboardButton(
-                text='Регистрация'
-            )
-
-            btn_login = types.KeyboardButton(
-                text='Авторизация'
-            )
-
-            btn_password = types.KeyboardButton(
-                text='Забыл пароль'
-            )
-
-            markup.add(
-                btn_register,
-                btn_login,
-                btn_password
-            )
+            markup = AUTH_KEYBOARD
 
             bot.reply_to(
                 message,
@@ -3821,27 +3344,7 @@ def participant_question(message):
             )
 
     else:
-        markup = types.ReplyKeyboardMarkup(
-            resize_keyboard=True
-        )
-
-        btn_register = types.KeyboardButton(
-            text='Регистрация'
-        )
-
-        btn_login = types.KeyboardButton(
-            text='Авторизация'
-        )
-
-        btn_password = types.KeyboardButton(
-            text='Забыл пароль'
-        )
-
-        markup.add(
-            btn_register,
-            btn_login,
-            btn_password
-        )
+        markup = AUTH_KEYBOARD
 
         bot.reply_to(
             message,
@@ -3865,46 +3368,20 @@ def process_participant_rating_question(message):
     else:
         tournament_rating(
             message=message,
-            my_telegram_id=telegram_id
+            my_telegram_id=int(telegram_id) if telegram_id.isdigit() else telegram_id
         )
 
 
-@bot.message_handler(func=lambda message: 'Общий рейтинг тура по баллам (викторина)' in message.text or message.text == '/quiz_tour_stat')
+@router.route('Общий рейтинг тура по баллам (викторина)', '/quiz_tour_stat')
 def tour_question(message):
     """"
     Фиксирует номер тура для вывода рейтинга участников в разрезе тура
     """
-    is_AttributeError = False
-    uid = message.from_user.id
-    user_auth_data = Authorization.objects.filter(
-        telegram_id=uid
-    )
-
-    try:
-        custom_user = CustomUser.objects.get(
-            username_id=user_auth_data.first().id
-        )
-    except AttributeError as e:
-        is_AttributeError = True
-
-    if user_auth_data.exists() and not is_AttributeError:
-        if custom_user.is_authorized:
-            markup = types.ReplyKeyboardMarkup(
-                resize_keyboard=True
-            )
-
-            btn_main_menu = types.KeyboardButton(
-                text='Главное меню'
-            )
-
-            btn_logout = types.KeyboardButton(
-                text='Выход'
-            )
+    session = get_user_session(message)
 
-            markup.add(
-                btn_main_menu,
-                btn_logout
-            )
+    if session.is_registered:
+        if session.is_authorized:
+            markup = NAVIGATION_KEYBOARD
 
             response = bot.reply_to(
                 message,
@@ -3918,27 +3395,7 @@ def tour_question(message):
             )
 
         else:
-            markup = types.ReplyKeyboardMarkup(
-                resize_keyboard=True
-            )
-
-            btn_register = types.KeyboardButton(
-                text='Регистрация'
-            )
-
-            btn_login = types.KeyboardButton(
-                text='Авторизация'
-            )
-
-            btn_password = types.KeyboardButton(
-                text='Забыл пароль'
-            )
-
-            markup.add(
-                btn_register,
-                btn_login,
-                btn_password
-            )
+            markup = AUTH_KEYBOARD
 
             bot.reply_to(
                 message,
@@ -3947,27 +3404,7 @@ def tour_question(message):
             )
 
     else:
-        markup = types.ReplyKeyboardMarkup(
-            resize_keyboard=True
-        )
-
-        btn_register = types.KeyboardButton(
-            text='Регистрация'
-        )
-
-        btn_login = types.KeyboardButton(
-            text='Авторизация'
-        )
-
-        btn_password = types.KeyboardButton(
-            text='Забыл пароль'
-        )
-
-        markup.add(
-            btn_register,
-            btn_login,
-            btn_password
-        )
+        markup = AUTH_KEYBOARD
 
         bot.reply_to(
             message,
@@ -3995,48 +3432,24 @@ def process_tour_question(message):
         )
 
 
-@bot.message_handler(func=lambda message: 'Общий рейтинг по всем турам (викторина)' in message.text or message.text == '/quiz_tours_stat')
+@router.route('Общий рейтинг по всем турам (викторина)', '/quiz_tours_stat')
 def tours_output(message):
     """"
     Выводит рейтинг всех туров сразу в виде Excel-файла
     """
-    is_AttributeError = False
-    uid = message.from_user.id
-    user_auth_data = Authorization.objects.filter(
-        telegram_id=uid
-    )
-
-    try:
-        custom_user = CustomUser.objects.get(
-            username_id=user_auth_data.first().id
-        )
-    except AttributeError as e:
-        is_AttributeError = True
-
-    if user_auth_data.exists() and not is_AttributeError:
-        if custom_user.is_authorized:
-
-            markup = types.ReplyKeyboardMarkup(
-                resize_keyboard=True
-            )
+    session = get_user_session(message)
 
-            btn_main_menu = types.KeyboardButton(
-                text='Главное меню'
-            )
+    if session.is_registered:
+        if session.is_authorized:
 
-            btn_logout = types.KeyboardButton(
-                text='Выход'
-            )
-
-            markup.add(
-                btn_main_menu,
-                btn_logout
-            )
+            markup = NAVIGATION_KEYBOARD
 
             tours = Question.objects.all().values_list(
                 'tour_id',
                 flat=True
-            ).distinct()
+            ).distinct().order_by(
+                'tour_id'
+            )
 
             if tours.exists():
                 bot.reply_to(
@@ -4058,27 +3471,7 @@ def tours_output(message):
                 )
 
         else:
-            markup = types.ReplyKeyboardMarkup(
-                resize_keyboard=True
-            )
-
-            btn_register = types.KeyboardButton(
-                text='Регистрация'
-            )
-
-            btn_login = types.KeyboardButton(
-                text='Авторизация'
-            )
-
-            btn_password = types.KeyboardButton(
-                text='Забыл пароль'
-            )
-
-            markup.add(
-                btn_register,
-                btn_login,
-                btn_password
-            )
+            markup = AUTH_KEYBOARD
 
             bot.reply_to(
                 message,
@@ -4087,27 +3480,7 @@ def tours_output(message):
             )
 
     else:
-        markup = types.ReplyKeyboardMarkup(
-            resize_keyboard=True
-        )
-
-        btn_register = types.KeyboardButton(
-            text='Регистрация'
-        )
-
-        btn_login = types.KeyboardButton(
-            text='Авторизация'
-        )
-
-        btn_password = types.KeyboardButton(
-            text='Забыл пароль'
-        )
-
-        markup.add(
-            btn_register,
-            btn_login,
-            btn_password
-        )
+        markup = AUTH_KEYBOARD
 
         bot.reply_to(
             message,
@@ -4116,43 +3489,17 @@ def tours_output(message):
         )
 
 
-@bot.message_handler(func=lambda message: 'Общий рейтинг по верным ответам (викторина)' in message.text or message.text=='/quiz_answers_rating')
+@router.route('Общий рейтинг по верным ответам (викторина)', '/quiz_answers_rating')
 def answers_rating(message):
     """"
     Выводит рейтинг участников с сортированием по количеству правильных ответов
     """
-    is_AttributeError = False
-    uid = message.from_user.id
-    user_auth_data = Authorization.objects.filter(
-        telegram_id=uid
-    )
-
-    try:
-        custom_user = CustomUser.objects.get(
-            username_id=user_auth_data.first().id
-        )
-    except AttributeError as e:
-        is_AttributeError = True
+    session = get_user_session(message)
 
-    if user_auth_data.exists() and not is_AttributeError:
-        if custom_user.is_authorized:
+    if session.is_registered:
+        if session.is_authorized:
 
-            markup = types.ReplyKeyboardMarkup(
-                resize_keyboard=True
-            )
-
-            btn_main_menu = types.KeyboardButton(
-                text='Главное меню'
-            )
-
-            btn_logout = types.KeyboardButton(
-                text='Выход'
-            )
-
-            markup.add(
-                btn_main_menu,
-                btn_logout
-            )
+            markup = NAVIGATION_KEYBOARD
 
             bot.reply_to(
                 message,
@@ -4166,27 +3513,7 @@ def answers_rating(message):
             )
 
         else:
-            markup = types.ReplyKeyboardMarkup(
-                resize_keyboard=True
-            )
-
-            btn_register = types.KeyboardButton(
-                text='Регистрация'
-            )
-
-            btn_login = types.KeyboardButton(
-                text='Авторизация'
-            )
-
-            btn_password = types.KeyboardButton(
-                text='Забыл пароль'
-            )
-
-            markup.add(
-                btn_register,
-                btn_login,
-                btn_password
-            )
+            markup = AUTH_KEYBOARD
 
             bot.reply_to(
                 message,
@@ -4195,27 +3522,7 @@ def answers_rating(message):
             )
 
     else:
-        markup = types.ReplyKeyboardMarkup(
-            resize_keyboard=True
-        )
-
-        btn_register = types.KeyboardButton(
-            text='Регистрация'
-        )
-
-        btn_login = types.KeyboardButton(
-            text='Авторизация'
-        )
-
-        btn_password = types.KeyboardButton(
-            text='Забыл пароль'
-        )
-
-        markup.add(
-            btn_register,
-            btn_login,
-            btn_password
-        )
+        markup = AUTH_KEYBOARD
 
         bot.reply_to(
             message,
@@ -4224,44 +3531,17 @@ def answers_rating(message):
         )
 
 
-@bot.message_handler(func=lambda message: 'Общий рейтинг по баллам (турнир)' in message.text or message.text == '/tournament_rating')
+@router.route('Общий рейтинг по баллам (турнир)', '/tournament_rating')
 def tournament_rating_realization2(message):
     """"
     Выводит общий рейтинг турнира в виде Excel-файла
     """
-    is_AttributeError = False
-    uid = message.from_user.id
-
-    user_auth_data = Authorization.objects.filter(
-        telegram_id=uid
-    )
-
-    try:
-        custom_user = CustomUser.objects.get(
-            username_id=user_auth_data.first().id
-        )
-    except AttributeError as e:
-        is_AttributeError = True
-
-    if user_auth_data.exists() and not is_AttributeError:
-        if custom_user.is_authorized:
+    session = get_user_session(message)
 
-            markup = types.ReplyKeyboardMarkup(
-                resize_keyboard=True
-            )
-
-            btn_main_menu = types.KeyboardButton(
-                text='Главное меню'
-            )
-
-            btn_logout = types.KeyboardButton(
-                text='Выход'
-            )
+    if session.is_registered:
+        if session.is_authorized:
 
-            markup.add(
-                btn_main_menu,
-                btn_logout
-            )
+            markup = NAVIGATION_KEYBOARD
 
             bot.send_message(
                 message.chat.id,
@@ -4274,27 +3554,7 @@ def tournament_rating_realization2(message):
             )
 
         else:
-            markup = types.ReplyKeyboardMarkup(
-                resize_keyboard=True
-            )
-
-            btn_register = types.KeyboardButton(
-                text='Регистрация'
-            )
-
-            btn_login = types.KeyboardButton(
-                text='Авторизация'
-            )
-
-            btn_password = types.KeyboardButton(
-                text='Забыл пароль'
-            )
-
-            markup.add(
-                btn_register,
-                btn_login,
-                btn_password
-            )
+            markup = AUTH_KEYBOARD
 
             bot.reply_to(
                 message,
@@ -4303,27 +3563,7 @@ def tournament_rating_realization2(message):
             )
 
     else:
-        markup = types.ReplyKeyboardMarkup(
-            resize_keyboard=True
-        )
-
-        btn_register = types.KeyboardButton(
-            text='Регистрация'
-        )
-
-        btn_login = types.KeyboardButton(
-            text='Авторизация'
-        )
-
-        btn_password = types.KeyboardButton(
-            text='Забыл пароль'
-        )
-
-        markup.add(
-            btn_register,
-            btn_login,
-            btn_password
-        )
+        markup = AUTH_KEYBOARD
 
         bot.reply_to(
             message,
@@ -4332,32 +3572,20 @@ def tournament_rating_realization2(message):
         )
 
 
-@bot.message_handler(func=lambda message: 'Мое место в рейтинге по баллам (турнир)' in message.text or message.text == '/my_tournam_rating')
+@router.route('Мое место в рейтинге по баллам (турнир)', '/my_tournam_rating')
 def participant_question2(message):
     """"
     Фиксирует Telegram ID участника для вывода индивидуального рейтинга
     """
-    is_AttributeError = False
-    uid = message.from_user.id
-
-    user_auth_data = Authorization.objects.filter(
-        telegram_id=uid
-    )
-
-    try:
-        custom_user = CustomUser.objects.get(
-            username_id=user_auth_data.first().id
-        )
-    except AttributeError as e:
-        is_AttributeError = True
+    session = get_user_session(message)
 
     participants = Authorization.objects.all().filter(
         role=3
     )
 
     participants_list = []
-    if user_auth_data.exists() and not is_AttributeError:
-        if custom_user.is_authorized:
+    if session.is_registered:
+        if session.is_authorized:
             if participants.exists():
                 for participant in participants:
                     part_id = participant.id
@@ -4369,22 +3597,7 @@ def participant_question2(message):
                         f"{part_id}: {part_name}" + f" (Telegram: {part_nick}, {part_tel_id})"
                     )
 
-                markup = types.ReplyKeyboardMarkup(
-                    resize_keyboard=True
-                )
-
-                btn_main_menu = types.KeyboardButton(
-                    text='Главное меню'
-                )
-
-                btn_logout = types.KeyboardButton(
-                    text='Выход'
-                )
-
-                markup.add(
-                    btn_main_menu,
-                    btn_logout
-                )
+                markup = NAVIGATION_KEYBOARD
 
                 participants_list = "\n".join(
                     participants_list
@@ -4413,27 +3626,7 @@ def participant_question2(message):
                 )
 
         else:
-            markup = types.ReplyKeyboardMarkup(
-                resize_keyboard=True
-            )
-
-            btn_register = types.KeyboardButton(
-                text='Регистрация'
-            )
-
-            btn_login = types.KeyboardButton(
-                text='Авторизация'
-            )
-
-            btn_password = types.KeyboardButton(
-                text='Забыл пароль'
-            )
-
-            markup.add(
-                btn_register,
-                btn_login,
-                btn_password
-            )
+            markup = AUTH_KEYBOARD
 
             bot.reply_to(
                 message,
@@ -4442,27 +3635,7 @@ def participant_question2(message):
             )
 
     else:
-        markup = types.ReplyKeyboardMarkup(
-            resize_keyboard=True
-        )
-
-        btn_register = types.KeyboardButton(
-            text='Регистрация'
-        )
-
-        btn_login = types.KeyboardButton(
-            text='Авторизация'
-        )
-
-        btn_password = types.KeyboardButton(
-            text='Забыл пароль'
-        )
-
-        markup.add(
-            btn_register,
-            btn_login,
-            btn_password
-        )
+        markup = AUTH_KEYBOARD
 
         bot.reply_to(
             message,
@@ -4486,46 +3659,20 @@ def process_participant_rating_question2(message):
     else:
         points_tournament_rating(
             message,
-            my_telegram_id=telegram_id
+            my_telegram_id=int(telegram_id) if telegram_id.isdigit() else telegram_id
         )
 
 
-@bot.message_handler(func=lambda message: 'Общий рейтинг турнира по баллам (турнир)' in message.text or message.text == '/tournam_stat')
+@router.route('Общий рейтинг турнира по баллам (турнир)', '/tournam_stat')
 def tour_question2(message):
     """"
     Фиксирует номер тура для вывода рейтинга участников в разрезе турнира
     """
-    is_AttributeError = False
-    uid = message.from_user.id
-    user_auth_data = Authorization.objects.filter(
-        telegram_id=uid
-    )
-
-    try:
-        custom_user = CustomUser.objects.get(
-            username_id=user_auth_data.first().id
-        )
-    except AttributeError as e:
-        is_AttributeError = True
-
-    if user_auth_data.exists() and not is_AttributeError:
-        if custom_user.is_authorized:
-            markup = types.ReplyKeyboardMarkup(
-                resize_keyboard=True
-            )
-
-            btn_main_menu = types.KeyboardButton(
-                text='Главное меню'
-            )
+    session = get_user_session(message)
 
-            btn_logout = types.KeyboardButton(
-                text='Выход'
-            )
-
-            markup.add(
-                btn_main_menu,
-                btn_logout
-            )
+    if session.is_registered:
+        if session.is_authorized:
+            markup = NAVIGATION_KEYBOARD
 
             response = bot.reply_to(
                 message,
@@ -4539,27 +3686,7 @@ def tour_question2(message):
             )
 
         else:
-            markup = types.ReplyKeyboardMarkup(
-                resize_keyboard=True
-            )
-
-            btn_register = types.KeyboardButton(
-                text='Регистрация'
-            )
-
-            btn_login = types.KeyboardButton(
-                text='Авторизация'
-            )
-
-            btn_password = types.KeyboardButton(
-                text='Забыл пароль'
-            )
-
-            markup.add(
-                btn_register,
-                btn_login,
-                btn_password
-            )
+            markup = AUTH_KEYBOARD
 
             bot.reply_to(
                 message,
@@ -4568,27 +3695,7 @@ def tour_question2(message):
             )
 
     else:
-        markup = types.ReplyKeyboardMarkup(
-            resize_keyboard=True
-        )
-
-        btn_register = types.KeyboardButton(
-            text='Регистрация'
-        )
-
-        btn_login = types.KeyboardButton(
-            text='Авторизация'
-        )
-
-        btn_password = types.KeyboardButton(
-            text='Забыл пароль'
-        )
-
-        markup.add(
-            btn_register,
-            btn_login,
-            btn_password
-        )
+        markup = AUTH_KEYBOARD
 
         bot.reply_to(
             message,
@@ -4616,48 +3723,24 @@ def process_tour_question2(message):
         )
 
 
-@bot.message_handler(func=lambda message: 'Общий рейтинг по всем турнирам (турнир)' in message.text or message.text == '/tournams_stat')
+@router.route('Общий рейтинг по всем турнирам (турнир)', '/tournams_stat')
 def tours_output2(message):
     """"
     Выводит рейтинг всех туров сразу в виде Excel-файла
     """
-    is_AttributeError = False
-    uid = message.from_user.id
-    user_auth_data = Authorization.objects.filter(
-        telegram_id=uid
-    )
+    session = get_user_session(message)
 
-    try:
-        custom_user = CustomUser.objects.get(
-            username_id=user_auth_data.first().id
-        )
-    except AttributeError as e:
-        is_AttributeError = True
-
-    if user_auth_data.exists() and not is_AttributeError:
-        if custom_user.is_authorized:
-
-            markup = types.ReplyKeyboardMarkup(
-                resize_keyboard=True
-            )
-
-            btn_main_menu = types.KeyboardButton(
-                text='Главное меню'
-            )
-
-            btn_logout = types.KeyboardButton(
-                text='Выход'
-            )
+    if session.is_registered:
+        if session.is_authorized:
 
-            markup.add(
-                btn_main_menu,
-                btn_logout
-            )
+            markup = NAVIGATION_KEYBOARD
 
             tours = Tournament.objects.all().values_list(
                 'id',
                 flat=True
-            ).distinct()
+            ).distinct().order_by(
+                'id'
+            )
 
             if tours.exists():
                 bot.reply_to(
@@ -4679,27 +3762,7 @@ def tours_output2(message):
                 )
 
         else:
-            markup = types.ReplyKeyboardMarkup(
-                resize_keyboard=True
-            )
-
-            btn_register = types.KeyboardButton(
-                text='Регистрация'
-            )
-
-            btn_login = types.KeyboardButton(
-                text='Авторизация'
-            )
-
-            btn_password = types.KeyboardButton(
-                text='Забыл пароль'
-            )
-
-            markup.add(
-                btn_register,
-                btn_login,
-                btn_password
-            )
+            markup = AUTH_KEYBOARD
 
             bot.reply_to(
                 message,
@@ -4708,27 +3771,7 @@ def tours_output2(message):
             )
 
     else:
-        markup = types.ReplyKeyboardMarkup(
-            resize_keyboard=True
-        )
-
-        btn_register = types.KeyboardButton(
-            text='Регистрация'
-        )
-
-        btn_login = types.KeyboardButton(
-            text='Авторизация'
-        )
-
-        btn_password = types.KeyboardButton(
-            text='Забыл пароль'
-        )
-
-        markup.add(
-            btn_register,
-            btn_login,
-            btn_password
-        )
+        markup = AUTH_KEYBOARD
 
         bot.reply_to(
             message,
@@ -4737,29 +3780,18 @@ def tours_output2(message):
         )
 
 
-@bot.message_handler(func=lambda message: 'Начать викторину' in message.text or message.text == '/start_quiz')
+@router.route('Начать викторину', '/start_quiz')
 def tour_question(message):
     """
     Запускает викторину
     """
-    questions = Question.objects.all()
+    tours = get_tour_ids()
 
-    if questions.exists():
-        tours = questions.values_list(
-            'tour_id',
-            flat=True
-        ).distinct()
-
-        markup = types.ReplyKeyboardMarkup(
-            resize_keyboard=True
+    if tours:
+        markup = get_tours_keyboard(
+            tuple(tours)
         )
 
-        for tour in tours:
-            markup.add(types.KeyboardButton(
-                text=str(tour)
-                )
-            )
-
         reply = bot.reply_to(
             message,
             'Выберите тур для начала викторины:',
@@ -4779,19 +3811,70 @@ def tour_question(message):
         )
 
 
+def is_invalid_file_id_error(error):
+    """
+    Проверяет, что Telegram отклонил запрос из-за недействительного file_id (а не из-за лимитов, блокировки бота и т.п.)
+    """
+    description = (error.description or '').lower()
+
+    return error.error_code == 400 and (
+        'file identifier' in description or 'file_id' in description
+    )
+
+
+def send_question_image(chat_id, question_row):
+    """
+    Отправляет картинку вопроса
+    Если картинка уже отправлялась, то она пересылается по сохраненному file_id без повторной загрузки в Telegram
+    question_row - вопрос из банка вопросов (file_id обновляется и в нем, т.к. update() не сбрасывает банк)
+    """
+    if question_row.image_file_id:
+        try:
+            bot.send_photo(
+                chat_id=chat_id,
+                photo=question_row.image_file_id
+            )
+            return
+
+        except telebot.apihelper.ApiTelegramException as e:
+            if not is_invalid_file_id_error(e):
+                raise
+
+            Question.objects.filter(
+                pk=question_row.pk,
+                image_file_id=question_row.image_file_id
+            ).update(
+                image_file_id=None
+            )
+            question_row.image_file_id = None
+
+    with open(question_row.image.path, 'rb') as photo:
+        sent_message = bot.send_photo(
+            chat_id=chat_id,
+            photo=photo
+        )
+
+    if sent_message and sent_message.photo:
+        Question.objects.filter(
+            pk=question_row.pk,
+            image=question_row.image.name,
+            image_hash=question_row.image_hash
+        ).update(
+            image_file_id=sent_message.photo[-1].file_id
+        )
+        question_row.image_file_id = sent_message.photo[-1].file_id
+
+
 def start_quiz(message, tours, question_number=None, tour_id=None, question_id=None):
     """"
     Начинает викторину или продолжает ее в зависимости от question_number
     question_number - номер вопроса в турнире (ID из таблицы Question)
     """
 
-    is_AttributeError = False
     is_tour_number = False
     is_over = False
     is_repeat = False
 
-    uid = message.from_user.id
-
     if not tour_id:
         tour_input = message.text
 
@@ -4802,43 +3885,19 @@ def start_quiz(message, tours, question_number=None, tour_id=None, question_id=N
         if tour_id in tours:
             is_tour_number = True
 
-    user_auth_data = Authorization.objects.filter(
-        telegram_id=uid
-    )
-
-    try:
-        custom_user = CustomUser.objects.get(
-            username_id=user_auth_data.first().id
-        )
-    except AttributeError as e:
-        is_AttributeError = True
+    session = get_user_session(message)
 
     if is_tour_number:
-        if user_auth_data.exists() and not is_AttributeError:
-            if custom_user.is_authorized:
-                if custom_user.role_id == 3:
-                    markup = types.ReplyKeyboardMarkup(
-                        resize_keyboard=True
-                    )
-
-                    btn_main_menu = types.KeyboardButton(
-                        text='Главное меню'
-                    )
-
-                    btn_logout = types.KeyboardButton(
-                        text='Выход'
-                    )
-
-                    markup.add(
-                        btn_main_menu,
-                        btn_logout
-                    )
+        if session.is_registered:
+            if session.is_authorized:
+                if session.role_id == 3:
+                    markup = NAVIGATION_KEYBOARD
 
-                    questions = Question.objects.filter(
-                        tour_id=tour_input if not tour_id else tour_id
+                    questions = get_tour_questions(
+                        tour_input if not tour_id else tour_id
                     )
 
-                    if questions.exists():
+                    if questions:
 
                         if not question_id:
                             question_ids = [
@@ -4864,27 +3923,12 @@ def start_quiz(message, tours, question_number=None, tour_id=None, question_id=N
                                     is_done_list
                                 )
 
-                                if sum_is_done == questions.count():
+                                if sum_is_done == len(questions):
                                     is_over = True
                                     is_repeat = True
                                     question = None
 
-                                    markup = types.ReplyKeyboardMarkup(
-                                        resize_keyboard=True
-                                    )
-
-                                    btn_main_menu = types.KeyboardButton(
-                                        text='Главное меню'
-                                    )
-
-                                    btn_logout = types.KeyboardButton(
-                                        text='Выход'
-                                    )
-
-                                    markup.add(
-                                        btn_main_menu,
-                                        btn_logout
-                                    )
+                                    markup = NAVIGATION_KEYBOARD
 
                                     bot.reply_to(
                                         message,
@@ -4899,15 +3943,15 @@ def start_quiz(message, tours, question_number=None, tour_id=None, question_id=N
                                 )
 
                             if not is_over:
-                                question = Question.objects.filter(
-                                    tour_question_number_id=question_number,
-                                    tour_id=tour_input if not tour_id else tour_id
+                                question = get_tour_question(
+                                    tour_input if not tour_id else tour_id,
+                                    question_number
                                 )
 
                         else:
-                            question = Question.objects.filter(
-                                tour_question_number_id=question_number,
-                                tour_id=tour_input if not tour_id else tour_id
+                            question = get_tour_question(
+                                tour_input if not tour_id else tour_id,
+                                question_number
                             )
 
                     else:
@@ -4919,19 +3963,19 @@ def start_quiz(message, tours, question_number=None, tour_id=None, question_id=N
                         )
 
                     if question:
-                        tour = question.first().tour_id
-                        tour_question_number_id = question.first().tour_question_number_id
-                        question_text = question.first().question_text
-                        answer_explanation = question.first().explanation[1:][:-1]
+                        tour = question.tour_id
+                        tour_question_number_id = question.tour_question_number_id
+                        question_text = question.question_text
+                        answer_explanation = question.explanation[1:][:-1]
 
                         answer_dict = {
-                            'A': question.first().answer_a,
-                            'B': question.first().answer_b,
-                            'C': question.first().answer_c,
-                            'D': question.first().answer_d,
+                            'A': question.answer_a,
+                            'B': question.answer_b,
+                            'C': question.answer_c,
+                            'D': question.answer_d,
                         }
 
-                        correct_answer = answer_dict.get(question.first().correct_answer)
+                        correct_answer = answer_dict.get(question.correct_answer)
 
                         participant = PointsTransaction.objects.filter(
                             sender_telegram_id=message.from_user.id,
@@ -4944,10 +3988,10 @@ def start_quiz(message, tours, question_number=None, tour_id=None, question_id=N
                                 text=f"### Тур № {tour} ### Вопрос № {tour_question_number_id} ###",
                             )
 
-                        markup = types.ReplyKeyboardMarkup(row_width=2)
-                        for option in list(answer_dict.values()):
-                            button = types.KeyboardButton(option)
-                            markup.add(button)
+                        markup = get_answer_keyboard(
+                            question.id,
+                            tuple(answer_dict.values())
+                        )
 
                         bot.send_message(
                             message.chat.id,
@@ -4955,12 +3999,12 @@ def start_quiz(message, tours, question_number=None, tour_id=None, question_id=N
                             reply_markup=markup,
                         )
 
-                        image_path = question.first().image
-
-                        if image_path:
+                        if question.image:
                             try:
-                                with open(image_path.path, 'rb') as photo:
-                                    bot.send_photo(chat_id=message.chat.id, photo=photo)
+                                send_question_image(
+                                    chat_id=message.chat.id,
+                                    question_row=question
+                                )
                             except Exception as e:
                                 print(f"Ошибка при отправке фото: {e}")
 
@@ -4980,22 +4024,7 @@ def start_quiz(message, tours, question_number=None, tour_id=None, question_id=N
 
                     else:
                         if not is_repeat:
-                            markup = types.ReplyKeyboardMarkup(
-                                resize_keyboard=True
-                            )
-
-                            btn_main_menu = types.KeyboardButton(
-                                text='Главное меню'
-                            )
-
-                            btn_logout = types.KeyboardButton(
-                                text='Выход'
-                            )
-
-                            markup.add(
-                                btn_main_menu,
-                                btn_logout
-                            )
+                            markup = NAVIGATION_KEYBOARD
 
                             bot.reply_to(
                                 message,
@@ -5010,27 +4039,7 @@ def start_quiz(message, tours, question_number=None, tour_id=None, question_id=N
                     )
 
             else:
-                markup = types.ReplyKeyboardMarkup(
-                    resize_keyboard=True
-                )
-
-                btn_register = types.KeyboardButton(
-                    text='Регистрация'
-                )
-
-                btn_login = types.KeyboardButton(
-                    text='Авторизация'
-                )
-
-                btn_password = types.KeyboardButton(
-                    text='Забыл пароль'
-                )
-
-                markup.add(
-                    btn_register,
-                    btn_login,
-                    btn_password
-                )
+                markup = AUTH_KEYBOARD
 
                 bot.reply_to(
                     message,
@@ -5039,27 +4048,7 @@ def start_quiz(message, tours, question_number=None, tour_id=None, question_id=N
                 )
 
         else:
-            markup = types.ReplyKeyboardMarkup(
-                resize_keyboard=True
-            )
-
-            btn_register = types.KeyboardButton(
-                text='Регистрация'
-            )
-
-            btn_login = types.KeyboardButton(
-                text='Авторизация'
-            )
-
-            btn_password = types.KeyboardButton(
-                text='Забыл пароль'
-            )
-
-            markup.add(
-                btn_register,
-                btn_login,
-                btn_password
-            )
+            markup = AUTH_KEYBOARD
 
             bot.reply_to(
                 message,
@@ -5068,22 +4057,7 @@ def start_quiz(message, tours, question_number=None, tour_id=None, question_id=N
             )
 
     else:
-        markup = types.ReplyKeyboardMarkup(
-            resize_keyboard=True
-        )
-
-        btn_main_menu = types.KeyboardButton(
-            text='Главное меню'
-        )
-
-        btn_logout = types.KeyboardButton(
-            text='Выход'
-        )
-
-        markup.add(
-            btn_main_menu,
-            btn_logout
-        )
+        markup = NAVIGATION_KEYBOARD
 
         bot.reply_to(
             message,
@@ -5092,7 +4066,7 @@ def start_quiz(message, tours, question_number=None, tour_id=None, question_id=N
         )
 
 
-@bot.message_handler(func=lambda message: True)
+@router.fallback
 def handle_answer(message, correct_answer=None, answer_explanation=None, question_number=None, tours=None, tour_id=None, question_id=None):
     """"
     Фиксирует ответ участника и переходит к следующему вопросу, если он есть
@@ -5113,7 +4087,7 @@ def handle_answer(message, correct_answer=None, answer_explanation=None, questio
     elif message.text == correct_answer:
         bot.send_message(
             message.chat.id,
-            f"Верно! \n{answer_explanation}", reply_markup=types.ReplyKeyboardRemove()
+            f"Верно! \n{answer_explanation}", reply_markup=REMOVE_KEYBOARD
         )
 
         if not participant.exists():
@@ -5126,10 +4100,8 @@ def handle_answer(message, correct_answer=None, answer_explanation=None, questio
 
         else:
             if participant.first().is_done == 0:
-                PointsTransaction.objects.filter(
-                    sender_telegram_id=uid,
-                    question_id=question_id,
-                ).update(
+                update_points_rows(
+                    participant,
                     is_answered=1,
                     is_done=1,
                 )
@@ -5145,7 +4117,7 @@ def handle_answer(message, correct_answer=None, answer_explanation=None, questio
     else:
         bot.send_message(
             message.chat.id,
-            f"Неверно! \n{answer_explanation}", reply_markup=types.ReplyKeyboardRemove()
+            f"Неверно! \n{answer_explanation}", reply_markup=REMOVE_KEYBOARD
         )
 
         if not participant.exists():
@@ -5157,10 +4129,8 @@ def handle_answer(message, correct_answer=None, answer_explanation=None, questio
             )
 
         else:
-            PointsTransaction.objects.filter(
-                sender_telegram_id=uid,
-                question_id=question_id,
-            ).update(
+            update_points_rows(
+                participant,
                 is_answered=0,
                 is_done=1,
             )
@@ -5175,6 +4145,15 @@ def handle_answer(message, correct_answer=None, answer_explanation=None, questio
 
 
 if __name__ == "__main__":
+    get_question_bank()
+    setup_chat_dispatcher(
+        bot,
+        num_threads=BOT_WORKER_THREADS
+    )
+    start_conversation_sweeper(
+        bot.next_step_backend,
+        interval=CONVERSATION_STATE_SWEEP_INTERVAL
+    )
     bot.polling()
 
     # while True:
@@ -14,3 +14,11 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'quiz.settings')
 
 application = get_asgi_application()
+
+# В режиме webhook бот загружается сразу, чтобы первый апдейт не ждал импорта обработчиков
+from django.conf import settings
+
+if settings.BOT_WEBHOOK_SECRET:
+    from tgbot.views import get_webhook_bot
+
+    get_webhook_bot()
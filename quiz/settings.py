@@ -10,12 +10,22 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.0/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 
 # Telegram bot token
 BOT_TOKEN = '....'
 
+# Количество потоков для обработки сообщений (сообщения одного чата обрабатываются по очереди)
+BOT_WORKER_THREADS = 8
+
+# Режим webhook: Telegram отправляет апдейты на BOT_WEBHOOK_URL (обрабатывается quiz/urls.py по пути BOT_WEBHOOK_PATH)
+# и подписывает их секретом BOT_WEBHOOK_SECRET. Если секрет пустой, то webhook отключен
+BOT_WEBHOOK_URL = ''
+BOT_WEBHOOK_PATH = 'telegram/webhook/'
+BOT_WEBHOOK_SECRET = ''
+
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -79,14 +89,125 @@ WSGI_APPLICATION = 'quiz.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.0/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+# По умолчанию используется SQLite. Для PostgreSQL (нужен пакет psycopg) задайте переменную окружения
+# DB_ENGINE=postgresql и параметры подключения POSTGRES_DB, POSTGRES_USER, POSTGRES_PASSWORD, POSTGRES_HOST, POSTGRES_PORT
+# Тесты запускаются на той же СУБД: DB_ENGINE=postgresql python manage.py test
+
+DB_ENGINE = os.environ.get('DB_ENGINE', 'sqlite')
+
+if DB_ENGINE == 'postgresql':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.environ.get('POSTGRES_DB', 'quiz'),
+            'USER': os.environ.get('POSTGRES_USER', 'postgres'),
+            'PASSWORD': os.environ.get('POSTGRES_PASSWORD', ''),
+            'HOST': os.environ.get('POSTGRES_HOST', 'localhost'),
+            'PORT': os.environ.get('POSTGRES_PORT', '5432'),
+            # Соединение потока переиспользуется до 10 минут и проверяется перед использованием
+            'CONN_MAX_AGE': int(os.environ.get('POSTGRES_CONN_MAX_AGE', 600)),
+            'CONN_HEALTH_CHECKS': True,
+            # Серверные курсоры (выгрузка рейтингов через iterator) не работают через PgBouncer в режиме transaction
+            'DISABLE_SERVER_SIDE_CURSORS': os.environ.get('POSTGRES_DISABLE_SERVER_SIDE_CURSORS') == '1',
+        }
+    }
+
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': BASE_DIR / 'db.sqlite3',
+            # Соединения потоков бота не закрываются после каждого сообщения
+            'CONN_MAX_AGE': None,
+        }
     }
+
+# Бот и админка пишут в одну базу SQLite. PRAGMA выполняются при открытии каждого соединения (tgbot/database.py):
+# WAL позволяет читать во время записи, busy_timeout (мс) - ждать освобождения блокировки вместо ошибки
+# "database is locked", synchronous=NORMAL - не синхронизировать диск на каждый коммит (безопасно в режиме WAL)
+# Сравнение скорости записи: python manage.py benchmark_sqlite
+
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'busy_timeout': 5000,
+    'synchronous': 'NORMAL',
+    'mmap_size': 256 * 1024 * 1024,
+    'cache_size': -20000,
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/5.0/topics/cache/
+# Рейтинги и версия банка вопросов хранятся в файлах, чтобы изменения из админки сбрасывали кэш процесса бота
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'leaderboard': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': BASE_DIR / 'cache' / 'leaderboard',
+        'TIMEOUT': 60 * 60,
+    },
+    'question_bank': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': BASE_DIR / 'cache' / 'question_bank',
+        'TIMEOUT': None,
+    },
+    'users': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': BASE_DIR / 'cache' / 'users',
+        'TIMEOUT': None,
+        'OPTIONS': {
+            'MAX_ENTRIES': 10000,
+        },
+    },
+}
+
+# Тесты запускаются с кэшами в памяти процесса, чтобы не сбрасывать кэши работающего бота
+TEST_RUNNER = 'tgbot.test_runner.LocalCacheTestRunner'
+
+LEADERBOARD_CACHE_ALIAS = 'leaderboard'
+QUESTION_BANK_CACHE_ALIAS = 'question_bank'
+USER_CACHE_ALIAS = 'users'
+
+# Данные авторизации пользователей кэшируются в памяти процесса бота (LRU-кэш с коротким временем жизни)
+# Записи хранятся под версией пользователя из общего кэша USER_CACHE_ALIAS, поэтому вход, выход или смена роли
+# в любом процессе (админка, другой воркер webhook) сбрасывают кэш во всех процессах бота
+
+USER_CACHE_SIZE = 1024
+USER_CACHE_TTL = 30
+
+# Незавершенные диалоги бота (ожидаемые следующие шаги) хранятся в БД или в Redis, если задан URL,
+# и удаляются через CONVERSATION_STATE_TTL секунд без ответа пользователя
+# (заброшенные диалоги вычищаются раз в CONVERSATION_STATE_SWEEP_INTERVAL секунд)
+CONVERSATION_STATE_REDIS_URL = ''
+CONVERSATION_STATE_TTL = 60 * 60 * 24
+CONVERSATION_STATE_SWEEP_INTERVAL = 60 * 10
+
+
+# Password hashing
+# https://docs.djangoproject.com/en/5.0/topics/auth/passwords/
+# Пароли, которые вводятся в боте, хэшируются в отдельных процессах, чтобы не блокировать обработку сообщений
+
+PASSWORD_HASHERS = [
+    'django.contrib.auth.hashers.PBKDF2PasswordHasher',
+    'django.contrib.auth.hashers.PBKDF2SHA1PasswordHasher',
+    'django.contrib.auth.hashers.Argon2PasswordHasher',
+    'django.contrib.auth.hashers.BCryptSHA256PasswordHasher',
+    'django.contrib.auth.hashers.ScryptPasswordHasher',
+    'tgbot.hashers.BotPBKDF2PasswordHasher',
+]
+
+# Профиль хэширования паролей в боте: 'default' - первый хэшер из PASSWORD_HASHERS,
+# 'pbkdf2_sha256_bot' - PBKDF2 с количеством итераций BOT_PASSWORD_ITERATIONS
+BOT_PASSWORD_HASHER = 'default'
+BOT_PASSWORD_ITERATIONS = 260000
+
+PASSWORD_HASHING_WORKERS = 2
+PASSWORD_HASHING_QUEUE_SIZE = 64
+
+
 # Password validation
 # https://docs.djangoproject.com/en/5.0/ref/settings/#auth-password-validators
 
@@ -125,6 +246,10 @@ STATIC_URL = 'static/'
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 
+# При загрузке картинки вопросов уменьшаются до разрешения фото в Telegram и пережимаются в JPEG
+QUESTION_IMAGE_MAX_SIZE = 1280
+QUESTION_IMAGE_QUALITY = 85
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.0/ref/settings/#default-auto-field
 
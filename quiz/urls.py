@@ -19,8 +19,11 @@ from django.urls import path
 from django.conf import settings
 from django.conf.urls import static
 
+from tgbot.views import telegram_webhook
+
 urlpatterns = [
     path('admin/', admin.site.urls),
+    path(settings.BOT_WEBHOOK_PATH, telegram_webhook, name='telegram_webhook'),
 ]
 
 if settings.DEBUG:
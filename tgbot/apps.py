@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class BotConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'tgbot'
+
+    def ready(self):
+        # Настройка соединений с SQLite при их открытии
+        from tgbot import database  # noqa: F401
@@ -0,0 +1,310 @@
+import json
+import threading
+import time
+from collections import Counter
+from datetime import timedelta
+
+from django.apps import apps
+from django.conf import settings
+from django.db import close_old_connections, models, transaction
+from django.db.models import Q
+from django.utils import timezone
+from telebot import Handler
+from telebot.handler_backends import HandlerBackend
+
+from tgbot.models import ConversationState
+
+MODEL_KEY = '__model__'
+
+
+class DatabaseStateStore:
+    """"
+    Хранилище состояния диалогов в таблице ConversationState.
+    Повторяет нужную часть интерфейса клиента Redis (get, set, exists, getdel, delete),
+    поэтому вместо него можно подставить redis.Redis
+    """
+    def get(self, name):
+        return ConversationState.objects.filter(
+            Q(expires_at__isnull=True) | Q(expires_at__gt=timezone.now()),
+            key=name
+        ).values_list('value', flat=True).first()
+
+    def set(self, name, value, ex=None):
+        ConversationState.objects.update_or_create(
+            key=name,
+            defaults={
+                'value': value,
+                'expires_at': timezone.now() + timedelta(seconds=ex) if ex else None
+            }
+        )
+        return True
+
+    def exists(self, *names):
+        return ConversationState.objects.filter(
+            Q(expires_at__isnull=True) | Q(expires_at__gt=timezone.now()),
+            key__in=names
+        ).count()
+
+    def getdel(self, name):
+        with transaction.atomic():
+            state = ConversationState.objects.filter(
+                key=name
+            ).values_list('id', 'value', 'expires_at').first()
+
+            if state is None:
+                return None
+
+            state_id, value, expires_at = state
+
+            # Состояние мог забрать другой процесс бота
+            if not ConversationState.objects.filter(id=state_id).delete()[0]:
+                return None
+
+        if expires_at is not None and expires_at <= timezone.now():
+            return None
+
+        return value
+
+    def delete(self, *names):
+        return ConversationState.objects.filter(
+            key__in=names
+        ).delete()[0]
+
+    def mget(self, names):
+        values = dict(
+            ConversationState.objects.filter(
+                Q(expires_at__isnull=True) | Q(expires_at__gt=timezone.now()),
+                key__in=names
+            ).values_list('key', 'value')
+        )
+        return [values.get(name) for name in names]
+
+    def scan_iter(self, match):
+        # Поддерживается только шаблон вида "<префикс>*"
+        return ConversationState.objects.filter(
+            Q(expires_at__isnull=True) | Q(expires_at__gt=timezone.now()),
+            key__startswith=match.rstrip('*')
+        ).values_list('key', flat=True).iterator()
+
+    def delete_expired(self):
+        """
+        Удаляет устаревшие состояния (в Redis они удаляются автоматически)
+        """
+        return ConversationState.objects.filter(
+            expires_at__lte=timezone.now()
+        ).delete()[0]
+
+
+def get_state_store():
+    """
+    Возвращает хранилище состояния диалогов: Redis, если задан CONVERSATION_STATE_REDIS_URL, иначе таблицу в БД
+    """
+    if settings.CONVERSATION_STATE_REDIS_URL:
+        import redis
+
+        return redis.Redis.from_url(
+            settings.CONVERSATION_STATE_REDIS_URL,
+            decode_responses=True
+        )
+
+    return DatabaseStateStore()
+
+
+def encode_state_value(value):
+    """
+    Приводит аргумент обработчика к JSON-совместимому виду (объекты моделей заменяются ссылками на ID)
+    """
+    if isinstance(value, models.Model):
+        return {
+            MODEL_KEY: value._meta.label_lower,
+            'pk': value.pk
+        }
+    if isinstance(value, (list, tuple)):
+        return [encode_state_value(item) for item in value]
+    if isinstance(value, dict):
+        return {key: encode_state_value(item) for key, item in value.items()}
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+
+    raise TypeError(
+        f'Значение типа {type(value).__name__} нельзя сохранить в состоянии диалога'
+    )
+
+
+def decode_state_value(value):
+    """
+    Восстанавливает аргумент обработчика из JSON (объекты моделей заново загружаются из БД).
+    Если объект уже удален, выбрасывает LookupError
+    """
+    if isinstance(value, list):
+        return [decode_state_value(item) for item in value]
+    if isinstance(value, dict):
+        if MODEL_KEY in value:
+            model = apps.get_model(value[MODEL_KEY])
+            instance = model.objects.filter(pk=value['pk']).first()
+
+            if instance is None:
+                raise LookupError(f'{value[MODEL_KEY]} с ID {value["pk"]} не найден')
+
+            return instance
+
+        return {key: decode_state_value(item) for key, item in value.items()}
+
+    return value
+
+
+class StateStoreHandlerBackend(HandlerBackend):
+    """"
+    Хранит next-step обработчики бота во внешнем хранилище, чтобы начатые диалоги
+    переживали перезапуск бота и были доступны всем его процессам.
+    Вместо самих функций хранятся их имена, вместо объектов моделей - их ID
+    store - хранилище с интерфейсом клиента Redis (get, set, exists, getdel, delete)
+    callbacks - словарь, по которому имена обработчиков снова превращаются в функции (например, globals() бота)
+    ttl - время в секундах, после которого незавершенный диалог считается заброшенным
+    fallback - обработчик сообщения, если диалог успели завершить или его не удалось восстановить
+    """
+    def __init__(self, store, callbacks, ttl, fallback=None, prefix='next_step'):
+        super().__init__()
+        self.store = store
+        self.callbacks = callbacks
+        self.ttl = ttl
+        self.fallback = fallback
+        self.prefix = prefix
+        self.swept_total = 0
+
+    def get_key(self, handler_group_id):
+        return f'{self.prefix}:{handler_group_id}'
+
+    def encode_handler(self, handler):
+        callback_name = handler.callback.__name__
+
+        if self.callbacks.get(callback_name) is not handler.callback:
+            raise ValueError(
+                f'Обработчик {callback_name} должен быть функцией модуля бота'
+            )
+
+        return {
+            'callback': callback_name,
+            'args': encode_state_value(handler.args),
+            'kwargs': encode_state_value(handler.kwargs)
+        }
+
+    def decode_handler(self, state):
+        return Handler(
+            self.callbacks[state['callback']],
+            *decode_state_value(state['args']),
+            **decode_state_value(state['kwargs'])
+        )
+
+    def load_states(self, value):
+        if value is None:
+            return []
+        if isinstance(value, bytes):
+            value = value.decode()
+
+        return json.loads(value)
+
+    def register_handler(self, handler_group_id, handler):
+        key = self.get_key(handler_group_id)
+        states = self.load_states(self.store.get(key))
+        states.append(self.encode_handler(handler))
+
+        self.store.set(
+            key,
+            json.dumps(states, ensure_ascii=False, separators=(',', ':')),
+            ex=self.ttl
+        )
+
+    def clear_handlers(self, handler_group_id):
+        self.store.delete(self.get_key(handler_group_id))
+
+    def get_handlers(self, handler_group_id):
+        """
+        Вызывается для каждого сообщения в потоке, который получает апдейты, поэтому здесь только проверяется
+        наличие диалога. Состояние забирается из хранилища и восстанавливается уже в пуле потоков (см. run_handlers)
+        """
+        try:
+            if not self.store.exists(self.get_key(handler_group_id)):
+                return None
+        finally:
+            close_old_connections()
+
+        return [Handler(self.run_handlers, handler_group_id)]
+
+    def run_handlers(self, message, handler_group_id):
+        """
+        Забирает состояние диалога из хранилища и выполняет его обработчики для сообщения message
+        """
+        states = self.load_states(self.store.getdel(self.get_key(handler_group_id)))
+        handlers = []
+
+        for state in states:
+            try:
+                handlers.append(self.decode_handler(state))
+            except (KeyError, LookupError) as e:
+                print(f"Ошибка восстановления диалога {handler_group_id}: {e}")
+
+        if not handlers:
+            if self.fallback is not None:
+                self.fallback(message)
+            return
+
+        for handler in handlers:
+            handler['callback'](message, *handler['args'], **handler['kwargs'])
+
+    def sweep_expired(self):
+        """
+        Удаляет заброшенные диалоги из хранилища и возвращает их количество
+        """
+        delete_expired = getattr(self.store, 'delete_expired', None)
+        swept = delete_expired() if delete_expired is not None else 0
+        self.swept_total += swept
+        return swept
+
+    def get_stats(self):
+        """
+        Возвращает метрики незавершенных диалогов: их количество, количество ожидаемых шагов по обработчикам
+        и общее количество удаленных заброшенных диалогов
+        """
+        keys = list(self.store.scan_iter(match=f'{self.prefix}:*'))
+        steps = Counter()
+
+        for value in self.store.mget(keys) if keys else []:
+            for state in self.load_states(value):
+                steps[state['callback']] += 1
+
+        return {
+            'conversations': len(keys),
+            'steps': dict(steps.most_common()),
+            'swept_total': self.swept_total
+        }
+
+
+def start_conversation_sweeper(backend, interval):
+    """
+    Запускает фоновый поток, который раз в interval секунд удаляет заброшенные диалоги и выводит метрики
+    """
+    def sweep_conversations():
+        while True:
+            time.sleep(interval)
+
+            try:
+                swept = backend.sweep_expired()
+                stats = backend.get_stats()
+                print(
+                    f"Незавершенных диалогов: {stats['conversations']}, "
+                    f"удалено заброшенных: {swept} (всего {stats['swept_total']}), "
+                    f"по шагам: {stats['steps']}"
+                )
+            except Exception as e:
+                print(f"Ошибка при очистке диалогов: {e}")
+            finally:
+                close_old_connections()
+
+    sweeper = threading.Thread(
+        target=sweep_conversations,
+        name='conversation-sweeper',
+        daemon=True
+    )
+    sweeper.start()
+    return sweeper
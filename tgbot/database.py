@@ -0,0 +1,22 @@
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+
+def apply_sqlite_pragmas(cursor, pragmas):
+    """
+    Выполняет PRAGMA для соединения с SQLite
+    pragmas - словарь {имя PRAGMA: значение}
+    """
+    for name, value in pragmas.items():
+        cursor.execute(f'PRAGMA {name} = {value}')
+
+
+@receiver(connection_created)
+def configure_sqlite_connection(sender, connection, **kwargs):
+    """
+    Настраивает каждое новое соединение с SQLite (журнал WAL, ожидание блокировок, кэш, см. SQLITE_PRAGMAS в settings.py)
+    """
+    if connection.vendor == 'sqlite':
+        with connection.cursor() as cursor:
+            apply_sqlite_pragmas(cursor, settings.SQLITE_PRAGMAS)
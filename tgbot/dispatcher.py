@@ -0,0 +1,108 @@
+import queue
+import threading
+from collections import deque
+
+from django.db import close_old_connections
+from telebot import util
+
+
+def get_update_chat_id(update):
+    """
+    Возвращает ID чата, к которому относится апдейт (сообщение, callback-запрос и т.п.)
+    Если чат определить нельзя, то возвращает None
+    """
+    chat = getattr(update, 'chat', None)
+
+    if chat is not None:
+        return chat.id
+
+    message = getattr(update, 'message', None)
+
+    if message is not None and getattr(message, 'chat', None) is not None:
+        return message.chat.id
+
+    from_user = getattr(update, 'from_user', None)
+
+    if from_user is not None:
+        return from_user.id
+
+
+class ChatOrderedThreadPool(util.ThreadPool):
+    """"
+    Пул потоков для обработки апдейтов (замена стандартного пула TeleBot)
+    Апдейты одного чата обрабатываются строго по очереди, апдейты разных чатов - параллельно
+    Задачи, для которых чат определить нельзя, выполняются любым свободным потоком
+    """
+    def __init__(self, telebot, num_threads=2):
+        self.telebot = telebot
+        self.tasks = queue.Queue()
+        self.num_threads = num_threads
+
+        self.exception_event = threading.Event()
+        self.exception_info = None
+
+        self._chat_tasks = {}
+        self._chat_lock = threading.Lock()
+
+        self.workers = [
+            util.WorkerThread(self.on_exception, self.tasks) for _ in range(num_threads)
+        ]
+
+    def put(self, func, *args, **kwargs):
+        chat_id = get_update_chat_id(args[0]) if args else None
+
+        if chat_id is None:
+            self.tasks.put((self._run_task, (func, args, kwargs), {}))
+            return
+
+        with self._chat_lock:
+            chat_tasks = self._chat_tasks.get(chat_id)
+
+            if chat_tasks is not None:
+                chat_tasks.append((func, args, kwargs))
+                return
+
+            self._chat_tasks[chat_id] = deque()
+
+        self.tasks.put((self._run_chat_task, (chat_id, func, args, kwargs), {}))
+
+    def _run_task(self, func, args, kwargs):
+        """
+        Выполняет задачу и закрывает устаревшие или оборванные соединения потока с БД (см. CONN_MAX_AGE)
+        """
+        try:
+            func(*args, **kwargs)
+
+        finally:
+            close_old_connections()
+
+    def _run_chat_task(self, chat_id, func, args, kwargs):
+        """
+        Выполняет задачу чата и ставит в очередь следующую задачу этого же чата
+        """
+        try:
+            self._run_task(func, args, kwargs)
+
+        finally:
+            with self._chat_lock:
+                chat_tasks = self._chat_tasks[chat_id]
+
+                if chat_tasks:
+                    next_task = chat_tasks.popleft()
+                else:
+                    next_task = None
+                    del self._chat_tasks[chat_id]
+
+            if next_task is not None:
+                self.tasks.put((self._run_chat_task, (chat_id,) + next_task, {}))
+
+
+def setup_chat_dispatcher(bot, num_threads):
+    """
+    Заменяет стандартный пул потоков бота на ChatOrderedThreadPool с num_threads потоками
+    """
+    bot.worker_pool.close()
+    bot.worker_pool = ChatOrderedThreadPool(
+        bot,
+        num_threads=num_threads
+    )
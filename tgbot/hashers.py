@@ -0,0 +1,12 @@
+from django.conf import settings
+from django.contrib.auth.hashers import PBKDF2PasswordHasher
+
+
+class BotPBKDF2PasswordHasher(PBKDF2PasswordHasher):
+    """"
+    Облегченный профиль PBKDF2 для паролей, которые задаются через бота
+    Количество итераций задается в BOT_PASSWORD_ITERATIONS (settings.py)
+    Включается через BOT_PASSWORD_HASHER = 'pbkdf2_sha256_bot'
+    """
+    algorithm = 'pbkdf2_sha256_bot'
+    iterations = settings.BOT_PASSWORD_ITERATIONS
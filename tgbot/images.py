@@ -0,0 +1,57 @@
+import os
+from io import BytesIO
+
+from PIL import Image, ImageOps
+from django.conf import settings
+from django.core.files.base import ContentFile
+
+
+def optimize_question_image(image):
+    """
+    Подготавливает картинку вопроса к отправке в Telegram:
+        * уменьшает картинку до QUESTION_IMAGE_MAX_SIZE пикселей по большей стороне
+        * перекодирует картинку в JPEG с качеством QUESTION_IMAGE_QUALITY
+        * удаляет метаданные (EXIF и т.п.), предварительно развернув картинку по EXIF-ориентации
+    Возвращает ContentFile с оптимизированной картинкой (имя файла сохраняется, расширение меняется на .jpg)
+    image - загруженный файл картинки
+    """
+    image.open('rb')
+    image.seek(0)
+
+    with Image.open(image) as picture:
+        picture = ImageOps.exif_transpose(picture)
+
+        picture.thumbnail(
+            (settings.QUESTION_IMAGE_MAX_SIZE, settings.QUESTION_IMAGE_MAX_SIZE),
+            Image.LANCZOS
+        )
+
+        if picture.mode in ('RGBA', 'LA') or (picture.mode == 'P' and 'transparency' in picture.info):
+            picture = picture.convert('RGBA')
+            background = Image.new('RGB', picture.size, (255, 255, 255))
+            background.paste(picture, mask=picture.getchannel('A'))
+            picture = background
+
+        elif picture.mode != 'RGB':
+            picture = picture.convert('RGB')
+
+        buffer = BytesIO()
+
+        picture.save(
+            buffer,
+            format='JPEG',
+            quality=settings.QUESTION_IMAGE_QUALITY,
+            optimize=True,
+            progressive=True
+        )
+
+    image.seek(0)
+
+    file_name = os.path.splitext(
+        os.path.basename(image.name)
+    )[0] + '.jpg'
+
+    return ContentFile(
+        buffer.getvalue(),
+        name=file_name
+    )
@@ -0,0 +1,89 @@
+from functools import lru_cache
+
+from telebot import types
+
+
+def serialize_keyboard(button_rows, resize_keyboard=True, row_width=3):
+    """
+    Собирает клавиатуру ReplyKeyboardMarkup и возвращает ее в виде JSON
+    Готовый JSON передается в reply_markup как есть, поэтому клавиатура собирается один раз, а не на каждое сообщение
+    button_rows - список вызовов markup.add (каждый элемент - список текстов кнопок)
+    """
+    markup = types.ReplyKeyboardMarkup(
+        resize_keyboard=resize_keyboard,
+        row_width=row_width
+    )
+
+    for button_row in button_rows:
+        markup.add(*[
+            types.KeyboardButton(text=text) for text in button_row
+        ])
+
+    return markup.to_json()
+
+
+AUTH_KEYBOARD = serialize_keyboard([
+    ['Регистрация', 'Авторизация', 'Забыл пароль'],
+])
+
+NAVIGATION_KEYBOARD = serialize_keyboard([
+    ['Главное меню', 'Выход'],
+])
+
+REMOVE_KEYBOARD = types.ReplyKeyboardRemove().to_json()
+
+RATING_BUTTONS = [
+    'Общий рейтинг по баллам (викторина)',
+    'Общий рейтинг по баллам (турнир)',
+    'Мое место в рейтинге по баллам (викторина)',
+    'Мое место в рейтинге по баллам (турнир)',
+    'Общий рейтинг по верным ответам (викторина)',
+    'Общий рейтинг тура по баллам (викторина)',
+    'Общий рейтинг турнира по баллам (турнир)',
+    'Общий рейтинг по всем турам (викторина)',
+    'Общий рейтинг по всем турнирам (турнир)',
+]
+
+DIRECTOR_MAIN_MENU_KEYBOARD = serialize_keyboard([
+    ['Выход', 'Добавить очки за викторину', 'Добавить очки за турнир'] + RATING_BUTTONS,
+])
+
+PARTICIPANT_MAIN_MENU_KEYBOARD = serialize_keyboard([
+    ['Выход', 'Начать викторину'] + RATING_BUTTONS,
+])
+
+
+def get_main_menu_keyboard(role_id):
+    """
+    Возвращает клавиатуру главного меню в зависимости от роли пользователя (2 - директор, остальные - участники)
+    """
+    if role_id == 2:
+        return DIRECTOR_MAIN_MENU_KEYBOARD
+
+    return PARTICIPANT_MAIN_MENU_KEYBOARD
+
+
+@lru_cache(maxsize=1024)
+def get_answer_keyboard(question_id, answers):
+    """
+    Возвращает клавиатуру с вариантами ответа на вопрос (каждый вариант в отдельной строке)
+    Клавиатура собирается один раз на вопрос и его варианты ответа (при изменении ответов собирается заново)
+    question_id - ID вопроса из таблицы Question
+    answers - кортеж вариантов ответа
+    """
+    return serialize_keyboard(
+        [[answer] for answer in answers],
+        resize_keyboard=None,
+        row_width=2
+    )
+
+
+@lru_cache(maxsize=128)
+def get_tours_keyboard(tours):
+    """
+    Возвращает клавиатуру выбора тура (каждый тур в отдельной строке)
+    tours - кортеж номеров туров
+    """
+    return serialize_keyboard(
+        [[str(tour)] for tour in tours]
+    )
@@ -0,0 +1,134 @@
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+
+
+LEADERBOARD_VERSION_KEY = 'leaderboard:version'
+
+_MISSING = object()
+
+
+def get_leaderboard_cache():
+    """
+    Возвращает кэш рейтингов (общий для процесса бота и админки, см. CACHES в settings.py)
+    """
+    return caches[settings.LEADERBOARD_CACHE_ALIAS]
+
+
+def new_leaderboard_version():
+    """
+    Возвращает новую версию рейтингов. Версия - случайный токен, а не счетчик:
+    кэш может вытеснить ключ версии, и счетчик, начавшись заново с 1, вернул бы рейтинги старых версий
+    """
+    return uuid.uuid4().hex
+
+
+def get_version_key(board_type=None, scope_id=None):
+    """
+    Возвращает ключ версии рейтинга board_type по туру или турниру scope_id (None - общий рейтинг)
+    Без board_type возвращает ключ общей версии всех рейтингов (меняется при изменении данных участников)
+    """
+    if board_type is None:
+        return LEADERBOARD_VERSION_KEY
+
+    return f'{LEADERBOARD_VERSION_KEY}:{board_type}:{scope_id}'
+
+
+def get_leaderboard_version(board_type, scope_id):
+    """
+    Возвращает текущую версию рейтинга board_type по scope_id: общую версию всех рейтингов и версию этого рейтинга
+    Версия рейтинга меняется только при изменении баллов, которые в нем учитываются
+    """
+    cache = get_leaderboard_cache()
+
+    return ':'.join(
+        cache.get_or_set(
+            key,
+            new_leaderboard_version,
+            timeout=None
+        ) for key in (get_version_key(), get_version_key(board_type, scope_id))
+    )
+
+
+def invalidate_leaderboards(board_type=None, scope_ids=()):
+    """
+    Сбрасывает рейтинги из кэша, меняя их версию
+    board_type - тип рейтинга, баллы которого изменились (если не задан, то сбрасываются все рейтинги)
+    scope_ids - туры или турниры с измененными баллами (общий рейтинг типа board_type сбрасывается всегда)
+    """
+    if board_type is None:
+        keys = [get_version_key()]
+    else:
+        keys = [get_version_key(board_type, scope_id) for scope_id in {None, *scope_ids}]
+
+    get_leaderboard_cache().set_many(
+        {key: new_leaderboard_version() for key in keys},
+        timeout=None
+    )
+
+
+def get_or_build(key, build):
+    """
+    Возвращает значение из кэша рейтингов, а при его отсутствии строит значение через build() и сохраняет в кэш
+    """
+    cache = get_leaderboard_cache()
+
+    value = cache.get(key, _MISSING)
+
+    if value is _MISSING:
+        value = build()
+        cache.set(key, value)
+
+    return value
+
+
+def get_cached_leaderboard(board_type, scope_id, sort_param, build):
+    """
+    Возвращает рейтинг из кэша, а при его отсутствии строит рейтинг через build() и сохраняет в кэш
+    board_type - тип рейтинга (викторина или турнир)
+    scope_id - номер тура или турнира (None для общего рейтинга)
+    sort_param - параметр сортировки рейтинга
+    """
+    key = f'leaderboard:{get_leaderboard_version(board_type, scope_id)}:{board_type}:{scope_id}:{sort_param}'
+    return get_or_build(key, build)
+
+
+def get_leaderboard_export_key(board_type, scope_id, sort_param, my_telegram_id):
+    """
+    Возвращает ключ Excel-файла с рейтингом для текущей версии рейтингов
+    my_telegram_id - Telegram ID участника (None для полного рейтинга)
+    """
+    return (
+        f'leaderboard_export:{get_leaderboard_version(board_type, scope_id)}:'
+        f'{board_type}:{scope_id}:{sort_param}:{my_telegram_id}'
+    )
+
+
+def get_cached_leaderboard_export(export_key, render):
+    """
+    Возвращает содержимое Excel-файла с рейтингом из кэша, а при его отсутствии формирует файл через render()
+    Файл формируется один раз на версию рейтинга и переиспользуется для всех пользователей
+    """
+    return get_or_build(export_key, render)
+
+
+def get_export_file_id(export_key):
+    """
+    Возвращает file_id, под которым Telegram сохранил Excel-файл с рейтингом (None, если файл еще не отправлялся)
+    """
+    return get_leaderboard_cache().get(f'{export_key}:file_id')
+
+
+def set_export_file_id(export_key, file_id):
+    """
+    Запоминает file_id отправленного Excel-файла с рейтингом для повторной отправки без загрузки файла
+    """
+    get_leaderboard_cache().set(f'{export_key}:file_id', file_id)
+
+
+def delete_export_file_id(export_key):
+    """
+    Удаляет file_id Excel-файла с рейтингом (например, если Telegram перестал его принимать)
+    """
+    get_leaderboard_cache().delete(f'{export_key}:file_id')
@@ -0,0 +1,129 @@
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from tgbot.database import apply_sqlite_pragmas
+
+
+def connect(path, pragmas):
+    connection = sqlite3.connect(path, timeout=5, check_same_thread=False)
+    apply_sqlite_pragmas(connection.cursor(), pragmas)
+    return connection
+
+
+def run_benchmark(path, pragmas, writers, transactions):
+    """
+    Измеряет скорость записи в SQLite: writers потоков (процесс бота) записывают по transactions транзакций,
+    а еще один поток (админка) в это время читает агрегаты по той же таблице
+    Возвращает (транзакций в секунду, количество чтений, количество ошибок "database is locked")
+    """
+    connection = connect(path, pragmas)
+    connection.execute(
+        'CREATE TABLE points (id INTEGER PRIMARY KEY, telegram_id BIGINT NOT NULL, question_id INTEGER NOT NULL, '
+        'bonuses INTEGER, created_at TEXT NOT NULL)'
+    )
+    connection.execute('CREATE INDEX points_telegram_question ON points (telegram_id, question_id)')
+    connection.commit()
+    connection.close()
+
+    errors = []
+    reads = []
+    is_writing = threading.Event()
+    is_writing.set()
+
+    def write(writer_id):
+        writer_connection = connect(path, pragmas)
+
+        for number in range(transactions):
+            try:
+                writer_connection.execute(
+                    "INSERT INTO points (telegram_id, question_id, bonuses, created_at) VALUES (?, ?, ?, datetime('now'))",
+                    (writer_id, number, number % 10)
+                )
+                writer_connection.execute(
+                    'UPDATE points SET bonuses = bonuses + 1 WHERE telegram_id = ? AND question_id = ?',
+                    (writer_id, number)
+                )
+                writer_connection.commit()
+            except sqlite3.OperationalError:
+                writer_connection.rollback()
+                errors.append(writer_id)
+
+        writer_connection.close()
+
+    def read():
+        reader_connection = connect(path, pragmas)
+
+        while is_writing.is_set():
+            try:
+                reader_connection.execute(
+                    'SELECT telegram_id, SUM(bonuses) FROM points GROUP BY telegram_id'
+                ).fetchall()
+                reads.append(1)
+            except sqlite3.OperationalError:
+                errors.append('reader')
+
+        reader_connection.close()
+
+    threads = [threading.Thread(target=write, args=(writer_id,)) for writer_id in range(writers)]
+    reader = threading.Thread(target=read)
+
+    started_at = time.perf_counter()
+    reader.start()
+
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    elapsed = time.perf_counter() - started_at
+    is_writing.clear()
+    reader.join()
+
+    return writers * transactions / elapsed, len(reads), len(errors)
+
+
+class Command(BaseCommand):
+    """"
+    Сравнивает скорость записи в SQLite с настройками по умолчанию и с SQLITE_PRAGMAS
+    """
+    help = 'Сравнивает скорость записи в SQLite без PRAGMA и с SQLITE_PRAGMAS из settings.py (на временной базе)'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--writers',
+            type=int,
+            default=4,
+            help='Количество потоков, записывающих в базу'
+        )
+        parser.add_argument(
+            '--transactions',
+            type=int,
+            default=500,
+            help='Количество транзакций на поток'
+        )
+
+    def handle(self, *args, **options):
+        profiles = [
+            ('Без PRAGMA', {}),
+            ('SQLITE_PRAGMAS', settings.SQLITE_PRAGMAS),
+        ]
+
+        with tempfile.TemporaryDirectory() as directory:
+            for index, (name, pragmas) in enumerate(profiles):
+                throughput, reads, errors = run_benchmark(
+                    path=os.path.join(directory, f'benchmark_{index}.sqlite3'),
+                    pragmas=pragmas,
+                    writers=options['writers'],
+                    transactions=options['transactions']
+                )
+
+                self.stdout.write(
+                    f'{name}: {throughput:.0f} транзакций/с, чтений во время записи: {reads}, '
+                    f'ошибок блокировки: {errors}'
+                )
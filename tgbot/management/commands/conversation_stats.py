@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    """"
+    Выводит метрики незавершенных диалогов бота и при необходимости удаляет заброшенные
+    """
+    help = 'Показывает количество незавершенных диалогов бота по шагам (с --sweep удаляет заброшенные)'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--sweep',
+            action='store_true',
+            help='Удалить диалоги, время жизни которых истекло (CONVERSATION_STATE_TTL)'
+        )
+
+    def handle(self, *args, **options):
+        from bot import bot
+
+        backend = bot.next_step_backend
+
+        if options['sweep']:
+            self.stdout.write(f'Удалено заброшенных диалогов: {backend.sweep_expired()}')
+
+        stats = backend.get_stats()
+        self.stdout.write(f"Незавершенных диалогов: {stats['conversations']}")
+
+        for step, count in stats['steps'].items():
+            self.stdout.write(f'  {step}: {count}')
@@ -0,0 +1,128 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from tgbot.models import PointsTournament, PointsTransaction, Question
+
+
+def get_index_names(model, fields):
+    """
+    Возвращает имена индексов (и уникальных ограничений) таблицы модели, построенных ровно по полям fields
+    """
+    table = model._meta.db_table
+    columns = [model._meta.get_field(field).column for field in fields]
+
+    with connection.cursor() as cursor:
+        constraints = connection.introspection.get_constraints(cursor, table)
+        index_names = [
+            name for name, constraint in constraints.items()
+            if (constraint['index'] or constraint['unique']) and constraint['columns'] == columns
+        ]
+
+        # Уникальные ограничения, созданные вместе с таблицей, SQLite хранит в индексах sqlite_autoindex_*
+        if connection.vendor == 'sqlite':
+            cursor.execute(f'PRAGMA index_list({connection.ops.quote_name(table)})')
+
+            for index_row in cursor.fetchall():
+                cursor.execute(f'PRAGMA index_info({connection.ops.quote_name(index_row[1])})')
+
+                if [column_row[2] for column_row in cursor.fetchall()] == columns:
+                    index_names.append(index_row[1])
+
+    return list(dict.fromkeys(index_names))
+
+
+def get_hot_queries():
+    """
+    Возвращает самые частые запросы бота: (описание, запрос, модель, поля индекса, который должен использоваться)
+    """
+    return [
+        (
+            'Вопрос по номеру тура и номеру вопроса',
+            Question.objects.filter(tour_id=1, tour_question_number_id=1),
+            Question,
+            ['tour_id', 'tour_question_number_id']
+        ),
+        (
+            'Вопросы тура',
+            Question.objects.filter(tour_id=1),
+            Question,
+            ['tour_id', 'tour_question_number_id']
+        ),
+        (
+            'Ответ участника на вопрос викторины',
+            PointsTransaction.objects.filter(sender_telegram_id=1, question_id=1),
+            PointsTransaction,
+            ['sender_telegram', 'question']
+        ),
+        (
+            'Ответы участника на вопросы тура',
+            PointsTransaction.objects.filter(sender_telegram_id=1, question_id__in=[1, 2, 3]),
+            PointsTransaction,
+            ['sender_telegram', 'question']
+        ),
+        (
+            'Баллы участника от директора за вопрос',
+            PointsTransaction.objects.filter(sender_telegram_id=1, transferor_telegram_id=2, question_id=1),
+            PointsTransaction,
+            ['sender_telegram', 'transferor_telegram', 'question']
+        ),
+        (
+            'Полученные участником баллы (викторина)',
+            PointsTransaction.objects.filter(receiver_telegram_id=1),
+            PointsTransaction,
+            ['receiver_telegram']
+        ),
+        (
+            'Баллы участника от директора за турнир',
+            PointsTournament.objects.filter(sender_telegram_id=1, transferor_telegram_id=2, tournament_id=1),
+            PointsTournament,
+            ['sender_telegram', 'transferor_telegram', 'tournament']
+        ),
+        (
+            'Полученные участником баллы (турнир)',
+            PointsTournament.objects.filter(receiver_telegram_id=1),
+            PointsTournament,
+            ['receiver_telegram']
+        ),
+        (
+            'Баллы за турнир',
+            PointsTournament.objects.filter(tournament_id=1),
+            PointsTournament,
+            ['tournament']
+        ),
+    ]
+
+
+class Command(BaseCommand):
+    """"
+    Проверяет через EXPLAIN, что частые запросы бота используют индексы
+    """
+    help = 'Выполняет EXPLAIN для частых запросов бота и проверяет, что в плане используется нужный индекс'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--show-plans',
+            action='store_true',
+            help='Вывести планы всех запросов'
+        )
+
+    def handle(self, *args, **options):
+        failed = []
+
+        for description, queryset, model, fields in get_hot_queries():
+            index_names = get_index_names(model, fields)
+            plan = queryset.explain()
+            is_used = any(index_name in plan for index_name in index_names)
+
+            self.stdout.write(
+                f"{'OK' if is_used else 'НЕТ ИНДЕКСА'}: {description} ({', '.join(index_names or fields)})"
+            )
+
+            if options['show_plans'] or not is_used:
+                self.stdout.write(f'  {plan}')
+
+            if not is_used:
+                failed.append(description)
+
+        if failed:
+            raise CommandError(f'Запросы без индекса: {len(failed)}')
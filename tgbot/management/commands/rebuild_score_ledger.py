@@ -0,0 +1,158 @@
+from django.db import transaction
+from django.db.models import Count, Q, Sum
+from django.db.models.functions import Coalesce
+from django.core.management.base import BaseCommand, CommandError
+
+from tgbot.leaderboard import invalidate_leaderboards
+from tgbot.models import PointsTransaction, PointsTournament, ScoreLedger
+
+
+LEDGER_FIELDS = [
+    'tournament_points',
+    'points_received_or_transferred',
+    'bonuses',
+    'transfer_income',
+    'transfer_loss',
+    'right_answers',
+    'question_count',
+    'sent_count',
+    'received_count',
+]
+
+
+def calculate_score_ledger():
+    """
+    Рассчитывает содержимое ScoreLedger по исходным таблицам PointsTransaction и PointsTournament
+    Возвращает словарь {(Telegram ID, тип записи, номер тура или турнира): {поле: значение}}
+    """
+    sources = [
+        (ScoreLedger.QUIZ, PointsTransaction, 'question__tour_id'),
+        (ScoreLedger.TOURNAMENT, PointsTournament, 'tournament_id'),
+    ]
+
+    score_ledger = {}
+    for ledger_type, points_model, scope_field in sources:
+        sender_annotations = {
+            'tournament_points_sum': Coalesce(Sum('tournament_points'), 0),
+            'points_received_or_transferred_sum': Coalesce(Sum('points_received_or_transferred'), 0),
+            'bonuses_sum': Coalesce(Sum('bonuses'), 0),
+            'transfer_loss_sum': Coalesce(Sum('points_transferred'), 0),
+            'question_count_sum': Count('id', filter=Q(is_done=True)),
+            'sent_count_sum': Count('id'),
+        }
+
+        if points_model is PointsTransaction:
+            sender_annotations['right_answers_sum'] = Count('id', filter=Q(is_answered=True))
+
+        sender_data = points_model.objects.values(
+            'sender_telegram_id',
+            scope_field
+        ).annotate(
+            **sender_annotations
+        ).order_by()
+
+        for item in sender_data:
+            values = score_ledger.setdefault(
+                (item['sender_telegram_id'], ledger_type, item[scope_field]),
+                dict.fromkeys(LEDGER_FIELDS, 0)
+            )
+            for field in LEDGER_FIELDS:
+                values[field] += item.get(f'{field}_sum', 0)
+
+        receiver_data = points_model.objects.filter(
+            receiver_telegram_id__isnull=False
+        ).values(
+            'receiver_telegram_id',
+            scope_field
+        ).annotate(
+            transfer_income_sum=Coalesce(Sum('points_transferred'), 0),
+            received_count_sum=Count('id'),
+        ).order_by()
+
+        for item in receiver_data:
+            values = score_ledger.setdefault(
+                (item['receiver_telegram_id'], ledger_type, item[scope_field]),
+                dict.fromkeys(LEDGER_FIELDS, 0)
+            )
+            values['transfer_income'] += item['transfer_income_sum']
+            values['received_count'] += item['received_count_sum']
+
+    return score_ledger
+
+
+class Command(BaseCommand):
+    help = 'Сверяет ScoreLedger с таблицами PointsTransaction и PointsTournament и исправляет расхождения'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--check',
+            action='store_true',
+            help='Только вывести расхождения, не исправляя их'
+        )
+
+    def handle(self, *args, **options):
+        expected = calculate_score_ledger()
+        actual = {
+            (row.participant_telegram_id, row.ledger_type, row.scope_id): row for row in ScoreLedger.objects.all()
+        }
+
+        missing_rows = []
+        changed_rows = []
+        for key, values in expected.items():
+            row = actual.pop(key, None)
+
+            if row is None:
+                participant_telegram_id, ledger_type, scope_id = key
+                missing_rows.append(ScoreLedger(
+                    participant_telegram_id=participant_telegram_id,
+                    ledger_type=ledger_type,
+                    scope_id=scope_id,
+                    **values
+                ))
+
+            elif any(getattr(row, field) != value for field, value in values.items()):
+                for field, value in values.items():
+                    setattr(row, field, value)
+                changed_rows.append(row)
+
+        extra_rows = [
+            row for row in actual.values() if any(getattr(row, field) for field in LEDGER_FIELDS)
+        ]
+
+        for title, rows in (
+                ('Отсутствуют', missing_rows),
+                ('Расходятся', changed_rows),
+                ('Лишние', extra_rows),
+        ):
+            for row in rows:
+                self.stdout.write(f'{title}: {row}')
+
+        if options['check']:
+            if missing_rows or changed_rows or extra_rows:
+                raise CommandError('ScoreLedger не совпадает с исходными таблицами')
+
+            self.stdout.write(self.style.SUCCESS('ScoreLedger совпадает с исходными таблицами'))
+            return
+
+        with transaction.atomic():
+            ScoreLedger.objects.filter(
+                id__in=[row.id for row in actual.values()]
+            ).delete()
+            ScoreLedger.objects.bulk_update(
+                changed_rows,
+                fields=LEDGER_FIELDS,
+                batch_size=500
+            )
+            ScoreLedger.objects.bulk_create(
+                missing_rows,
+                batch_size=500
+            )
+
+        # bulk_update и bulk_create не отправляют сигналы, поэтому кэш рейтингов сбрасывается вручную
+        if missing_rows or changed_rows or actual:
+            invalidate_leaderboards()
+
+        self.stdout.write(self.style.SUCCESS(
+            f'ScoreLedger пересчитан: добавлено {len(missing_rows)}, '
+            f'исправлено {len(changed_rows)}, удалено {len(actual)}'
+        ))
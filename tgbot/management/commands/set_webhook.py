@@ -0,0 +1,33 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    """"
+    Регистрирует (или удаляет) webhook бота в Telegram
+    """
+    help = 'Регистрирует webhook бота по адресу BOT_WEBHOOK_URL с секретным токеном BOT_WEBHOOK_SECRET'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--delete',
+            action='store_true',
+            help='Удалить webhook и вернуться к long polling'
+        )
+
+    def handle(self, *args, **options):
+        from bot import bot
+
+        if options['delete']:
+            bot.remove_webhook()
+            self.stdout.write('Webhook удален')
+            return
+
+        if not settings.BOT_WEBHOOK_URL or not settings.BOT_WEBHOOK_SECRET:
+            raise CommandError('Заполните BOT_WEBHOOK_URL и BOT_WEBHOOK_SECRET в settings.py')
+
+        bot.set_webhook(
+            url=settings.BOT_WEBHOOK_URL,
+            secret_token=settings.BOT_WEBHOOK_SECRET
+        )
+        self.stdout.write(f'Webhook зарегистрирован: {settings.BOT_WEBHOOK_URL}')
@@ -1,16 +1,23 @@
 import re
+import hashlib
+from functools import partial
 from itertools import groupby
 
-from django.db import models, transaction
+from django.db import models, transaction, IntegrityError
 from django.apps import apps
-from django.db.models import Sum
+from django.db.models import F, Sum
 from django.utils import timezone
 from django.dispatch import receiver
 from django.core.exceptions import ValidationError
 from django.db.models.signals import pre_save, post_migrate, post_save, post_delete
 from django.contrib.auth.models import AbstractUser, Group, Permission
+from PIL.Image import DecompressionBombError
 
 from tgbot.apps import BotConfig
+from tgbot.images import optimize_question_image
+from tgbot.leaderboard import invalidate_leaderboards
+from tgbot.question_bank import invalidate_question_bank
+from tgbot.user_cache import invalidate_user
 
 
 def validate_date_of_birth(value):
@@ -101,6 +108,16 @@ def create_default_roles(sender, **kwargs):
                 )
 
 
+@receiver(post_migrate)
+def reset_caches_after_migrate(sender, **kwargs):
+    """"
+    Сбрасывает кэши рейтингов и банка вопросов после миграций (в кэше могли остаться данные в старом формате)
+    """
+    if sender.name == apps.get_app_config(BotConfig.name).name:
+        invalidate_leaderboards()
+        invalidate_question_bank()
+
+
 class Authorization(models.Model):
     """"
     Содержит данные зарегистрированных пользователей
@@ -141,10 +158,9 @@ class Authorization(models.Model):
         unique=True,
         max_length=100
     )
-    telegram_id = models.CharField(
+    telegram_id = models.BigIntegerField(
         null=False,
-        unique=True,
-        max_length=50
+        unique=True
     )
     role = models.ForeignKey(
         to=Role,
@@ -273,6 +289,7 @@ def update_is_authorized(sender, instance, **kwargs):
     )
     if instance.role_id != auth_obj.role_id:
         instance.is_authorized = False
+        invalidate_user(auth_obj.telegram_id)
 
 
 @receiver(pre_save, sender=CustomUser)
@@ -283,8 +300,34 @@ def update_authorization_role_id(sender, instance, **kwargs):
     auth_obj = Authorization.objects.get(
         id=instance.username_id
     )
-    auth_obj.role_id = instance.role_id
-    auth_obj.save()
+
+    # При входе и выходе роль не меняется, и запись Authorization не пересохраняется
+    if auth_obj.role_id != instance.role_id:
+        auth_obj.role_id = instance.role_id
+        auth_obj.save()
+
+
+@receiver(post_save, sender=CustomUser)
+@receiver(post_delete, sender=CustomUser)
+def reset_user_cache(sender, instance, **kwargs):
+    """
+    Удаляет данные авторизации пользователя из кэша бота после изменения или удаления пользователя
+    """
+    auth_obj = Authorization.objects.filter(
+        id=instance.username_id
+    ).first()
+
+    if auth_obj is not None:
+        invalidate_user(auth_obj.telegram_id)
+
+
+@receiver(post_save, sender=Authorization)
+@receiver(post_delete, sender=Authorization)
+def reset_authorization_cache(sender, instance, **kwargs):
+    """
+    Удаляет данные авторизации пользователя из кэша бота после изменения или удаления его записи в Authorization
+    """
+    invalidate_user(instance.telegram_id)
 
 
 class Question(models.Model):
@@ -300,6 +343,8 @@ class Question(models.Model):
     correct_answer - столбец, обозначающий правильный ответ (A, B, C, D)
     explanation - объяснение к правильному ответу
     image - картинка вопроса
+    image_hash - SHA-256 содержимого картинки вопроса
+    image_file_id - file_id картинки вопроса в Telegram (для повторной отправки без загрузки файла)
     """
     tour_id = models.PositiveIntegerField(
         null=False
@@ -343,11 +388,94 @@ class Question(models.Model):
         upload_to='questions_images/',
         blank = True
     )
+    image_hash = models.CharField(
+        null=True,
+        blank=True,
+        editable=False,
+        max_length=64
+    )
+    image_file_id = models.CharField(
+        null=True,
+        blank=True,
+        editable=False,
+        max_length=250
+    )
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['tour_id', 'tour_question_number_id'],
+                name='unique_question_tour_number'
+            )
+        ]
 
     def __str__(self):
         return f'Question {self.id}'
 
 
+def get_image_hash(image):
+    """
+    Возвращает SHA-256 содержимого картинки
+    """
+    image_hash = hashlib.sha256()
+
+    image.open('rb')
+    image.seek(0)
+
+    for chunk in image.chunks():
+        image_hash.update(chunk)
+
+    image.seek(0)
+
+    return image_hash.hexdigest()
+
+
+@receiver(pre_save, sender=Question)
+def optimize_uploaded_question_image(sender, instance, **kwargs):
+    """
+    Оптимизирует новую картинку вопроса перед сохранением (см. optimize_question_image)
+    Если картинку не удалось открыть или она слишком большая для Pillow (защита от "бомб декомпрессии"),
+    то она сохраняется как есть
+    """
+    if instance.image and not instance.image._committed:
+        try:
+            instance.image = optimize_question_image(instance.image)
+        except (OSError, DecompressionBombError):
+            pass
+
+
+@receiver(pre_save, sender=Question)
+def reset_question_image_file_id(sender, instance, **kwargs):
+    """
+    Пересчитывает хэш картинки вопроса при ее замене
+    Если содержимое картинки изменилось, то сохраненный file_id сбрасывается
+    """
+    if not instance.image:
+        instance.image_hash = None
+        instance.image_file_id = None
+        return
+
+    if instance.image._committed and instance.image_hash and instance.pk:
+        previous_image = Question.objects.filter(
+            pk=instance.pk
+        ).values_list(
+            'image',
+            flat=True
+        ).first()
+
+        if previous_image == instance.image.name:
+            return
+
+    try:
+        image_hash = get_image_hash(instance.image)
+    except (FileNotFoundError, ValueError):
+        image_hash = None
+
+    if image_hash != instance.image_hash:
+        instance.image_hash = image_hash
+        instance.image_file_id = None
+
+
 class PointsTransaction(models.Model):
     """"
     Содержит данные о начисленных и списанных баллах в рамках викторины
@@ -419,6 +547,20 @@ class PointsTransaction(models.Model):
         choices=[(True, 'Да'), (False, 'Нет')]
     )
 
+    class Meta:
+        indexes = [
+            # Ответ участника на вопрос викторины
+            models.Index(
+                fields=['sender_telegram', 'question'],
+                name='points_tx_sender_question'
+            ),
+            # Начисление баллов директором участнику за вопрос
+            models.Index(
+                fields=['sender_telegram', 'transferor_telegram', 'question'],
+                name='points_tx_sender_transferor'
+            ),
+        ]
+
     def __str__(self):
         return f'Transaction {self.id}'
 
@@ -529,6 +671,15 @@ class PointsTournament(models.Model):
         null=False,
     )
 
+    class Meta:
+        indexes = [
+            # Начисление баллов директором участнику за турнир
+            models.Index(
+                fields=['sender_telegram', 'transferor_telegram', 'tournament'],
+                name='points_tour_sender_transferor'
+            ),
+        ]
+
     def __str__(self):
         return f'Transaction {self.id}'
 
@@ -642,3 +793,350 @@ def delete_point_records(sender, instance, **kwargs):
         Standings.objects.filter(
             participant_telegram=instance,
         ).delete()
+
+
+class ScoreLedger(models.Model):
+    """
+    Содержит накопленные баллы участника в разрезе тура викторины или турнира
+    Записи обновляются приращениями при каждом изменении PointsTransaction и PointsTournament
+    participant_telegram - Telegram ID участника
+    ledger_type - тип записи (quiz - тур викторины, tournament - турнир)
+    scope_id - номер тура викторины или ID турнира
+    tournament_points - количество баллов, начисленных по 1-му типу
+    points_received_or_transferred - количество баллов, начисленных по 2-му типу
+    bonuses - количество баллов, начисленных по 3-му типу
+    transfer_income - количество баллов, полученных по 4-му типу
+    transfer_loss - количество баллов, списанных по 4-му типу
+    right_answers - количество правильных ответов
+    question_count - количество пройденных вопросов
+    sent_count - количество записей, в которых участник указан отправителем (sender_telegram)
+    received_count - количество записей, в которых участник указан получателем (receiver_telegram)
+    """
+    QUIZ = 'quiz'
+    TOURNAMENT = 'tournament'
+
+    participant_telegram = models.ForeignKey(
+        'Authorization',
+        related_name='score_ledger',
+        on_delete=models.CASCADE,
+        to_field='telegram_id'
+    )
+    ledger_type = models.CharField(
+        max_length=10,
+        choices=[
+            (QUIZ, 'Викторина'),
+            (TOURNAMENT, 'Турнир')
+        ])
+    scope_id = models.PositiveIntegerField(
+        null=False
+    )
+    tournament_points = models.IntegerField(
+        default=0
+    )
+    points_received_or_transferred = models.IntegerField(
+        default=0
+    )
+    bonuses = models.IntegerField(
+        default=0
+    )
+    transfer_income = models.IntegerField(
+        default=0
+    )
+    transfer_loss = models.IntegerField(
+        default=0
+    )
+    right_answers = models.IntegerField(
+        default=0
+    )
+    question_count = models.IntegerField(
+        default=0
+    )
+    sent_count = models.IntegerField(
+        default=0
+    )
+    received_count = models.IntegerField(
+        default=0
+    )
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['participant_telegram', 'ledger_type', 'scope_id'],
+                name='unique_score_ledger_scope'
+            )
+        ]
+
+    def __str__(self):
+        return f'{self.participant_telegram_id} ({self.ledger_type} {self.scope_id})'
+
+
+def get_score_ledger_contribution(sender, instance, tour_id=None):
+    """
+    Возвращает вклад записи PointsTransaction или PointsTournament в ScoreLedger
+    в виде словаря {(Telegram ID, тип записи, номер тура или турнира): {поле: значение}}
+    tour_id - тур вопроса записи PointsTransaction (если не указан, берется из БД)
+    """
+    if sender is PointsTransaction:
+        ledger_type = ScoreLedger.QUIZ
+        scope_id = tour_id if tour_id is not None else Question.objects.filter(
+            id=instance.question_id
+        ).values_list(
+            'tour_id',
+            flat=True
+        ).first()
+
+    else:
+        ledger_type = ScoreLedger.TOURNAMENT
+        scope_id = instance.tournament_id
+
+    if scope_id is None:
+        return {}
+
+    contribution = {
+        (instance.sender_telegram_id, ledger_type, scope_id): {
+            'tournament_points': instance.tournament_points or 0,
+            'points_received_or_transferred': instance.points_received_or_transferred or 0,
+            'bonuses': instance.bonuses or 0,
+            'transfer_loss': instance.points_transferred or 0,
+            'right_answers': int(bool(getattr(instance, 'is_answered', False))),
+            'question_count': int(bool(instance.is_done)),
+            'sent_count': 1,
+        }
+    }
+
+    if instance.receiver_telegram_id:
+        receiver_key = (instance.receiver_telegram_id, ledger_type, scope_id)
+        receiver_contribution = contribution.setdefault(receiver_key, {})
+        receiver_contribution['transfer_income'] = receiver_contribution.get(
+            'transfer_income', 0
+        ) + (instance.points_transferred or 0)
+        receiver_contribution['received_count'] = receiver_contribution.get(
+            'received_count', 0
+        ) + 1
+
+    return contribution
+
+
+def apply_score_ledger_delta(new_contribution, old_contribution, create=True):
+    """
+    Применяет к ScoreLedger разницу между новым и старым вкладом записи с баллами
+    create - создавать ли отсутствующие записи ScoreLedger (при удалении баллов не требуется)
+    """
+    for key in set(new_contribution) | set(old_contribution):
+        new_values = new_contribution.get(key, {})
+        old_values = old_contribution.get(key, {})
+
+        delta = {}
+        for field in set(new_values) | set(old_values):
+            value = new_values.get(field, 0) - old_values.get(field, 0)
+            if value:
+                delta[field] = value
+
+        if not delta:
+            continue
+
+        telegram_id, ledger_type, scope_id = key
+        ledger_row = ScoreLedger.objects.filter(
+            participant_telegram_id=telegram_id,
+            ledger_type=ledger_type,
+            scope_id=scope_id
+        )
+
+        increments = {field: F(field) + value for field, value in delta.items()}
+
+        if not ledger_row.update(**increments) and create:
+            try:
+                with transaction.atomic():
+                    ScoreLedger.objects.create(
+                        participant_telegram_id=telegram_id,
+                        ledger_type=ledger_type,
+                        scope_id=scope_id,
+                        **delta
+                    )
+            except IntegrityError:
+                ledger_row.update(**increments)
+
+
+def reset_leaderboards_after_commit(*contributions):
+    """
+    Сбрасывает после фиксации транзакции кэш только тех рейтингов, в которых учитываются вклады contributions:
+    рейтингов туров или турниров этих записей и общих рейтингов викторины или турнира
+    """
+    scope_ids = {}
+
+    for contribution in contributions:
+        for _, ledger_type, scope_id in contribution:
+            scope_ids.setdefault(ledger_type, set()).add(scope_id)
+
+    for ledger_type, ledger_scope_ids in scope_ids.items():
+        transaction.on_commit(partial(
+            invalidate_leaderboards,
+            ledger_type,
+            scope_ids=ledger_scope_ids
+        ))
+
+
+@receiver(pre_save, sender=PointsTransaction)
+@receiver(pre_save, sender=PointsTournament)
+def remember_score_ledger_contribution(sender, instance, **kwargs):
+    """
+    Запоминает вклад записи с баллами в ScoreLedger до ее изменения
+    """
+    old_instance = None
+    if instance.pk:
+        old_instance = sender.objects.filter(
+            pk=instance.pk
+        ).first()
+
+    instance._score_ledger_contribution = get_score_ledger_contribution(
+        sender, old_instance
+    ) if old_instance else {}
+
+
+@receiver(post_save, sender=PointsTransaction)
+@receiver(post_save, sender=PointsTournament)
+def update_score_ledger(sender, instance, **kwargs):
+    """
+    Применяет к ScoreLedger изменение баллов после сохранения записи PointsTransaction или PointsTournament
+    """
+    new_contribution = get_score_ledger_contribution(sender, instance)
+
+    old_contribution = getattr(instance, '_score_ledger_contribution', {})
+
+    apply_score_ledger_delta(
+        new_contribution=new_contribution,
+        old_contribution=old_contribution
+    )
+    instance._score_ledger_contribution = new_contribution
+
+    if new_contribution != old_contribution:
+        reset_leaderboards_after_commit(new_contribution, old_contribution)
+
+
+@receiver(post_delete, sender=PointsTransaction)
+@receiver(post_delete, sender=PointsTournament)
+def revert_score_ledger(sender, instance, **kwargs):
+    """
+    Списывает из ScoreLedger вклад удаленной записи PointsTransaction или PointsTournament
+    """
+    old_contribution = get_score_ledger_contribution(sender, instance)
+
+    apply_score_ledger_delta(
+        new_contribution={},
+        old_contribution=old_contribution,
+        create=False
+    )
+    reset_leaderboards_after_commit(old_contribution)
+
+
+@receiver(pre_save, sender=Question)
+def remember_question_tour(sender, instance, **kwargs):
+    """
+    Запоминает тур вопроса до его изменения
+    """
+    instance._previous_tour_id = Question.objects.filter(
+        pk=instance.pk
+    ).values_list(
+        'tour_id',
+        flat=True
+    ).first() if instance.pk else None
+
+
+@receiver(post_save, sender=Question)
+def move_score_ledger_to_new_tour(sender, instance, created, **kwargs):
+    """
+    Переносит в ScoreLedger баллы за вопрос из старого тура в новый, если вопрос перенесли в другой тур
+    """
+    previous_tour_id = getattr(instance, '_previous_tour_id', None)
+
+    if created or previous_tour_id is None or previous_tour_id == instance.tour_id:
+        return
+
+    with transaction.atomic():
+        for points_row in PointsTransaction.objects.filter(question_id=instance.pk).iterator():
+            apply_score_ledger_delta(
+                new_contribution=get_score_ledger_contribution(
+                    PointsTransaction, points_row, tour_id=instance.tour_id
+                ),
+                old_contribution=get_score_ledger_contribution(
+                    PointsTransaction, points_row, tour_id=previous_tour_id
+                )
+            )
+
+    instance._previous_tour_id = instance.tour_id
+    transaction.on_commit(partial(
+        invalidate_leaderboards,
+        ScoreLedger.QUIZ,
+        scope_ids=(previous_tour_id, instance.tour_id)
+    ))
+
+
+@receiver(post_delete, sender=Authorization)
+def reset_leaderboards(sender, **kwargs):
+    """
+    Сбрасывает кэш всех рейтингов после удаления участника
+    Версия меняется только после фиксации транзакции (например, сохранения в админке): иначе бот мог бы
+    успеть построить рейтинг по старым данным и сохранить его под новой версией
+    """
+    transaction.on_commit(invalidate_leaderboards)
+
+
+LEADERBOARD_AUTHORIZATION_FIELDS = ('full_name', 'telegram_nickname', 'telegram_id', 'role_id')
+
+
+@receiver(pre_save, sender=Authorization)
+def remember_leaderboard_fields(sender, instance, **kwargs):
+    """
+    Запоминает данные участника, которые выводятся в рейтингах, до сохранения записи Authorization
+    """
+    instance._leaderboard_fields = Authorization.objects.filter(
+        pk=instance.pk
+    ).values_list(
+        *LEADERBOARD_AUTHORIZATION_FIELDS
+    ).first() if instance.pk else None
+
+
+@receiver(post_save, sender=Authorization)
+def reset_leaderboards_on_authorization_change(sender, instance, created, **kwargs):
+    """
+    Сбрасывает кэш рейтингов, только если изменились ФИО, никнейм, Telegram ID или роль участника
+    """
+    new_fields = tuple(getattr(instance, field) for field in LEADERBOARD_AUTHORIZATION_FIELDS)
+
+    if created or getattr(instance, '_leaderboard_fields', None) != new_fields:
+        transaction.on_commit(invalidate_leaderboards)
+
+
+@receiver(post_save, sender=Question)
+@receiver(post_delete, sender=Question)
+def reset_question_bank(sender, **kwargs):
+    """
+    Сбрасывает банк вопросов бота после изменения вопросов (в т.ч. через админку)
+    Версия меняется только после фиксации транзакции, чтобы бот не загрузил под новой версией старые вопросы
+    """
+    transaction.on_commit(invalidate_question_bank)
+
+
+class ConversationState(models.Model):
+    """"
+    Содержит состояние незавершенных диалогов бота (ожидаемые следующие шаги пользователей)
+    key - ключ состояния (например, next_step:<ID чата>)
+    value - состояние в виде JSON (имя обработчика и его аргументы, модели хранятся в виде ID)
+    expires_at - дата и время, после которых состояние считается устаревшим (диалог заброшен)
+    """
+    key = models.CharField(
+        null=False,
+        unique=True,
+        max_length=255
+    )
+    value = models.TextField(
+        null=False
+    )
+    expires_at = models.DateTimeField(
+        null=True,
+        blank=True,
+        db_index=True
+    )
+
+    def __str__(self):
+        return self.key
@@ -0,0 +1,92 @@
+import os
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import django
+from django.conf import settings
+from django.contrib.auth.hashers import make_password, check_password
+
+
+_executor = None
+_executor_slots = None
+_executor_lock = threading.Lock()
+
+
+def init_password_worker(settings_module):
+    """
+    Настраивает Django в процессе, который хэширует пароли
+    """
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', settings_module)
+    django.setup()
+
+
+def hash_password(password):
+    """
+    Хэширует пароль по профилю BOT_PASSWORD_HASHER (выполняется в пуле процессов)
+    """
+    return make_password(
+        password,
+        hasher=settings.BOT_PASSWORD_HASHER
+    )
+
+
+def verify_password(password, encoded_password):
+    """
+    Проверяет пароль (выполняется в пуле процессов)
+    """
+    return check_password(
+        password,
+        encoded_password
+    )
+
+
+def get_password_executor():
+    """
+    Возвращает пул процессов для хэширования паролей (создается при первом обращении)
+    """
+    global _executor, _executor_slots
+
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(
+                max_workers=settings.PASSWORD_HASHING_WORKERS,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=init_password_worker,
+                initargs=(os.environ.get('DJANGO_SETTINGS_MODULE', 'quiz.settings'),)
+            )
+            _executor_slots = threading.BoundedSemaphore(
+                settings.PASSWORD_HASHING_QUEUE_SIZE
+            )
+
+    return _executor
+
+
+def submit_password_task(function, *args, callback):
+    """
+    Выполняет function(*args) в пуле процессов и передает результат в callback, не блокируя обработчик сообщений
+    Количество ожидающих задач ограничено PASSWORD_HASHING_QUEUE_SIZE: при переполнении обработчик ждет свободного места
+    function - hash_password или verify_password
+    callback - функция, которая получает результат. Вызывается в служебном потоке пула, поэтому должна только
+    передать результат дальше (например, в bot.worker_pool), а не обращаться к БД или Telegram сама
+    """
+    executor = get_password_executor()
+    _executor_slots.acquire()
+
+    try:
+        future = executor.submit(function, *args)
+    except Exception:
+        _executor_slots.release()
+        raise
+
+    def handle_result(done_future):
+        _executor_slots.release()
+
+        try:
+            callback(done_future.result())
+        except Exception as e:
+            print(f"Ошибка при обработке пароля: {e}")
+
+    future.add_done_callback(handle_result)
+
+    return future
@@ -0,0 +1,137 @@
+import threading
+import uuid
+
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import caches
+
+
+QUESTION_BANK_VERSION_KEY = 'question_bank:version'
+
+_question_bank = None
+_question_bank_lock = threading.Lock()
+
+
+def get_question_bank_cache():
+    """
+    Возвращает кэш, в котором хранится версия банка вопросов (общий для процесса бота и админки)
+    """
+    return caches[settings.QUESTION_BANK_CACHE_ALIAS]
+
+
+def new_question_bank_version():
+    """
+    Возвращает новую версию банка вопросов. Версия - случайный токен, а не счетчик: увеличение счетчика в кэше
+    не атомарно между процессами, а после вытеснения ключа счетчик начался бы заново и совпал со старой версией
+    """
+    return uuid.uuid4().hex
+
+
+def get_question_bank_version():
+    """
+    Возвращает текущую версию банка вопросов. Версия меняется при каждом изменении таблицы Question
+    """
+    return get_question_bank_cache().get_or_set(
+        QUESTION_BANK_VERSION_KEY,
+        new_question_bank_version,
+        timeout=None
+    )
+
+
+def invalidate_question_bank():
+    """
+    Сбрасывает банк вопросов во всех процессах, меняя его версию
+    """
+    get_question_bank_cache().set(
+        QUESTION_BANK_VERSION_KEY,
+        new_question_bank_version(),
+        timeout=None
+    )
+
+
+def load_question_bank(version):
+    """
+    Загружает все вопросы из таблицы Question одним запросом
+    Возвращает словарь:
+        * version - версия банка вопросов
+        * tours - {номер тура: кортеж вопросов тура, упорядоченных по номеру вопроса}
+        * questions - {(номер тура, номер вопроса в туре): вопрос}
+    Туры идут в порядке первого появления в таблице (как в values_list('tour_id').distinct())
+    """
+    question_model = apps.get_model('tgbot', 'Question')
+
+    tours = {}
+    questions = {}
+
+    for question in question_model.objects.order_by('id'):
+        tours.setdefault(question.tour_id, []).append(question)
+        questions.setdefault(
+            (question.tour_id, question.tour_question_number_id),
+            question
+        )
+
+    return {
+        'version': version,
+        'tours': {
+            tour_id: tuple(sorted(
+                tour_questions,
+                key=lambda question: question.tour_question_number_id
+            ))
+            for tour_id, tour_questions in tours.items()
+        },
+        'questions': questions,
+    }
+
+
+def get_question_bank():
+    """
+    Возвращает банк вопросов из памяти процесса
+    Банк перезагружается из базы данных только после изменения версии (см. invalidate_question_bank)
+    """
+    global _question_bank
+
+    version = get_question_bank_version()
+    question_bank = _question_bank
+
+    if question_bank is None or question_bank['version'] != version:
+        with _question_bank_lock:
+            if _question_bank is None or _question_bank['version'] != version:
+                _question_bank = load_question_bank(version)
+
+            question_bank = _question_bank
+
+    return question_bank
+
+
+def parse_tour_id(tour_id):
+    """
+    Приводит номер тура к числу (номер тура может прийти текстом из сообщения)
+    """
+    if str(tour_id).isdigit():
+        return int(tour_id)
+
+
+def get_tour_ids():
+    """
+    Возвращает список номеров туров, по которым есть вопросы
+    """
+    return list(get_question_bank()['tours'])
+
+
+def get_tour_questions(tour_id):
+    """
+    Возвращает кортеж вопросов тура, упорядоченных по номеру вопроса (пустой кортеж, если тура нет)
+    """
+    return get_question_bank()['tours'].get(
+        parse_tour_id(tour_id),
+        ()
+    )
+
+
+def get_tour_question(tour_id, question_number):
+    """
+    Возвращает вопрос тура по его номеру в туре (None, если вопроса нет)
+    """
+    return get_question_bank()['questions'].get(
+        (parse_tour_id(tour_id), parse_tour_id(question_number))
+    )
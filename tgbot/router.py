@@ -0,0 +1,56 @@
+class CommandRouter:
+    """"
+    Маршрутизатор текстовых сообщений бота
+    Обработчик выбирается по точному совпадению текста кнопки или команды (/команда) за одно обращение к словарю,
+    поэтому результат не зависит от порядка регистрации обработчиков. Остальные сообщения получает fallback-обработчик
+    """
+    def __init__(self):
+        self.routes = {}
+        self.fallback_handler = None
+
+    @staticmethod
+    def get_route_key(text):
+        """
+        Возвращает ключ маршрута: текст без пробелов по краям, а для команд - команду без аргументов и @имени_бота
+        """
+        text = (text or '').strip()
+
+        if text.startswith('/'):
+            return text.split(maxsplit=1)[0].split('@', 1)[0]
+
+        return text
+
+    def route(self, *texts):
+        """
+        Регистрирует обработчик для текстов кнопок и команд texts
+        """
+        def decorator(handler):
+            for text in texts:
+                if text in self.routes:
+                    raise ValueError(
+                        f'Текст "{text}" уже обрабатывается функцией {self.routes[text].__name__}'
+                    )
+                self.routes[text] = handler
+
+            return handler
+
+        return decorator
+
+    def fallback(self, handler):
+        """
+        Регистрирует обработчик сообщений, для которых не нашлось маршрута
+        """
+        self.fallback_handler = handler
+        return handler
+
+    def resolve(self, message):
+        return self.routes.get(
+            self.get_route_key(message.text),
+            self.fallback_handler
+        )
+
+    def dispatch(self, message):
+        handler = self.resolve(message)
+
+        if handler is not None:
+            return handler(message)
@@ -0,0 +1,133 @@
+from telebot.handler_backends import BaseMiddleware
+
+from tgbot.models import Authorization, CustomUser
+from tgbot.user_cache import user_cache, get_user_cache_key, invalidate_user
+
+
+class UserSession:
+    """"
+    Содержит данные пользователя, отправившего сообщение. Загружается один раз на сообщение (см. get_user_session)
+    telegram_id - Telegram ID пользователя
+    authorization_id - ID пользователя в таблице Authorization (None, если пользователь не зарегистрирован)
+    custom_user_id - ID пользователя в таблице CustomUser (None, если пользователь не зарегистрирован)
+    role_id - роль пользователя
+    is_authorized - статус авторизации пользователя
+    Записи authorization и custom_user загружаются из базы данных только при обращении к ним
+    """
+    def __init__(self, telegram_id, authorization_id=None, custom_user_id=None, role_id=None, is_authorized=False):
+        self.telegram_id = telegram_id
+        self.authorization_id = authorization_id
+        self.custom_user_id = custom_user_id
+        self.role_id = role_id
+        self.is_authorized = is_authorized
+        self._authorization = None
+        self._custom_user = None
+
+    @property
+    def is_registered(self):
+        return self.authorization_id is not None and self.custom_user_id is not None
+
+    @property
+    def authorization(self):
+        if self._authorization is None and self.authorization_id is not None:
+            self._authorization = Authorization.objects.get(
+                id=self.authorization_id
+            )
+
+        return self._authorization
+
+    @property
+    def custom_user(self):
+        if self._custom_user is None and self.custom_user_id is not None:
+            self._custom_user = CustomUser.objects.get(
+                id=self.custom_user_id
+            )
+
+        return self._custom_user
+
+
+def load_user_session(telegram_id):
+    """
+    Загружает данные авторизации пользователя из кэша, а при их отсутствии - из таблиц Authorization и CustomUser
+    В кэше хранится кортеж (ID в Authorization, ID в CustomUser, роль, статус авторизации)
+    """
+    key = get_user_cache_key(telegram_id)
+    user_data = user_cache.get(key)
+
+    if user_data is None:
+        custom_user = CustomUser.objects.filter(
+            username__telegram_id=telegram_id
+        ).order_by(
+            'id'
+        ).values_list(
+            'username_id',
+            'id',
+            'role_id',
+            'is_authorized'
+        ).first()
+
+        if custom_user is not None:
+            user_data = custom_user
+
+        else:
+            user_data = (
+                Authorization.objects.filter(
+                    telegram_id=telegram_id
+                ).values_list(
+                    'id',
+                    flat=True
+                ).first(),
+                None,
+                None,
+                False
+            )
+
+        user_cache.set(key, user_data)
+
+    authorization_id, custom_user_id, role_id, is_authorized = user_data
+
+    return UserSession(
+        telegram_id=telegram_id,
+        authorization_id=authorization_id,
+        custom_user_id=custom_user_id,
+        role_id=role_id,
+        is_authorized=is_authorized
+    )
+
+
+def get_user_session(message):
+    """
+    Возвращает данные пользователя, отправившего сообщение
+    Данные сохраняются в самом сообщении, поэтому в рамках одного сообщения загружаются только один раз
+    """
+    session = getattr(message, 'user_session', None)
+
+    if session is None:
+        session = load_user_session(message.from_user.id)
+        message.user_session = session
+
+    return session
+
+
+def reset_user_session(message):
+    """
+    Сбрасывает данные пользователя в сообщении и в кэше (после входа, выхода или смены пароля)
+    """
+    message.user_session = None
+    invalidate_user(message.from_user.id)
+
+
+class UserSessionMiddleware(BaseMiddleware):
+    """"
+    Загружает данные пользователя до вызова обработчиков сообщений
+    Обработчики получают их через get_user_session(message) или аргумент session
+    """
+    def __init__(self):
+        super().__init__()
+        self.update_types = ['message']
+
+    def pre_process(self, message, data):
+        data['session'] = get_user_session(message)
+
+    def post_process(self, message, data, exception):
+        pass
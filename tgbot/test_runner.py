@@ -0,0 +1,28 @@
+from django.conf import settings
+from django.test.runner import DiscoverRunner
+from django.test.utils import override_settings
+
+
+# Кэши в памяти процесса вместо файловых: иначе тесты сбрасывали бы рейтинги, банк вопросов
+# и данные пользователей работающего бота (сигналы post_migrate и post_save меняют их версии)
+TEST_CACHES = {
+    alias: {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': f'test-{alias}',
+    }
+    for alias in settings.CACHES
+}
+
+
+class LocalCacheTestRunner(DiscoverRunner):
+    """"
+    Запускает тесты с кэшами TEST_CACHES (в т.ч. миграции тестовой базы)
+    """
+    def setup_test_environment(self, **kwargs):
+        super().setup_test_environment(**kwargs)
+        self.cache_override = override_settings(CACHES=TEST_CACHES)
+        self.cache_override.enable()
+
+    def teardown_test_environment(self, **kwargs):
+        self.cache_override.disable()
+        super().teardown_test_environment(**kwargs)
@@ -1,3 +1,612 @@
-from django.test import TestCase
+import datetime
+import json
+import threading
+import time
+from io import StringIO
+from types import SimpleNamespace
 
-# Create your tests here.
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from telebot import Handler
+
+import bot
+from tgbot.models import Authorization, ConversationState, PointsTournament, PointsTransaction, Question, \
+    ScoreLedger, Standings, Tournament
+from tgbot.conversation import DatabaseStateStore, StateStoreHandlerBackend, decode_state_value, encode_state_value
+from tgbot.dispatcher import ChatOrderedThreadPool, get_update_chat_id
+from tgbot.router import CommandRouter
+from tgbot.test_runner import TEST_CACHES
+
+
+def create_authorization(telegram_id, full_name, role_id=3):
+    """
+    Создает пользователя (запись в Standings для участника создается сигналом)
+    """
+    return Authorization.objects.create(
+        uid=str(telegram_id),
+        full_name=full_name,
+        date_of_birth=datetime.date(1990, 1, 1),
+        phone_number=f'8900{telegram_id:07d}',
+        telegram_nickname=f'user{telegram_id}',
+        telegram_id=telegram_id,
+        role_id=role_id
+    )
+
+
+def create_question(tour_id, tour_question_number_id):
+    return Question.objects.create(
+        tour_id=tour_id,
+        tour_question_number_id=tour_question_number_id,
+        question_text='Вопрос',
+        answer_a='A',
+        answer_b='B',
+        answer_c='C',
+        answer_d='D',
+        correct_answer='A'
+    )
+
+
+@override_settings(CACHES=TEST_CACHES)
+class StandingsPlacesTests(TestCase):
+    """"
+    Проверяет пересчет мест в турнирной таблице (update_standings_places)
+    """
+    def setUp(self):
+        for telegram_id, full_name, tournament_points, quiz_points, total_points in (
+                (101, 'Борисов', 10, 5, 15),
+                (102, 'Андреев', 10, None, 15),
+                (103, 'Васильев', 3, 5, 8),
+                (104, 'Григорьев', None, None, None),
+                (105, 'Васильев', None, 7, 8),
+        ):
+            create_authorization(telegram_id, full_name)
+            Standings.objects.filter(
+                participant_telegram_id=telegram_id
+            ).update(
+                tournament_points=tournament_points,
+                quiz_points=quiz_points,
+                total_points=total_points
+            )
+
+    def get_places(self, place_field):
+        return dict(
+            Standings.objects.values_list('participant_telegram_id', place_field)
+        )
+
+    def test_places_with_ties_and_nulls(self):
+        bot.update_standings_places()
+
+        # Одинаковые баллы дают одно место, участники без баллов (NULL) стоят в конце
+        self.assertEqual(
+            self.get_places('tournament_place'),
+            {101: 1, 102: 1, 103: 2, 104: 3, 105: 3}
+        )
+        self.assertEqual(
+            self.get_places('quiz_place'),
+            {105: 1, 101: 2, 103: 2, 102: 3, 104: 3}
+        )
+        # В общем зачете при равных баллах участники упорядочиваются по ФИО
+        self.assertEqual(
+            self.get_places('final_place'),
+            {102: 1, 101: 2, 103: 3, 105: 3, 104: 4}
+        )
+
+    def test_unchanged_places_are_not_written(self):
+        bot.update_standings_places()
+
+        with self.assertNumQueries(1):
+            bot.update_standings_places()
+
+    def test_places_follow_points(self):
+        bot.update_standings_places()
+
+        Standings.objects.filter(
+            participant_telegram_id=104
+        ).update(
+            tournament_points=20,
+            total_points=20
+        )
+        bot.update_standings_places()
+
+        self.assertEqual(
+            self.get_places('tournament_place'),
+            {104: 1, 101: 2, 102: 2, 103: 3, 105: 4}
+        )
+        self.assertEqual(
+            self.get_places('final_place'),
+            {104: 1, 102: 2, 101: 3, 103: 4, 105: 4}
+        )
+
+
+@override_settings(CACHES=TEST_CACHES)
+class StandingsPointsTests(TestCase):
+    """"
+    Проверяет запись итоговых баллов участника в Standings (update_quiz_points, update_tournament_points)
+    """
+    def setUp(self):
+        create_authorization(900, 'Директор', role_id=2)
+        create_authorization(101, 'Иванов')
+        create_authorization(102, 'Петров')
+
+        question = create_question(1, 1)
+        tournament = Tournament.objects.create(tournament_name='Турнир')
+
+        PointsTransaction.objects.create(
+            sender_telegram_id=101,
+            transferor_telegram_id=900,
+            question=question,
+            tournament_points=10,
+            bonuses=3
+        )
+        PointsTransaction.objects.create(
+            sender_telegram_id=102,
+            receiver_telegram_id=101,
+            transferor_telegram_id=900,
+            question=question,
+            points_transferred=4
+        )
+        PointsTournament.objects.create(
+            sender_telegram_id=101,
+            transferor_telegram_id=900,
+            tournament=tournament,
+            tournament_points=7
+        )
+
+    def get_points(self, telegram_id):
+        return Standings.objects.filter(
+            participant_telegram_id=telegram_id
+        ).values_list(
+            'quiz_points',
+            'tournament_points',
+            'total_points',
+            'final_place'
+        ).get()
+
+    def test_points_and_places(self):
+        bot.update_quiz_points(101)
+        bot.update_tournament_points(101)
+        bot.update_quiz_points(102)
+
+        # Доход от трансфера прибавляется получателю и вычитается у отправителя
+        self.assertEqual(self.get_points(101), (17, 7, 24, 1))
+        self.assertEqual(self.get_points(102), (-4, 0, -4, 2))
+
+
+@override_settings(CACHES=TEST_CACHES)
+class ScoreLedgerTests(TestCase):
+    """"
+    Проверяет, что приращения ScoreLedger совпадают с пересчетом rebuild_score_ledger
+    """
+    def setUp(self):
+        create_authorization(900, 'Директор', role_id=2)
+        create_authorization(101, 'Иванов')
+        create_authorization(102, 'Петров')
+        create_authorization(103, 'Сидоров')
+
+        self.question_1 = create_question(1, 1)
+        self.question_2 = create_question(1, 2)
+        self.tournament = Tournament.objects.create(tournament_name='Турнир')
+
+        self.answer = PointsTransaction.objects.create(
+            sender_telegram_id=101,
+            transferor_telegram_id=900,
+            question=self.question_1,
+            tournament_points=10,
+            bonuses=3,
+            is_answered=True,
+            is_done=True
+        )
+        self.transfer = PointsTransaction.objects.create(
+            sender_telegram_id=102,
+            receiver_telegram_id=103,
+            transferor_telegram_id=900,
+            question=self.question_2,
+            points_transferred=4
+        )
+        PointsTournament.objects.create(
+            sender_telegram_id=101,
+            transferor_telegram_id=900,
+            tournament=self.tournament,
+            tournament_points=7
+        )
+
+    def assertLedgerMatchesSource(self):
+        call_command('rebuild_score_ledger', check=True, stdout=StringIO())
+
+    def get_ledger(self, telegram_id, ledger_type, scope_id):
+        return ScoreLedger.objects.get(
+            participant_telegram_id=telegram_id,
+            ledger_type=ledger_type,
+            scope_id=scope_id
+        )
+
+    def test_deltas_on_create(self):
+        self.assertLedgerMatchesSource()
+
+        ledger = self.get_ledger(101, ScoreLedger.QUIZ, 1)
+        self.assertEqual(
+            (ledger.tournament_points, ledger.bonuses, ledger.right_answers, ledger.question_count, ledger.sent_count),
+            (10, 3, 1, 1, 1)
+        )
+        self.assertEqual(self.get_ledger(102, ScoreLedger.QUIZ, 1).transfer_loss, 4)
+        self.assertEqual(self.get_ledger(103, ScoreLedger.QUIZ, 1).transfer_income, 4)
+        self.assertEqual(
+            self.get_ledger(101, ScoreLedger.TOURNAMENT, self.tournament.id).tournament_points,
+            7
+        )
+
+    def test_deltas_on_update_and_delete(self):
+        self.answer.bonuses = None
+        self.answer.is_answered = False
+        self.answer.save()
+        self.assertLedgerMatchesSource()
+
+        self.transfer.delete()
+        self.assertLedgerMatchesSource()
+
+        self.assertEqual(self.get_ledger(103, ScoreLedger.QUIZ, 1).transfer_income, 0)
+
+    def test_question_moved_to_another_tour(self):
+        self.question_1.tour_id = 2
+        self.question_1.save()
+        self.assertLedgerMatchesSource()
+
+        self.assertEqual(self.get_ledger(101, ScoreLedger.QUIZ, 2).tournament_points, 10)
+        self.assertEqual(self.get_ledger(101, ScoreLedger.QUIZ, 1).tournament_points, 0)
+
+    def test_check_detects_and_repairs_mismatch(self):
+        ScoreLedger.objects.filter(participant_telegram_id=101).delete()
+        ScoreLedger.objects.filter(participant_telegram_id=102).update(transfer_loss=0)
+
+        with self.assertRaises(CommandError):
+            self.assertLedgerMatchesSource()
+
+        call_command('rebuild_score_ledger', stdout=StringIO())
+        self.assertLedgerMatchesSource()
+
+
+@override_settings(CACHES=TEST_CACHES)
+class LeaderboardTests(TestCase):
+    """"
+    Проверяет строки рейтингов (build_leaderboard)
+    """
+    def setUp(self):
+        create_authorization(900, 'Директор', role_id=2)
+        create_authorization(101, 'Иванов')
+        create_authorization(102, 'Петров')
+        create_authorization(103, 'Сидоров')
+
+    def test_quiz_leaderboard(self):
+        question_1 = create_question(1, 1)
+        question_2 = create_question(1, 2)
+        question_3 = create_question(2, 1)
+
+        for question, fields in (
+                (question_1, {'sender_telegram_id': 101, 'tournament_points': 10, 'bonuses': 3, 'is_answered': True,
+                              'is_done': True}),
+                (question_3, {'sender_telegram_id': 101, 'points_received_or_transferred': 2, 'is_done': True}),
+                (question_2, {'sender_telegram_id': 102, 'tournament_points': 5, 'is_answered': True,
+                              'is_done': True}),
+                (question_1, {'sender_telegram_id': 102, 'receiver_telegram_id': 103, 'points_transferred': 4}),
+        ):
+            PointsTransaction.objects.create(
+                transferor_telegram_id=900,
+                question=question,
+                **fields
+            )
+
+        # Место, ФИО, никнейм, Telegram ID, итог, баллы по типам 1-3, прибыль, доход и убыток от трансфера,
+        # правильные ответы, вопросы, туры
+        self.assertEqual(
+            bot.build_leaderboard(ScoreLedger.QUIZ),
+            [
+                [1, 'Иванов', 'user101', 101, 15, 10, 2, 3, 0, 0, 0, 1, 2, 2],
+                [2, 'Сидоров', 'user103', 103, 4, 0, 0, 0, 4, 4, 0, 0, 0, 0],
+                [3, 'Петров', 'user102', 102, 1, 5, 0, 0, -4, 0, 4, 1, 1, 1],
+            ]
+        )
+        self.assertEqual(
+            bot.build_leaderboard(ScoreLedger.QUIZ, scope_id=2),
+            [
+                [1, 'Иванов', 'user101', 101, 2, 0, 2, 0, 0, 0, 0, 0, 1, 1],
+            ]
+        )
+
+    def test_tournament_leaderboard(self):
+        tournament_1 = Tournament.objects.create(tournament_name='Турнир 1')
+        tournament_2 = Tournament.objects.create(tournament_name='Турнир 2')
+
+        for tournament, fields in (
+                (tournament_1, {'sender_telegram_id': 101, 'tournament_points': 7}),
+                (tournament_1, {'sender_telegram_id': 102, 'tournament_points': 5, 'bonuses': 3}),
+                (tournament_2, {'sender_telegram_id': 102, 'points_received_or_transferred': 1}),
+        ):
+            PointsTournament.objects.create(
+                transferor_telegram_id=900,
+                tournament=tournament,
+                **fields
+            )
+
+        self.assertEqual(
+            bot.build_leaderboard(ScoreLedger.TOURNAMENT),
+            [
+                [1, 'Петров', 'user102', 102, 9, 5, 1, 3, 0, 0, 0, 2],
+                [2, 'Иванов', 'user101', 101, 7, 7, 0, 0, 0, 0, 0, 1],
+            ]
+        )
+        self.assertEqual(
+            bot.build_leaderboard(ScoreLedger.TOURNAMENT, scope_id=tournament_1.id, sort_param='total_bonuses'),
+            [
+                [1, 'Петров', 'user102', 102, 8, 5, 0, 3, 0, 0, 0, 1],
+                [2, 'Иванов', 'user101', 101, 7, 7, 0, 0, 0, 0, 0, 1],
+            ]
+        )
+
+    def test_no_participants(self):
+        Authorization.objects.filter(role_id=3).delete()
+
+        self.assertIsNone(bot.build_leaderboard(ScoreLedger.QUIZ))
+
+
+def create_update(chat_id, message_id):
+    return SimpleNamespace(
+        chat=SimpleNamespace(id=chat_id),
+        message_id=message_id
+    )
+
+
+class ChatOrderedThreadPoolTests(SimpleTestCase):
+    """"
+    Проверяет, что апдейты одного чата обрабатываются по очереди, а разных чатов - параллельно
+    """
+    def setUp(self):
+        self.pool = ChatOrderedThreadPool(
+            SimpleNamespace(exception_handler=None),
+            num_threads=4
+        )
+        self.addCleanup(self.pool.close)
+
+    def run_updates(self, updates, fail_message_ids=()):
+        """
+        Обрабатывает апдейты в пуле и возвращает (ID чата, ID сообщения) в порядке завершения обработки
+        updates - список (апдейт, время обработки в секундах)
+        """
+        processed = []
+        done = threading.Semaphore(0)
+
+        def handle(update, delay):
+            try:
+                time.sleep(delay)
+                processed.append((update.chat.id, update.message_id))
+
+                if update.message_id in fail_message_ids:
+                    raise RuntimeError('Ошибка обработчика')
+            finally:
+                done.release()
+
+        for update, delay in updates:
+            self.pool.put(handle, update, delay)
+
+        for _ in updates:
+            self.assertTrue(done.acquire(timeout=5))
+
+        return processed
+
+    def test_chat_order_is_kept(self):
+        processed = self.run_updates(
+            [(create_update(1, message_id), 0.05 - message_id * 0.01) for message_id in range(1, 5)] +
+            [(create_update(2, 10), 0)]
+        )
+
+        self.assertEqual(
+            [message_id for chat_id, message_id in processed if chat_id == 1],
+            [1, 2, 3, 4]
+        )
+        # Апдейт другого чата не ждет, пока обработаются сообщения первого чата
+        self.assertEqual(processed[0], (2, 10))
+
+    def test_failed_update_does_not_block_chat(self):
+        processed = self.run_updates(
+            [(create_update(1, message_id), 0) for message_id in range(1, 4)],
+            fail_message_ids=(1,)
+        )
+
+        self.assertEqual(processed, [(1, 1), (1, 2), (1, 3)])
+
+    def test_update_chat_id(self):
+        message = create_update(5, 1)
+
+        self.assertEqual(get_update_chat_id(message), 5)
+        self.assertEqual(get_update_chat_id(SimpleNamespace(message=message, from_user=None)), 5)
+        self.assertEqual(get_update_chat_id(SimpleNamespace(message=None, from_user=SimpleNamespace(id=7))), 7)
+        self.assertIsNone(get_update_chat_id(SimpleNamespace()))
+
+
+conversation_steps = []
+
+
+def remember_conversation_step(message, participant, tours):
+    conversation_steps.append((message.text, participant.telegram_id, tours))
+
+
+@override_settings(CACHES=TEST_CACHES)
+class ConversationStateTests(TestCase):
+    """"
+    Проверяет хранение next-step обработчиков в таблице ConversationState (StateStoreHandlerBackend)
+    """
+    def setUp(self):
+        conversation_steps.clear()
+        self.participant = create_authorization(101, 'Иванов')
+        self.fallback_messages = []
+
+        router = CommandRouter()
+        router.fallback(lambda message: self.fallback_messages.append(message.text))
+
+        self.store = DatabaseStateStore()
+        self.backend = StateStoreHandlerBackend(
+            store=self.store,
+            callbacks={'remember_conversation_step': remember_conversation_step},
+            ttl=60,
+            fallback=router.dispatch
+        )
+
+    def register_step(self, chat_id=5):
+        self.backend.register_handler(
+            chat_id,
+            Handler(remember_conversation_step, participant=self.participant, tours=['1', '2'])
+        )
+
+    def send(self, text, chat_id=5):
+        """
+        Повторяет обработку сообщения ботом: проверка диалога в потоке приема апдейтов и его выполнение в пуле потоков
+        """
+        message = SimpleNamespace(text=text)
+        handlers = self.backend.get_handlers(chat_id)
+
+        for handler in handlers or []:
+            handler['callback'](message, *handler['args'], **handler['kwargs'])
+
+        return handlers
+
+    def test_state_value_encoding(self):
+        value = {'participant': self.participant, 'tours': ['1', 2], 'bonuses': None}
+        encoded = encode_state_value(value)
+
+        self.assertEqual(
+            json.loads(json.dumps(encoded)),
+            {'participant': {'__model__': 'tgbot.authorization', 'pk': self.participant.pk},
+             'tours': ['1', 2], 'bonuses': None}
+        )
+        self.assertEqual(decode_state_value(encoded), value)
+
+        with self.assertRaises(TypeError):
+            encode_state_value(object())
+
+        self.participant.delete()
+
+        with self.assertRaises(LookupError):
+            decode_state_value(encoded)
+
+    def test_step_is_restored_once(self):
+        self.register_step()
+
+        self.assertTrue(self.send('1'))
+        self.assertEqual(conversation_steps, [('1', 101, ['1', '2'])])
+        self.assertFalse(ConversationState.objects.exists())
+
+        self.assertIsNone(self.send('2'))
+        self.assertEqual(len(conversation_steps), 1)
+
+    def test_only_existence_is_checked_before_worker(self):
+        self.register_step()
+
+        with self.assertNumQueries(1):
+            handlers = self.backend.get_handlers(5)
+
+        self.assertEqual(len(handlers), 1)
+        self.assertTrue(ConversationState.objects.exists())
+
+    def test_lost_race_falls_back_to_router(self):
+        self.register_step()
+        handlers = self.backend.get_handlers(5)
+
+        # Диалог забрал другой процесс бота между проверкой и выполнением обработчика
+        self.store.delete(self.backend.get_key(5))
+
+        for handler in handlers:
+            handler['callback'](SimpleNamespace(text='1'), *handler['args'], **handler['kwargs'])
+
+        self.assertEqual(conversation_steps, [])
+        self.assertEqual(self.fallback_messages, ['1'])
+
+    def test_deleted_model_falls_back_to_router(self):
+        self.register_step()
+        self.participant.delete()
+
+        self.send('1')
+
+        self.assertEqual(conversation_steps, [])
+        self.assertEqual(self.fallback_messages, ['1'])
+
+    def test_expired_state(self):
+        self.register_step()
+        self.register_step(chat_id=6)
+        key = self.backend.get_key(5)
+
+        ConversationState.objects.filter(key=key).update(
+            expires_at=timezone.now() - datetime.timedelta(seconds=1)
+        )
+
+        self.assertIsNone(self.store.get(key))
+        self.assertEqual(self.store.exists(key), 0)
+        self.assertIsNone(self.send('1'))
+        self.assertEqual(self.store.mget([key, self.backend.get_key(6)])[0], None)
+
+        self.assertEqual(self.backend.sweep_expired(), 1)
+        self.assertEqual(
+            list(ConversationState.objects.values_list('key', flat=True)),
+            [self.backend.get_key(6)]
+        )
+        self.assertEqual(
+            self.backend.get_stats(),
+            {'conversations': 1, 'steps': {'remember_conversation_step': 1}, 'swept_total': 1}
+        )
+
+    def test_callback_must_be_module_function(self):
+        with self.assertRaises(ValueError):
+            self.backend.register_handler(5, Handler(lambda message: None))
+
+        with self.assertRaises(ValueError):
+            self.backend.register_handler(5, Handler(self.send))
+
+        self.assertFalse(ConversationState.objects.exists())
+
+
+class CommandRouterTests(SimpleTestCase):
+    """"
+    Проверяет выбор обработчика сообщения по тексту кнопки или команды (CommandRouter)
+    """
+    def setUp(self):
+        self.router = CommandRouter()
+        self.calls = []
+
+        @self.router.route('Рейтинг', '/rating')
+        def rating(message):
+            self.calls.append(('rating', message.text))
+            return 'rating'
+
+        @self.router.fallback
+        def unknown(message):
+            self.calls.append(('unknown', message.text))
+
+    def test_route_key(self):
+        self.assertEqual(CommandRouter.get_route_key('/rating@QuizBot 1 2'), '/rating')
+        self.assertEqual(CommandRouter.get_route_key('  /rating  '), '/rating')
+        self.assertEqual(CommandRouter.get_route_key(' Рейтинг\n'), 'Рейтинг')
+        self.assertEqual(CommandRouter.get_route_key('Рейтинг участника'), 'Рейтинг участника')
+        self.assertEqual(CommandRouter.get_route_key(None), '')
+
+    def test_dispatch(self):
+        for text in ('Рейтинг', '/rating@QuizBot', '/rating 2', 'рейтинг', None):
+            self.router.dispatch(SimpleNamespace(text=text))
+
+        self.assertEqual(self.calls, [
+            ('rating', 'Рейтинг'),
+            ('rating', '/rating@QuizBot'),
+            ('rating', '/rating 2'),
+            ('unknown', 'рейтинг'),
+            ('unknown', None),
+        ])
+
+    def test_duplicate_route(self):
+        with self.assertRaises(ValueError):
+            self.router.route('/rating')(lambda message: None)
+
+    def test_without_fallback(self):
+        self.assertIsNone(CommandRouter().dispatch(SimpleNamespace(text='/rating')))
+
+    def test_bot_routes(self):
+        self.assertIs(bot.router.resolve(SimpleNamespace(text='/start@QuizBot')), bot.start)
+        self.assertIs(bot.router.resolve(SimpleNamespace(text='Главное меню')), bot.main_menu)
@@ -0,0 +1,99 @@
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from functools import partial
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+
+
+class UserCache:
+    """"
+    LRU-кэш с ограниченным временем жизни записей (используется для данных авторизации пользователей)
+    max_size - максимальное количество записей (при превышении удаляются давно не использованные записи)
+    ttl - время жизни записи в секундах
+    """
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+
+            if item is None:
+                return None
+
+            expires_at, value = item
+
+            if expires_at <= time.monotonic():
+                del self._items[key]
+                return None
+
+            self._items.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._items[key] = (time.monotonic() + self.ttl, value)
+            self._items.move_to_end(key)
+
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+
+user_cache = UserCache(
+    max_size=settings.USER_CACHE_SIZE,
+    ttl=settings.USER_CACHE_TTL
+)
+
+
+def get_user_version_cache():
+    """
+    Возвращает общий для всех процессов кэш, в котором хранятся версии данных пользователей
+    """
+    return caches[settings.USER_CACHE_ALIAS]
+
+
+def new_user_version():
+    return uuid.uuid4().hex
+
+
+def get_user_cache_key(telegram_id):
+    """
+    Возвращает ключ данных авторизации пользователя в кэше процесса: Telegram ID и текущая версия пользователя
+    Если ключ версии вытеснен из общего кэша, то создается новая версия, и данные перечитываются из БД
+    """
+    version = get_user_version_cache().get_or_set(
+        f'user:version:{telegram_id}',
+        new_user_version,
+        timeout=None
+    )
+
+    return f'{telegram_id}:{version}'
+
+
+def invalidate_user(telegram_id):
+    """
+    Сбрасывает данные авторизации пользователя в кэше всех процессов (после входа, выхода, смены пароля или роли),
+    меняя версию пользователя в общем кэше. Версия меняется после фиксации транзакции, чтобы процесс бота
+    не закэшировал под новой версией еще не сохраненные данные
+    """
+    transaction.on_commit(partial(
+        get_user_version_cache().set,
+        f'user:version:{telegram_id}',
+        new_user_version(),
+        timeout=None
+    ))
@@ -1,3 +1,65 @@
-from django.shortcuts import render
+import threading
 
-# Create your views here.
+import telebot
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseForbidden, Http404
+from django.utils.crypto import constant_time_compare
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
+
+
+_webhook_bot = None
+_webhook_bot_lock = threading.Lock()
+
+
+def get_webhook_bot():
+    """
+    Возвращает бота из bot.py для обработки апдейтов, пришедших через webhook
+    При первом обращении загружает банк вопросов, включает пул потоков с сохранением порядка сообщений в чате
+    и запускает очистку заброшенных диалогов
+    """
+    global _webhook_bot
+
+    with _webhook_bot_lock:
+        if _webhook_bot is None:
+            from bot import bot, get_question_bank, setup_chat_dispatcher, start_conversation_sweeper
+
+            get_question_bank()
+            setup_chat_dispatcher(
+                bot,
+                num_threads=settings.BOT_WORKER_THREADS
+            )
+            start_conversation_sweeper(
+                bot.next_step_backend,
+                interval=settings.CONVERSATION_STATE_SWEEP_INTERVAL
+            )
+            _webhook_bot = bot
+
+    return _webhook_bot
+
+
+@csrf_exempt
+@require_POST
+def telegram_webhook(request):
+    """
+    Принимает апдейты Telegram и передает их обработчикам бота
+    Апдейт принимается только с верным секретным токеном (заголовок X-Telegram-Bot-Api-Secret-Token)
+    """
+    if not settings.BOT_WEBHOOK_SECRET:
+        raise Http404
+
+    secret_token = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+
+    if not constant_time_compare(secret_token, settings.BOT_WEBHOOK_SECRET):
+        return HttpResponseForbidden()
+
+    try:
+        update = telebot.types.Update.de_json(
+            request.body.decode('utf-8')
+        )
+    except ValueError:
+        return HttpResponseBadRequest()
+
+    get_webhook_bot().process_new_updates([update])
+
+    return HttpResponse()